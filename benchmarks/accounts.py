@@ -0,0 +1,73 @@
+'''measure login lookups per second against a large account store
+
+Fills a SQLite store with --count identities, then times find() for random
+known identities, unknown ones, and rekeyed clients sending their previous
+IDK, with and without the read cache.
+
+    python benchmarks/accounts.py --count 1000000 --seconds 2
+'''
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from sqrl.accounts import Account, SQLiteAccountStore
+
+
+def populate(store, count, batch=100000):
+    '''insert count accounts, return their idks'''
+    idks = []
+    for start in range(0, count, batch):
+        rows = [Account(os.urandom(32), os.urandom(32), os.urandom(32),
+                        None, None, 0)
+                for _ in range(min(batch, count - start))]
+        store.create_many(rows)
+        idks.extend(a.idk for a in rows)
+    return idks
+
+
+def run(lookup, keys, seconds):
+    '''call lookup on keys for seconds, return calls per second'''
+    n = 0
+    start = time.perf_counter()
+    deadline = start + seconds
+    while time.perf_counter() < deadline:
+        for key in keys:
+            lookup(key)
+        n += len(keys)
+    return n / (time.perf_counter() - start)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument('--count', type=int, default=1000000)
+    ap.add_argument('--seconds', type=float, default=2)
+    ap.add_argument('--hot', type=int, default=10000,
+                    help='distinct identities looked up')
+    ap.add_argument('--db', help='database file (default: a temporary one)')
+    args = ap.parse_args()
+
+    path = args.db or os.path.join(tempfile.mkdtemp(), 'accounts.db')
+    store = SQLiteAccountStore(path, cache_size=0)
+    t = time.perf_counter()
+    idks = populate(store, args.count)
+    print('{} accounts in {:.1f}s'.format(args.count, time.perf_counter() - t))
+
+    hot = random.sample(idks, min(args.hot, len(idks)))
+    unknown = [os.urandom(32) for _ in hot]
+    cached = SQLiteAccountStore(path, cache_size=2 * len(hot))
+    cases = (
+        ('known', lambda k: store.find(k)),
+        ('unknown', lambda k: store.find(k)),
+        ('rekeyed', lambda k: store.find(os.urandom(32), k)),
+        ('known cached', lambda k: cached.find(k)),
+    )
+    print('{:>14} {:>14}'.format('lookup', 'finds/s'))
+    for name, lookup in cases:
+        keys = unknown if name == 'unknown' else hot
+        print('{:>14} {:>14.0f}'.format(name, run(lookup, keys, args.seconds)))
+
+
+if __name__ == '__main__':
+    main()
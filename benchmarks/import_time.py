@@ -0,0 +1,93 @@
+'''measure how long each part of sqrl takes to import, against a budget
+
+Each module is imported in a fresh interpreter with -X importtime, and
+its cumulative time is read from the report. pysodium, which everything
+needs, is costed in the same report, so the cost of a module that loads
+it is what it adds on top, with no noise from comparing separate runs.
+The modules are measured in turn, round after round, and the best round
+is kept for each. The script exits with status 1 if any module goes over
+its budget, or loads a module it should not.
+
+    python benchmarks/import_time.py [--repeat 20] [--scale 2]
+'''
+import argparse
+import compileall
+import os
+import subprocess
+import sys
+
+# module: (ms, over pysodium if it uses it; modules it must not load)
+# The budgets are about 1.5 times the best of 20 rounds on the machine they
+# were set on (server 10, s4 10, crypto 8, storage 8, accounts 10, s4dump
+# 15 ms). Fewer rounds are noisier; use --scale on slower machines.
+BUDGETS = {
+    'sqrl.server': (15, ('cryptography', 'sqlite3', 'asyncio')),
+    'sqrl.s4': (15, ('cryptography', 'concurrent.futures')),
+    'sqrl.crypto': (12, ('cryptography',)),
+    'sqrl.storage': (12, ('pysodium', 'cryptography')),
+    'sqrl.accounts': (15, ('pysodium', 'cryptography')),
+    's4dump': (22, ('cryptography', 'click', 'correcthorse')),
+}
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_time(module):
+    '''return (seconds, seconds of it in pysodium, modules loaded)'''
+    out = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c',
+         'import sys, {}; print(" ".join(sys.modules))'.format(module)],
+        cwd=ROOT, capture_output=True, text=True, check=True)
+    # import time: self [us] | cumulative | imported package
+    cumulative = {}
+    for line in out.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            _, us, name = line.split('|')
+            if us.strip().isdigit():
+                cumulative.setdefault(name.strip(), int(us) / 1e6)
+    return (cumulative[module], cumulative.get('pysodium', 0),
+            set(out.stdout.split()))
+
+
+def measure(modules, repeat):
+    '''return {module: (seconds, extra seconds, modules loaded)}
+
+    Every round imports each module once, so drift in the machine's speed
+    hits them all alike; the round with the least extra time is kept.
+    '''
+    results = {}
+    for _ in range(repeat):
+        for module in modules:
+            t, floor, loaded = import_time(module)
+            kept = results.get(module)
+            if kept is None or t - floor < kept[1]:
+                results[module] = (t, t - floor, loaded)
+    return results
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument('--repeat', type=int, default=20)
+    ap.add_argument('--scale', type=float, default=1,
+                    help='multiply the budgets, for slow machines')
+    args = ap.parse_args()
+
+    # time the imports, not compiling them
+    compileall.compile_dir(os.path.join(ROOT, 'sqrl'), quiet=1)
+    compileall.compile_file(os.path.join(ROOT, 's4dump.py'), quiet=1)
+    results = measure(BUDGETS, args.repeat)
+    print('{:<16} {:>9} {:>9} {:>9}'.format('module', 'ms', 'extra', 'budget'))
+    failed = False
+    for module, (budget, banned) in BUDGETS.items():
+        t, extra, loaded = results[module]
+        budget *= args.scale
+        bad = sorted(m for m in banned if m in loaded)
+        over = extra * 1e3 > budget or bad
+        failed = failed or over
+        print('{:<16} {:>9.1f} {:>9.1f} {:>9.0f} {}'.format(
+            module, t * 1e3, extra * 1e3, budget,
+            'loads ' + ', '.join(bad) if bad else 'OVER' if over else ''))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,72 @@
+'''measure nut throughput as the number of worker threads grows
+
+Compares a plain NutCase behind one global lock (what a threaded server had
+to do before) with a shared ThreadedNutCase.
+
+    python benchmarks/nut_threads.py --threads 1,2,4,8 --seconds 2
+'''
+import argparse
+import threading
+import time
+
+from sqrl.server import NutCase, ThreadedNutCase
+
+
+def locked(nc):
+    lock = threading.Lock()
+
+    def issue(ip):
+        with lock:
+            s = nc.seal(nc.new(ip))
+        with lock:
+            return nc.crack(ip, s)
+    return issue
+
+
+def shared(nc):
+    def issue(ip):
+        return nc.crack(ip, nc.seal(nc.new(ip)))
+    return issue
+
+
+def run(issue, threads, seconds):
+    '''run issue from threads workers for seconds, return round trips per second'''
+    counts = [0] * threads
+    stop = threading.Event()
+
+    def worker(n):
+        ip = bytes((10, 0, n >> 8 & 255, n & 255))
+        c = 0
+        while not stop.is_set():
+            for _ in range(100):
+                issue(ip)
+            c += 100
+        counts[n] = c
+
+    workers = [threading.Thread(target=worker, args=(n,))
+               for n in range(threads)]
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    time.sleep(seconds)
+    stop.set()
+    for w in workers:
+        w.join()
+    return sum(counts) / (time.perf_counter() - start)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument('--threads', default='1,2,4,8')
+    ap.add_argument('--seconds', type=float, default=2)
+    args = ap.parse_args()
+
+    print('{:>8} {:>14} {:>14}'.format('threads', 'locked/s', 'threaded/s'))
+    for n in (int(x) for x in args.threads.split(',')):
+        a = run(locked(NutCase()), n, args.seconds)
+        b = run(shared(ThreadedNutCase()), n, args.seconds)
+        print('{:>8} {:>14.0f} {:>14.0f}'.format(n, a, b))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,437 @@
+'''micro-benchmarks for the hot paths of sqrl
+
+    python benchmarks/suite.py run --out new.json [--filter crypto.] [--quick]
+    python benchmarks/suite.py compare base.json new.json [--threshold 0.10]
+
+Each case reports the best time per operation over several repeats. compare
+prints the ratio new/base for every case both runs share, marks cases that
+got slower than the threshold, and exits with status 1 if there are any.
+'''
+import argparse
+import ctypes
+import io
+import json
+import os
+import platform
+import sys
+import time
+
+import pysodium
+
+from sqrl import KEY_BYTES, rng, crypto, s4enc
+from sqrl.s4 import SQRLdata, Block, Access, Rescue, Previous
+from sqrl.s4ext import Secret, KeyCache
+from sqrl.server import NutCase, RateLimiter, Shed, TransactionTable, NONCE_BYTES
+
+CASES = []
+
+
+def bench(name, quick=True):
+    '''register a case
+
+    The decorated function does any setup and returns (fn, ops): fn takes no
+    arguments and performs ops operations. Cases with quick=False are skipped
+    by --quick.
+    '''
+    def register(setup):
+        CASES.append((name, setup, quick))
+        return setup
+    return register
+
+
+def measure(fn, ops, repeat=5, mintime=0.1):
+    '''return the best seconds per operation of repeat timed runs'''
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= mintime:
+            break
+        loops *= 2 if elapsed * 10 > mintime else 10
+    best = elapsed
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        best = min(best, time.perf_counter() - start)
+    return best / (loops * ops)
+
+
+# sqrl.crypto
+
+KEY = bytes(range(KEY_BYTES))
+IV = bytes(12)
+
+
+@bench('crypto.encrypt.64')
+def _():
+    pt, ad = bytes(64), bytes(45)
+    return lambda: crypto.encrypt(KEY, IV, pt, ad), 1
+
+
+@bench('crypto.decrypt.64')
+def _():
+    ad = bytes(45)
+    ct, tag = crypto.encrypt(KEY, IV, bytes(64), ad)
+    return lambda: crypto.decrypt(KEY, IV, ct, ad, tag), 1
+
+
+@bench('crypto.AEAD.encrypt.64')
+def _():
+    pt, ad, box = bytes(64), bytes(45), crypto.AEAD(KEY)
+    return lambda: box.encrypt(IV, pt, ad), 1
+
+
+@bench('crypto.AEAD.encrypt_into.64')
+def _():
+    pt, ad, box = bytes(64), bytes(45), crypto.AEAD(KEY)
+    out = memoryview(bytearray(64 + crypto.TAG_BYTES))
+    return lambda: box.encrypt_into(IV, pt, ad, out), 1
+
+
+@bench('crypto.sha256sum')
+def _():
+    return lambda: crypto.sha256sum(KEY), 1
+
+
+@bench('crypto.enhash')
+def _():
+    return lambda: crypto.enhash(KEY), 1
+
+
+for _logN in (1, 5, 9):
+    @bench('crypto.enscrypt.logN{}'.format(_logN), quick=_logN < 9)
+    def _(logN=_logN):
+        iterations = 64
+        return (lambda: crypto.enscrypt(b'password', KEY[:16], logN,
+                                        iterations), iterations)
+
+
+@bench('crypto.scrypt_raw.logN1')
+def _():
+    # the libsodium calls alone: the floor for crypto.enscrypt.logN1
+    iterations = 64
+    out = ctypes.create_string_buffer(KEY_BYTES)
+    args = (b'password', ctypes.c_size_t(8), out, ctypes.c_size_t(KEY_BYTES),
+            ctypes.c_uint64(2), ctypes.c_uint32(256), ctypes.c_uint32(1),
+            out, ctypes.c_size_t(KEY_BYTES))
+
+    def fn():
+        for _ in range(iterations):
+            crypto._kdf(*args)
+    return fn, iterations
+
+
+def _signed(count):
+    pk, sk = pysodium.crypto_sign_keypair()
+    return [(crypto.sign(m, sk), m, pk) for m in
+            (i.to_bytes(4, 'little') * 64 for i in range(count))]
+
+
+@bench('crypto.verify')
+def _():
+    sig, msg, pk = _signed(1)[0]
+    return lambda: crypto.verify(sig, msg, pk), 1
+
+
+@bench('crypto.verify_many.4096')
+def _():
+    items = _signed(4096)
+    return lambda: crypto.verify_many(items), len(items)
+
+
+@bench('crypto.Nonce.next')
+def _():
+    n = crypto.Nonce()
+    return lambda: next(n), 1
+
+
+# sqrl.s4enc
+
+for _size in (64, 4096, 262144):
+    @bench('s4enc.encode.{}'.format(_size))
+    def _(size=_size):
+        data = rng.randombytes(size)
+        return lambda: s4enc.encode(data), 1
+
+    @bench('s4enc.decode.{}'.format(_size))
+    def _(size=_size):
+        text = s4enc.encode(rng.randombytes(size))
+        return lambda: s4enc.decode(text), 1
+
+    @bench('s4enc.Encoder.{}'.format(_size))
+    def _(size=_size):
+        data = rng.randombytes(size)
+        chunks = [data[i:i + 65536] for i in range(0, size, 65536)]
+
+        def fn():
+            enc = s4enc.Encoder(io.BytesIO())
+            for c in chunks:
+                enc.update(c)
+            enc.finish()
+        return fn, 1
+
+    @bench('s4enc.Decoder.{}'.format(_size))
+    def _(size=_size):
+        text = s4enc.encode(rng.randombytes(size))
+        # wrapped at 76 columns, as a text export would be
+        text = b'\n'.join(text[i:i + 76] for i in range(0, len(text), 76))
+        chunks = [text[i:i + 65536] for i in range(0, len(text), 65536)]
+
+        def fn():
+            dec = s4enc.Decoder(io.BytesIO())
+            for c in chunks:
+                dec.update(c)
+            dec.finish()
+        return fn, 1
+
+
+# sqrl.s4, sqrl.s4ext
+
+TYPEMAP = dict((x.BLOCKTYPE, x)
+               for x in (Block, Access, Rescue, Previous, Secret))
+
+
+def synthetic_vault(secrets):
+    '''build a SQRLdata with cheap KDF parameters and `secrets` Secret blocks'''
+    iuk = rng.randombytes(KEY_BYTES)
+    imk = crypto.enhash(iuk)
+    ab = Access(logN=1, pwverifysecs=0).seal(imk + bytes(KEY_BYTES), b'pw')
+    rb = Rescue.seal(iuk, b'0' * 24, logN=1, miniter=1, mintime=0)
+    pb = Previous.seal(imk, [rng.randombytes(KEY_BYTES)])
+    blocks = [ab, rb, pb]
+    for i in range(secrets):
+        name = str(i).encode('ascii')
+        blocks.append(Secret.make(b'bench', b'site' + name, b'user' + name)
+                      .seal(imk, rng.randombytes(16)))
+    return SQRLdata(blocks), imk
+
+
+for _count in (10, 1000, 100000):
+    @bench('s4.dump.{}'.format(_count), quick=_count < 100000)
+    def _(count=_count):
+        vault = synthetic_vault(count)[0]
+        return lambda: vault.dump(io.BytesIO()), 1
+
+    @bench('s4.ascii.{}'.format(_count), quick=_count < 100000)
+    def _(count=_count):
+        vault = synthetic_vault(count)[0]
+        return vault.ascii, 1
+
+    @bench('s4.load.{}'.format(_count), quick=_count < 100000)
+    def _(count=_count):
+        bio = io.BytesIO()
+        synthetic_vault(count)[0].dump(bio)
+        data = bio.getvalue()
+        return lambda: list(SQRLdata.load(io.BytesIO(data), TYPEMAP)), 1
+
+    @bench('s4.frombuffer.{}'.format(_count), quick=_count < 100000)
+    def _(count=_count):
+        bio = io.BytesIO()
+        synthetic_vault(count)[0].dump(bio)
+        data = bio.getvalue()
+        return lambda: SQRLdata.frombuffer(data, TYPEMAP), 1
+
+    @bench('s4.load_ascii.{}'.format(_count), quick=_count < 100000)
+    def _(count=_count):
+        data = synthetic_vault(count)[0].ascii().encode('ascii')
+        return lambda: list(SQRLdata.load(io.BytesIO(data), TYPEMAP)), 1
+
+
+@bench('s4file.VaultFile.save.10000')
+def _():
+    # change and save one Secret in a 10000 Secret vault
+    import tempfile
+    from sqrl.s4file import VaultFile
+    vault, imk = synthetic_vault(10000)
+    path = os.path.join(tempfile.mkdtemp(), 'vault')
+    vf = VaultFile(path, TYPEMAP, compact_ratio=None)
+    for block in vault:
+        vf.add(block)
+    vf.save()
+    secret = vf.blocks[-1]
+
+    def fn():
+        secret.seal(imk, b'changed')
+        vf.changed(secret)
+        vf.save()
+    return fn, 1
+
+
+@bench('s4.open_secrets.1000')
+def _():
+    vault, imk = synthetic_vault(1000)
+    return lambda: list(vault.open_secrets(imk)), 1000
+
+
+@bench('s4ext.Secret.open')
+def _():
+    vault, imk = synthetic_vault(1)
+    secret = vault[-1]
+    return lambda: secret.open(imk), 1
+
+
+@bench('s4ext.Secret.open.cached')
+def _():
+    vault, imk = synthetic_vault(1)
+    secret, cache = vault[-1], KeyCache()
+    return lambda: secret.open(imk, cache=cache), 1
+
+
+# sqrl.server
+
+IP = bytes((192, 168, 0, 100))
+
+
+@bench('server.NutCase.new')
+def _():
+    nc = NutCase()
+    return lambda: nc.new(IP), 1
+
+
+@bench('server.NutCase.seal')
+def _():
+    nc = NutCase()
+    nut = nc.new(IP)
+    return lambda: nc.seal(nut), 1
+
+
+@bench('server.NutCase.crack')
+def _():
+    nc = NutCase()
+    sealed = nc.seal(nc.new(IP))
+    return lambda: nc.crack(IP, sealed), 1
+
+
+@bench('server.NutCase.seal_many.1000')
+def _():
+    nc = NutCase()
+    ips = [IP] * 1000
+    return lambda: nc.seal_many(ips), 1000
+
+
+@bench('server.NutCase.crack_many.1000')
+def _():
+    nc = NutCase()
+    pairs = [(IP, s) for s in nc.seal_many([IP] * 1000)]
+    return lambda: nc.crack_many(pairs), 1000
+
+
+@bench('server.RateLimiter.allow')
+def _():
+    limiter = RateLimiter(rate=1e9)
+    return lambda: limiter.allow(IP), 1
+
+
+@bench('server.NutCase.crack.shed')
+def _():
+    nc = NutCase(fail_limit=RateLimiter(rate=1e-9, burst=1))
+    bad = nc.seal(nc.new(IP))[:-4] + b'AAAA'
+    try:
+        nc.crack(IP, bad)
+    except ValueError:
+        pass
+
+    def fn():
+        try:
+            nc.crack(IP, bad)
+        except Shed:
+            pass
+    return fn, 1
+
+
+@bench('server.TransactionTable.advance')
+def _():
+    table = TransactionTable(capacity=100000)
+    nonces = [os.urandom(NONCE_BYTES) for _ in range(1001)]
+    for i, nonce in enumerate(nonces[:-1]):
+        table.add(nonce, i, IP)
+
+    def fn():
+        for i in range(1000):
+            table.advance(nonces[i], nonces[i + 1])
+            table.advance(nonces[i + 1], nonces[i])
+    return fn, 2000
+
+
+def run(args):
+    results = {}
+    for name, setup, quick in CASES:
+        if args.filter and args.filter not in name:
+            continue
+        if args.quick and not quick:
+            continue
+        fn, ops = setup()
+        per_op = measure(fn, ops, args.repeat, args.mintime)
+        results[name] = {'per_op': per_op, 'ops_per_sec': 1 / per_op}
+        print('{:<40} {:>14.3f} us/op'.format(name, per_op * 1e6),
+              file=sys.stderr)
+    report = {
+        'meta': {
+            'time': int(time.time()),
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+            'sodium': pysodium.sodium.sodium_version_string().decode('ascii'),
+        },
+        'results': results,
+    }
+    text = json.dumps(report, indent=1, sort_keys=True)
+    if args.out:
+        with open(args.out, 'w') as fo:
+            fo.write(text)
+    else:
+        print(text)
+
+
+def compare(args):
+    with open(args.base) as fi:
+        base = json.load(fi)['results']
+    with open(args.new) as fi:
+        new = json.load(fi)['results']
+    regressions = 0
+    for name in sorted(set(base) & set(new)):
+        ratio = new[name]['per_op'] / base[name]['per_op']
+        mark = ''
+        if ratio > 1 + args.threshold:
+            mark = 'REGRESSION'
+            regressions += 1
+        elif ratio < 1 - args.threshold:
+            mark = 'faster'
+        print('{:<40} {:>8.3f} {}'.format(name, ratio, mark))
+    for name in sorted(set(base) ^ set(new)):
+        print('{:<40} {:>8} only in {}'.format(
+            name, '-', 'base' if name in base else 'new'))
+    return 1 if regressions else 0
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = ap.add_subparsers(dest='command')
+    r = sub.add_parser('run', help='run the benchmarks, write JSON')
+    r.add_argument('--out', help='write results here instead of stdout')
+    r.add_argument('--filter', help='only run cases containing this string')
+    r.add_argument('--quick', action='store_true',
+                   help='skip the slowest cases')
+    r.add_argument('--repeat', type=int, default=5)
+    r.add_argument('--mintime', type=float, default=0.1,
+                   help='minimum seconds per timed repeat')
+    c = sub.add_parser('compare', help='compare two result files')
+    c.add_argument('base')
+    c.add_argument('new')
+    c.add_argument('--threshold', type=float, default=0.10,
+                   help='relative slowdown that counts as a regression')
+    args = ap.parse_args(argv)
+    if args.command == 'run':
+        return run(args)
+    if args.command == 'compare':
+        return compare(args)
+    ap.print_help()
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
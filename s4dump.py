@@ -1,11 +1,15 @@
+'''
+Create a SQRL identity file, or show what is in one.
+
+    python s4dump.py id.sqrl [--open]
+
+click and the diceware word list are only loaded when they are used, so
+the helpers here can be imported cheaply.
+'''
 import os
 from getpass import getpass
 
-import click
-import correcthorse
-from cryptography.exceptions import InvalidTag
-
-from sqrl import KEY_BYTES, rng
+from sqrl import KEY_BYTES, crypto, metrics, rng
 from sqrl.crypto import enhash
 from sqrl.s4 import SQRLdata, Block, Access, Rescue, Previous
 from sqrl.s4ext import Secret
@@ -13,7 +17,7 @@ from pysodium import crypto_sign_seed_keypair, crypto_sign_keypair
 
 tm = dict((x.BLOCKTYPE, x) for x in (Block, Access, Rescue, Previous, Secret))
 
-_wl = correcthorse.getwords(('effs1',))
+_wl = None
 _MRC = 1000000000000000000000000 # 24 zeros. (1e24 is off by 16777216)
 
 
@@ -26,24 +30,33 @@ def rescue_code():
 
 def genpasswd():
     '''generate a 90 bit diceware passphrase'''
+    global _wl
+    import correcthorse
+    if _wl is None:
+        _wl = correcthorse.getwords(('effs1',))
     return correcthorse.random_passphrase(_wl)[0]
 
 
+def echo(message=None):
+    import click
+    click.echo(message)
+
+
 def gen_iuk():
     return crypto_sign_seed_keypair(rng.randombytes(KEY_BYTES))[1][:KEY_BYTES]
 
 
 def getnewpassword(what):
     '''prompt the user for a new password'''
-    click.echo('Here are some randomly selected words that you might use\n'
-               '  (Each line has about 90 bits of entropy.):')
+    echo('Here are some randomly selected words that you might use\n'
+         '  (Each line has about 90 bits of entropy.):')
     for x in range(16):
-        click.echo(genpasswd())
-    click.echo()
+        echo(genpasswd())
+    echo()
     pw = getpass('enter {}:'.format(what))
     pw2 = getpass('reenter {}:'.format(what))
     while pw != pw2:
-        click.echo('Passwords do not match. Please try again.')
+        echo('Passwords do not match. Please try again.')
         pw = getpass('enter {}:'.format(what))
         pw2 = getpass('reenter {}:'.format(what))
 
@@ -57,31 +70,31 @@ def getoldpassword(what):
 
 def createid(fname):
     '''create a new SQRL identity, storing it to `fname`'''
-    click.echo('creating new id in "{}"'.format(fname))
+    echo('creating new id in "{}"'.format(fname))
     pw = getnewpassword('access password')
     print(type(pw), pw)
     rc = rescue_code()
-    click.echo(
+    echo(
         'Here is your emergency rescue code (write it in a secure place or memorize it):')
     urc = rc.decode('ascii')
-    click.echo(' '.join(urc[i:i+4] for i in range(0,len(urc),4)))
+    echo(' '.join(urc[i:i+4] for i in range(0,len(urc),4)))
     ilk, iuk = crypto_sign_seed_keypair(rng.randombytes(KEY_BYTES))
     iuk = iuk[:KEY_BYTES]
     imk = enhash(iuk)
 
-    click.echo(
+    echo(
         'Encrypting your new identity. (This should take about 60 seconds.)')
     ab = Access().seal(imk + ilk, pw)
     rb = Rescue.seal(iuk, rc)
     sd = SQRLdata([ab, rb])
     with open(fname, 'wb') as fo:
         sd.dump(fo)
-    click.echo('Your new identity is now stored in "{}"'.format(
+    echo('Your new identity is now stored in "{}"'.format(
         os.path.abspath(fname)))
 
 
 def dumpid(fname, pw=None, rc=None):
-    click.echo('dump of "{}"'.format(fname))
+    echo('dump of "{}"'.format(fname))
     print(type(pw), pw)
     print(type(rc), rc)
     with open(fname, 'rb') as fo:
@@ -94,38 +107,65 @@ def dumpid(fname, pw=None, rc=None):
             try:
                 imk, ilk = b.open(pw)
                 print('IMK: {}\nILK: {}'.format(imk.hex(), ilk.hex()))
-            except InvalidTag:
+            except crypto.InvalidTag:
                 print('invalid password or data corrupt')
         if isinstance(b, Rescue) and rc:
             try:
                 iuk = b.open(rc)
                 print('IUK: {}'.format(iuk.hex()))
-            except InvalidTag:
+            except crypto.InvalidTag:
                 print('invalid password or data corrupt')
         if isinstance(b, Previous) and imk:
             try:
                 puks = b.open(imk)
                 for k in puks:
                     print('PIUK: {}'.format(k.hex()))
-            except InvalidTag:
+            except crypto.InvalidTag:
                 print('invalid IMK or data corrupt')
 
 
-@click.command()
-@click.argument('sqrldata')
-@click.option('--open', '-o', is_flag=True, help='prompt for passwords to decrypt blocks')
-@click.option('--verbose', '-v', is_flag=True, help='display extra stuff')
-@click.option('--config', '-c', help='read settings from CONFIG')
-def main(sqrldata, open, verbose, config):
-    click.echo('hello')
+def command():
+    '''build the click command'''
+    import click
+
+    @click.command()
+    @click.argument('sqrldata')
+    @click.option('--open', '-o', is_flag=True, help='prompt for passwords to decrypt blocks')
+    @click.option('--verbose', '-v', is_flag=True, help='display extra stuff')
+    @click.option('--config', '-c', help='read settings from CONFIG')
+    @click.option('--profile', metavar='FILE',
+                  help='sample the stack while running, write it to FILE')
+    @click.option('--metrics', 'metrics_file', metavar='FILE',
+                  help='write timings in Prometheus text format to FILE')
+    def s4dump(sqrldata, open, verbose, config, profile, metrics_file):
+        if metrics_file:
+            metrics.enable()
+        try:
+            if profile:
+                with metrics.Sampler(profile):
+                    run(sqrldata, open, verbose)
+            else:
+                run(sqrldata, open, verbose)
+        finally:
+            if metrics_file:
+                metrics.PrometheusFile(metrics_file)(metrics.REGISTRY)
+    return s4dump
+
+
+def main(args=None):
+    command()(args)
+
+
+def run(sqrldata, open, verbose):
+    echo('hello')
     if os.path.exists(sqrldata):
         if open:
             pw = getoldpassword('access key')
             if verbose and pw:
-                click.echo(pw)
+                echo(pw)
             rc = getoldpassword('rescue code')
             if verbose and rc:
-                click.echo(rc)
+                echo(rc)
         else:
             rc = pw = None
 
@@ -0,0 +1,218 @@
+'''
+Per-identity records for a SQRL site.
+
+For each identity a site keeps the IDK it logs in with, the SUK and VUK it
+hands back for identity unlock, and after a rekey the previous IDK
+(pidk). A login needs one lookup:
+
+    account, previous = store.find(idk, pidk)
+
+finds the account under the client's current IDK or, if the client has
+rekeyed, under the previous IDK it also sent. Both are IDKs of existing
+rows, so this is one query on the primary key.
+
+SQLiteAccountStore keeps one connection per thread, reuses the prepared
+statements sqlite3 caches per connection, and answers repeated lookups
+from a bounded LRU cache. The cache only sees writes made through this
+store: give other writers their own store with cache_size=0, or call
+clear_cache. A lookup that races a write through this store does not
+cache what it read.
+'''
+import abc
+import sqlite3
+import threading
+from collections import OrderedDict, namedtuple
+
+Account = namedtuple('Account', 'idk,suk,vuk,pidk,user,disabled')
+
+
+class AccountStore(abc.ABC):
+    '''the interface; keys are bytes'''
+
+    @abc.abstractmethod
+    def get(self, idk):
+        '''return the Account for idk, or None'''
+
+    def find(self, idk, pidk=None):
+        '''return (account, previous) for a login
+
+        account is found under idk, or else under pidk (the client's
+        previous identity), in which case previous is True. account is None
+        if neither is known.
+        '''
+        for key, previous in (idk, False), (pidk, True):
+            if key is not None:
+                account = self.get(key)
+                if account is not None:
+                    return account, previous
+        return None, False
+
+    @abc.abstractmethod
+    def create(self, account):
+        '''add a new Account'''
+
+    @abc.abstractmethod
+    def rekey(self, pidk, idk, suk, vuk):
+        '''move the account of identity pidk to the new identity idk'''
+
+    @abc.abstractmethod
+    def set_disabled(self, idk, disabled):
+        '''turn SQRL logins for the account of idk off (or back on)'''
+
+    @abc.abstractmethod
+    def remove(self, idk):
+        '''delete the account of idk'''
+
+
+class SQLiteAccountStore(AccountStore):
+    '''an AccountStore in a SQLite database
+
+    path: the database file, or a 'file:' URI
+    cache_size: the most accounts (and misses) to keep in memory
+    '''
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS accounts ('
+        ' idk BLOB PRIMARY KEY, suk BLOB NOT NULL, vuk BLOB NOT NULL,'
+        ' pidk BLOB, user TEXT, disabled INTEGER NOT NULL DEFAULT 0'
+        ') WITHOUT ROWID',
+        'CREATE INDEX IF NOT EXISTS accounts_pidk ON accounts (pidk)',
+    )
+    _COLUMNS = 'idk, suk, vuk, pidk, user, disabled'
+    _GET = 'SELECT {} FROM accounts WHERE idk = ?'.format(_COLUMNS)
+    _FIND = 'SELECT {} FROM accounts WHERE idk IN (?, ?)'.format(_COLUMNS)
+    _INSERT = 'INSERT INTO accounts ({}) VALUES (?, ?, ?, ?, ?, ?)'.format(
+        _COLUMNS)
+    _REKEY = 'UPDATE accounts SET idk = ?, suk = ?, vuk = ?, pidk = ? WHERE idk = ?'
+    _DISABLE = 'UPDATE accounts SET disabled = ? WHERE idk = ?'
+    _DELETE = 'DELETE FROM accounts WHERE idk = ?'
+
+    def __init__(self, path, cache_size=100000):
+        self.path = path
+        self.cache_size = cache_size
+        self._local = threading.local()
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+        # bumped by every write; a read only caches if it did not change
+        self._writes = 0
+        db = self._db()
+        with db:
+            for sql in self.SCHEMA:
+                db.execute(sql)
+
+    def _db(self):
+        '''return this thread's connection'''
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, uri=self.path.startswith('file:'),
+                                 cached_statements=32)
+            db.execute('PRAGMA journal_mode = WAL')
+            db.execute('PRAGMA synchronous = NORMAL')
+            self._local.db = db
+        return db
+
+    def _cached(self, key):
+        # returns (found, account)
+        with self._lock:
+            try:
+                account = self._cache[key]
+            except KeyError:
+                return False, None
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return True, account
+
+    def _miss(self):
+        # count a miss, and return the write count to pass to _remember
+        with self._lock:
+            self.misses += 1
+            return self._writes
+
+    def _remember(self, key, account, writes):
+        if not self.cache_size:
+            return
+        with self._lock:
+            if writes != self._writes:
+                return      # what was read may already be stale
+            self._cache[key] = account
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _forget(self, *keys):
+        with self._lock:
+            self._writes += 1
+            for key in keys:
+                self._cache.pop(key, None)
+
+    def clear_cache(self):
+        with self._lock:
+            self._writes += 1
+            self._cache.clear()
+
+    def get(self, idk):
+        found, account = self._cached(idk)
+        if found:
+            return account
+        writes = self._miss()
+        row = self._db().execute(self._GET, (idk,)).fetchone()
+        account = None if row is None else Account._make(row)
+        self._remember(idk, account, writes)
+        return account
+
+    def find(self, idk, pidk=None):
+        found, account = self._cached(idk)
+        if account is not None:
+            return account, False
+        if pidk is None:
+            if found:
+                return None, False
+        else:
+            pfound, paccount = self._cached(pidk)
+            if found and pfound:
+                return paccount, paccount is not None
+        # one query for both keys
+        writes = self._miss()
+        rows = self._db().execute(self._FIND, (idk, pidk)).fetchall()
+        byidk = dict((row[0], Account._make(row)) for row in rows)
+        account = byidk.get(idk)
+        self._remember(idk, account, writes)
+        if pidk is not None:
+            self._remember(pidk, byidk.get(pidk), writes)
+        if account is not None:
+            return account, False
+        account = byidk.get(pidk)
+        return account, account is not None
+
+    def create(self, account):
+        with self._db() as db:
+            db.execute(self._INSERT, account)
+        self._forget(account.idk)
+
+    def create_many(self, accounts):
+        '''insert many accounts in one transaction'''
+        with self._db() as db:
+            db.executemany(self._INSERT, accounts)
+        self.clear_cache()
+
+    def rekey(self, pidk, idk, suk, vuk):
+        with self._db() as db:
+            db.execute(self._REKEY, (idk, suk, vuk, pidk, pidk))
+        self._forget(pidk, idk)
+
+    def set_disabled(self, idk, disabled):
+        with self._db() as db:
+            db.execute(self._DISABLE, (int(bool(disabled)), idk))
+        self._forget(idk)
+
+    def remove(self, idk):
+        with self._db() as db:
+            db.execute(self._DELETE, (idk,))
+        self._forget(idk)
+
+    def by_previous(self, pidk):
+        '''return the account that replaced identity pidk, or None'''
+        row = self._db().execute(
+            'SELECT {} FROM accounts WHERE pidk = ?'.format(self._COLUMNS),
+            (pidk,)).fetchone()
+        return None if row is None else Account._make(row)
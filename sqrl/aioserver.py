@@ -0,0 +1,287 @@
+'''
+A small asyncio HTTP front end for the SQRL client protocol.
+
+    GET  /nut               issue a nut for a login page (returns a sqrl:// URL)
+    POST /sqrl?nut=...      a client query/ident/... command
+
+Nut handling is done on the event loop by a NutCase; it is cheap, and a
+task rotates its keys on a fixed schedule. Anything
+that may block (signature checks, the site's account lookups) is handed to
+an Offload, a thread pool with a bounded backlog. When the backlog is full,
+the client is told to retry (TIF_TRANSIENT) instead of queueing more work,
+so the event loop keeps answering under load.
+
+Malformed HTTP gets a 400 and the connection is closed; so is a
+connection that sends nothing for `timeout` seconds. A handler that
+raises fails the command (TIF_COMMAND_FAILED) and is counted in the
+sqrl_handler_errors metric.
+'''
+import asyncio
+import ipaddress
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+from sqrl import metrics
+from sqrl.crypto import verify, verify_many
+from sqrl.s4enc import decode, encode
+from sqrl.server import NutCase, Shed
+
+
+TIF_ID_MATCH = 0x01
+TIF_PREVIOUS_ID_MATCH = 0x02
+TIF_IP_MATCH = 0x04
+TIF_SQRL_DISABLED = 0x08
+TIF_NOT_SUPPORTED = 0x10
+TIF_TRANSIENT = 0x20
+TIF_COMMAND_FAILED = 0x40
+TIF_CLIENT_FAILURE = 0x80
+TIF_BAD_ID = 0x100
+
+MAX_BODY = 8192
+MAX_HEADERS = 64
+
+_handler_errors = metrics.counter(
+    'sqrl_handler_errors', 'commands failed by an exception in the handler')
+
+SQRLRequest = namedtuple('SQRLRequest', 'ip,cracked,client,server,ids,pids,urs')
+
+
+class Busy(Exception):
+    '''raised by Offload when its backlog is full'''
+
+
+class BadRequest(ValueError):
+    '''raised for HTTP the server does not understand'''
+
+
+class Offload:
+    '''run blocking calls on a thread pool with bounded concurrency
+
+    At most `workers` calls run at once, and at most `backlog` more wait for
+    a worker. Calls beyond that raise Busy immediately.
+    '''
+
+    def __init__(self, workers=4, backlog=64):
+        self._pool = ThreadPoolExecutor(workers)
+        self._slots = asyncio.Semaphore(workers + backlog)
+
+    async def __call__(self, fn, *args):
+        if self._slots.locked():
+            raise Busy()
+        async with self._slots:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._pool, fn, *args)
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False)
+
+
+def parse_client(data):
+    '''decode the client parameter into a dict of str'''
+    params = {}
+    for line in decode(data.encode('ascii')).decode('utf-8').split('\r\n'):
+        k, eq, v = line.partition('=')
+        if eq:
+            params[k] = v
+    return params
+
+
+def verify_signatures(req, message):
+    '''check the signatures sent with a request
+
+    returns True if ids (and pids, when present) are good signatures of
+    message. The urs signature needs the stored VUK, so it is left to the
+    site's handler.
+    '''
+    try:
+        idk = decode(req.client['idk'].encode('ascii'))
+        pidk = req.client.get('pidk')
+        if pidk is None:
+            return verify(req.ids, message, idk)
+        pidk = decode(pidk.encode('ascii'))
+    except (KeyError, ValueError):
+        return False
+    return all(verify_many([(req.ids, message, idk),
+                            (req.pids, message, pidk)]))
+
+
+class SQRLServer:
+    '''serve SQRL client requests over HTTP
+
+    nutcase: the NutCase that issues and cracks nuts
+    handler: handler(SQRLRequest) -> (tif, fields), called in a worker
+        thread after the signatures have been checked. tif holds the bits to
+        add to the reply; fields is a dict of extra reply parameters.
+    hostname: used to build the sqrl:// URLs handed to login pages
+    timeout: seconds to wait for each line or body of a request
+    '''
+
+    def __init__(self, nutcase=None, handler=None, hostname='localhost',
+                 path='/sqrl', workers=4, backlog=64, timeout=30):
+        self.nutcase = NutCase() if nutcase is None else nutcase
+        self.handler = handler
+        self.hostname = hostname
+        self.path = path
+        self.timeout = timeout
+        self.offload = Offload(workers, backlog)
+        self._rotation = None
+
+    async def start(self, host='127.0.0.1', port=0, rotate_interval=60):
+        '''listen on host:port, return the asyncio.Server'''
+        self._rotation = asyncio.ensure_future(
+            self.rotate_keys(rotate_interval))
+        return await asyncio.start_server(self.handle_connection, host, port)
+
+    def close(self):
+        if self._rotation is not None:
+            self._rotation.cancel()
+        self.offload.shutdown()
+
+    async def rotate_keys(self, interval):
+        '''rotate the nut keys every interval seconds, until cancelled'''
+        while True:
+            self.nutcase.rotate()
+            await asyncio.sleep(interval)
+
+    async def handle_connection(self, reader, writer):
+        ip = ipaddress.ip_address(writer.get_extra_info('peername')[0]).packed
+        try:
+            while True:
+                try:
+                    request = await self._read_request(reader)
+                except BadRequest:
+                    self._respond(writer, '400 Bad Request', 'text/plain',
+                                  b'bad request', False)
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+                method, target, headers, body = request
+                status, ctype, payload = await self.dispatch(
+                    ip, method, target, body)
+                keep = headers.get('connection', '').lower() != 'close'
+                self._respond(writer, status, ctype, payload, keep)
+                await writer.drain()
+                if not keep:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError,
+                asyncio.TimeoutError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _respond(writer, status, ctype, payload, keep):
+        writer.write(b''.join((
+            'HTTP/1.1 {}\r\nContent-Type: {}\r\nContent-Length: {}\r\n'
+            'Connection: {}\r\n\r\n'.format(
+                status, ctype, len(payload),
+                'keep-alive' if keep else 'close').encode('latin-1'),
+            payload)))
+
+    async def _read(self, read, *args):
+        return await asyncio.wait_for(read(*args), self.timeout)
+
+    async def _read_request(self, reader):
+        try:
+            line = await self._read(reader.readline)
+        except ValueError:      # no newline within the stream's limit
+            raise BadRequest('request line too long')
+        if not line:
+            return None
+        try:
+            method, target, version = line.decode('latin-1').split()
+        except ValueError:
+            raise BadRequest('malformed request line')
+        headers = {}
+        for count in range(MAX_HEADERS + 1):
+            try:
+                h = await self._read(reader.readline)
+            except ValueError:
+                raise BadRequest('header too long')
+            if h in (b'\r\n', b'\n', b''):
+                break
+            if count == MAX_HEADERS:
+                raise BadRequest('too many headers')
+            k, _, v = h.decode('latin-1').partition(':')
+            headers[k.strip().lower()] = v.strip()
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            raise BadRequest('malformed content-length')
+        if not 0 <= length <= MAX_BODY:
+            raise BadRequest('request body too large')
+        body = await self._read(reader.readexactly, length) if length else b''
+        return method, target, headers, body
+
+    async def dispatch(self, ip, method, target, body):
+        '''return (status, content_type, payload) for one HTTP request'''
+        try:
+            return await self._dispatch(ip, method, target, body)
+        except Shed:
+            # the client is over a NutCase rate limit
+            return '429 Too Many Requests', 'text/plain', b'slow down'
+        except UnicodeError:
+            # a nut or form that is not ASCII
+            return '400 Bad Request', 'text/plain', b'bad request'
+
+    async def _dispatch(self, ip, method, target, body):
+        url = urlsplit(target)
+        if method == 'GET' and url.path == '/nut':
+            return '200 OK', 'text/plain', self.login_url(ip).encode('ascii')
+        if method == 'POST' and url.path == self.path:
+            nut = parse_qs(url.query).get('nut', [''])[0].encode('ascii')
+            reply = await self.command(ip, nut, parse_qs(body.decode('ascii')))
+            return '200 OK', 'application/x-www-form-urlencoded', reply
+        return '404 Not Found', 'text/plain', b'not found'
+
+    def login_url(self, ip):
+        nut = self.nutcase.seal(self.nutcase.new(ip)).decode('ascii')
+        return 'sqrl://{}{}?nut={}'.format(self.hostname, self.path, nut)
+
+    async def command(self, ip, nut, form):
+        '''process one client command, return the encoded server reply'''
+        tif, fields = 0, {}
+        try:
+            client = form['client'][0]
+            server = form['server'][0]
+            req = SQRLRequest(
+                ip, self.nutcase.crack(ip, nut), parse_client(client), server,
+                decode(form['ids'][0].encode('ascii')),
+                decode(form.get('pids', [''])[0].encode('ascii')),
+                decode(form.get('urs', [''])[0].encode('ascii')))
+        except (KeyError, ValueError, UnicodeError):
+            return self.reply(ip, TIF_COMMAND_FAILED | TIF_CLIENT_FAILURE)
+
+        nn, ipmatch, goodtime, replayed = req.cracked
+        if ipmatch:
+            tif |= TIF_IP_MATCH
+        if not goodtime:
+            return self.reply(ip, tif | TIF_TRANSIENT | TIF_COMMAND_FAILED)
+        if replayed:
+            return self.reply(ip, tif | TIF_COMMAND_FAILED)
+
+        message = (client + server).encode('ascii')
+        try:
+            if not await self.offload(verify_signatures, req, message):
+                return self.reply(
+                    ip, tif | TIF_COMMAND_FAILED | TIF_CLIENT_FAILURE)
+            if self.handler is not None:
+                more, fields = await self.offload(self.handler, req)
+                tif |= more
+        except Busy:
+            return self.reply(ip, tif | TIF_TRANSIENT | TIF_COMMAND_FAILED)
+        except Exception:
+            if metrics.enabled:
+                _handler_errors.inc()
+            return self.reply(ip, tif | TIF_COMMAND_FAILED)
+        return self.reply(ip, tif, fields)
+
+    def reply(self, ip, tif, fields=None):
+        nut = self.nutcase.seal(self.nutcase.new(ip)).decode('ascii')
+        lines = ['ver=1', 'nut=' + nut, 'tif={:X}'.format(tif),
+                 'qry={}?nut={}'.format(self.path, nut)]
+        if fields:
+            lines.extend('{}={}'.format(k, v) for k, v in fields.items())
+        return encode(''.join(x + '\r\n' for x in lines).encode('utf-8'))
@@ -0,0 +1,104 @@
+'''
+Per-host EnScrypt calibration.
+
+Searching for an iteration count (run until mintime has passed) burns the
+whole time budget and gives a different count every run. A Calibration
+measures once how many iterations per second this host gets for each logN,
+keeps the figures in a small JSON file, and plans iteration counts from them.
+
+The file is ignored when the CPU, libsodium or Python implementation changes.
+
+    cal = Calibration()
+    cal.iterations(9, 2)         # iterations for about 2 CPU seconds at logN 9
+    Access().seal(keys, pw, plan=cal)
+'''
+import hashlib
+import json
+import math
+import os
+import platform
+
+from pysodium import sodium
+
+from sqrl.crypto import enscrypt
+
+CACHE_PATH = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+    'sqrl', 'enscrypt-calibration.json')
+
+
+def _cpu_model():
+    try:
+        with open('/proc/cpuinfo') as fi:
+            for line in fi:
+                if line.startswith('model name'):
+                    return line.partition(':')[2].strip()
+    except OSError:
+        pass
+    return platform.processor()
+
+
+def fingerprint():
+    '''identify the things that change EnScrypt speed on this host'''
+    parts = (_cpu_model(), platform.machine(), str(os.cpu_count()),
+             sodium.sodium_version_string().decode('ascii'),
+             platform.python_implementation())
+    return hashlib.sha256('\0'.join(parts).encode('utf-8')).hexdigest()
+
+
+class Calibration:
+    '''EnScrypt iterations per CPU second, for each logN
+
+    path: where to keep the measurements (None to keep them in memory only)
+    sample: seconds of CPU to spend measuring each logN
+    '''
+
+    def __init__(self, path=CACHE_PATH, sample=0.5):
+        self.path = path
+        self.sample = sample
+        self.fingerprint = fingerprint()
+        self.rates = {}
+        self._load()
+
+    def _load(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path) as fi:
+                data = json.load(fi)
+        except (OSError, ValueError):
+            return
+        if data.get('fingerprint') == self.fingerprint:
+            self.rates = dict((int(k), v) for k, v in data['rates'].items())
+
+    def save(self):
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as fo:
+            json.dump({'fingerprint': self.fingerprint,
+                       'rates': self.rates}, fo)
+        os.replace(tmp, self.path)
+
+    def measure(self, logN):
+        '''time EnScrypt at logN, store and return iterations per second'''
+        i, t, _ = enscrypt(b'calibration', bytes(16), logN, 2, self.sample)
+        rate = self.rates[logN] = i / t
+        self.save()
+        return rate
+
+    def rate(self, logN):
+        '''return iterations per second at logN, measuring it if needed'''
+        rate = self.rates.get(logN)
+        if rate is None:
+            rate = self.measure(logN)
+        return rate
+
+    def iterations(self, logN, seconds, miniter=1):
+        '''return the iteration count that takes about seconds at logN'''
+        return max(miniter, math.ceil(self.rate(logN) * seconds))
+
+    def estimate(self, logN, iterations):
+        '''return the expected seconds for iterations at logN'''
+        return iterations / self.rate(logN)
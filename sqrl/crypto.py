@@ -1,15 +1,12 @@
 
-from sqrl import rng
+from sqrl import metrics, rng
 import pysodium as na
 from pysodium import sodium
 import ctypes
-from time import process_time
-
-from cryptography.hazmat.primitives.ciphers import (
-    Cipher, algorithms, modes
-)
-
-from cryptography.hazmat.backends import default_backend
+import os
+import struct
+import threading
+from time import thread_time
 
 
 from sqrl import (
@@ -20,51 +17,105 @@ from sqrl import (
     NULLIV
 )
 
+_encrypt_seconds = metrics.histogram(
+    'sqrl_encrypt_seconds', 'AES-GCM encryption by sqrl.crypto.encrypt')
+_decrypt_seconds = metrics.histogram(
+    'sqrl_decrypt_seconds', 'AES-GCM decryption by sqrl.crypto.decrypt')
+_decrypt_failures = metrics.counter(
+    'sqrl_decrypt_failures', 'decryptions that failed to authenticate')
+_enscrypt_seconds = metrics.histogram(
+    'sqrl_enscrypt_seconds', 'EnScrypt derivations, wall time', ('logN',))
+_enscrypt_rate = metrics.gauge(
+    'sqrl_enscrypt_iterations_per_second',
+    'EnScrypt speed in the latest derivation, by its own clock', ('logN',))
 
-def encrypt(key, iv, plaintext, associated_data):
-    '''encrypt plaintext and mac with associated_data under key and iv
 
-    uses AES-256-GCM
+class AEAD:
+    '''AES-256-GCM under one key
+
+    The key schedule is set up once, so a handle can be reused for any
+    number of messages under the same key.
     '''
-    # Construct an AES-GCM Cipher object with the given key and a
-    # randomly generated parse_rescue_block.
-    encryptor = Cipher(
-        algorithms.AES(key),
-        modes.GCM(iv),
-        backend=default_backend()
-    ).encryptor()
+    __slots__ = ('_gcm',)
+
+    def __init__(self, key):
+        self._gcm = (_aesgcm or _load_aes())(bytes(key))
+
+    def encrypt(self, iv, plaintext, associated_data):
+        '''return (ciphertext, tag)'''
+        out = self._gcm.encrypt(iv, plaintext, associated_data)
+        return out[:-TAG_BYTES], out[-TAG_BYTES:]
+
+    def encrypt_into(self, iv, plaintext, associated_data, out):
+        '''write the ciphertext followed by the tag into out
+
+        out must be a writable buffer of exactly len(plaintext) + TAG_BYTES
+        bytes. It may be a memoryview into a larger buffer.
+        '''
+        if _encrypt_into:
+            return self._gcm.encrypt_into(iv, plaintext, associated_data, out)
+        out[:] = self._gcm.encrypt(iv, plaintext, associated_data)
+        return len(out)
+
+    def decrypt(self, iv, ciphertext, associated_data, tag):
+        '''return the plaintext, or raise InvalidTag'''
+        return self._gcm.decrypt(
+            iv, b''.join((ciphertext, tag)), associated_data)
+
+
+_aesgcm = None
+_encrypt_into = False
 
-    # associated_data will be authenticated but not encrypted,
-    # it must also be passed in on decryption.
-    encryptor.authenticate_additional_data(associated_data)
 
-    # Encrypt the plaintext and get the associated ciphertext.
-    # GCM does not require padding.
-    ciphertext = encryptor.update(plaintext) + encryptor.finalize()
+def _load_aes():
+    '''import cryptography, which only the AES-GCM users need'''
+    global _aesgcm, _encrypt_into
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    # AESGCM.encrypt_into is only in newer releases of cryptography
+    _encrypt_into = hasattr(AESGCM, 'encrypt_into')
+    _aesgcm = AESGCM
+    return AESGCM
 
-    return (ciphertext, encryptor.tag)
+
+def __getattr__(name):
+    # crypto.InvalidTag, without importing cryptography up front
+    if name == 'InvalidTag':
+        from cryptography.exceptions import InvalidTag
+        return InvalidTag
+    raise AttributeError('module {!r} has no attribute {!r}'.format(
+        __name__, name))
+
+
+def keyed(key):
+    '''return key as an AEAD handle'''
+    return key if isinstance(key, AEAD) else AEAD(key)
+
+
+def encrypt(key, iv, plaintext, associated_data):
+    '''encrypt plaintext and mac with associated_data under key and iv
+
+    uses AES-256-GCM. key may be an AEAD handle.
+    '''
+    if metrics.enabled:
+        with _encrypt_seconds.time():
+            return keyed(key).encrypt(iv, plaintext, associated_data)
+    return keyed(key).encrypt(iv, plaintext, associated_data)
 
 
 def decrypt(key, iv, ciphertext, associated_data, tag):
     '''decrypt ciphertext and mac with associated_data under key and iv, compare mac with tag
 
-    uses AES-256-GCM
+    uses AES-256-GCM. key may be an AEAD handle.
+    If the tag does not match an InvalidTag exception will be raised.
     '''
-    # Construct a Cipher object, with the key, iv, and additionally the
-    # GCM tag used for authenticating the message.
-    decryptor = Cipher(
-        algorithms.AES(key),
-        modes.GCM(iv, tag),
-        backend=default_backend()
-    ).decryptor()
-
-    # We put associated_data back in or the tag will fail to verify
-    # when we finalize the decryptor.
-    decryptor.authenticate_additional_data(associated_data)
-
-    # Decryption gs us the authenticated plaintext.
-    # If the tag does not match an InvalidTag exception will be raised.
-    return decryptor.update(ciphertext) + decryptor.finalize()
+    if metrics.enabled:
+        with _decrypt_seconds.time():
+            try:
+                return keyed(key).decrypt(iv, ciphertext, associated_data, tag)
+            except Exception:
+                _decrypt_failures.inc()
+                raise
+    return keyed(key).decrypt(iv, ciphertext, associated_data, tag)
 
 def sha256sum(b, bytes=32):
     out = ctypes.create_string_buffer(32)
@@ -94,6 +145,14 @@ class Nonce:
             self._prefix + c.to_bytes(self._bytes, 'little'), self._bytes)
         return res
 
+    def take(self, count):
+        '''reserve the next count nonces and return them as a list'''
+        c = self._count
+        self._count = c + count
+        prefix, nb = self._prefix, self._bytes
+        return [sha256sum(prefix + i.to_bytes(nb, 'little'), nb)
+                for i in range(c, c + count)]
+
     def __getstate__(self):
         return self._bytes, self._count, self._prefix
 
@@ -101,25 +160,62 @@ class Nonce:
         self.__init__(*s)
 
 
+def _fold(wide, words):
+    '''XOR together the KEY_BYTES words of a little-endian int'''
+    while words > 1:
+        half = (words + 1) // 2
+        shift = half * KEY_BYTES * 8
+        wide = (wide >> shift) ^ (wide & ((1 << shift) - 1))
+        words = half
+    return wide
+
+
+def _slots(count):
+    '''return a buffer of count KEY_BYTES slots and a pointer to each'''
+    buf = ctypes.create_string_buffer(count * KEY_BYTES)
+    base = ctypes.addressof(buf)
+    return buf, [ctypes.c_void_p(base + k * KEY_BYTES) for k in range(count)]
+
+
+_local = threading.local()
+
+
+def _enhash_rounds(iterations):
+    # each thread builds its buffer and argument tuples once
+    cache = getattr(_local, 'enhash', None)
+    if cache is None:
+        cache = _local.enhash = {}
+    rounds = cache.get(iterations)
+    if rounds is None:
+        buf, slots = _slots(iterations)
+        ld = ctypes.c_ulonglong(KEY_BYTES)
+        rounds = cache[iterations] = (
+            buf, slots[0], ld,
+            [(slots[k], slots[k - 1], ld) for k in range(1, iterations)])
+    return rounds
+
+
 def enhash(data, iterations=16):
     '''process the data through 16 rounds of pbkdf2_sha256
 
     This is intended for deriving secondary keys from a high-entropy master key.
     '''
     assert len(data) == KEY_BYTES
-    ld = ctypes.c_ulonglong(KEY_BYTES)
-    u = ctypes.create_string_buffer(KEY_BYTES).raw
-    sodium.crypto_hash_sha256(u, data, ld)
-    acc = int.from_bytes(u, 'little')
-    for i in range(1, iterations):
-        sodium.crypto_hash_sha256(u, u, ld)
-        acc ^= int.from_bytes(u, 'little')
-    return acc.to_bytes(32, 'little')
+    buf, first, ld, rounds = _enhash_rounds(iterations)
+    sha256 = sodium.crypto_hash_sha256
+    # round k hashes the output of round k - 1 into its own slot; all the
+    # outputs are XORed together at the end
+    sha256(first, bytes(data), ld)
+    for args in rounds:
+        sha256(*args)
+    acc = _fold(int.from_bytes(buf, 'little'), iterations)
+    return acc.to_bytes(KEY_BYTES, 'little')
 
 _kdf = sodium.crypto_pwhash_scryptsalsa208sha256_ll
 
 
-def enscrypt(passwd, salt, logN, iterations, seconds=0):
+def enscrypt(passwd, salt, logN, iterations, seconds=0, clock=thread_time,
+             maxtime=None):
     '''stretch the password into a high-entropy key
 
     This is a memory-hard and time-consuming KDF.
@@ -127,36 +223,211 @@ def enscrypt(passwd, salt, logN, iterations, seconds=0):
     If you are trying to match an exisiting key, leave seconds at 0.
     If you want the derivation to consume a certain amount of time, set seconds to that value.
     The function will terminate when both the minimum iterations and minimum time have been satisfied.
+    If maxtime is set, it also stops once that much time has passed, even
+    short of the minimum iterations; check the returned count.
+
+    Time is measured with clock, by default the CPU time of the calling
+    thread, so derivations running in parallel each get their full budget.
 
     returns a tuple: (iterations, time_consumed, derived_key)
     '''
-    pwlen = ctypes.c_size_t(len(passwd))
-    saltlen = ctypes.c_size_t(len(salt))
-    N = ctypes.c_uint64(1 << logN)
-    r = ctypes.c_uint32(256)
-    p = ctypes.c_uint32(1)
-    outlen = ctypes.c_size_t(KEY_BYTES)
-    out = ctypes.create_string_buffer(KEY_BYTES).raw
-    _kdf(
-        passwd, pwlen,
-        salt, saltlen,
-        N, r, p,
-        out, outlen,
-    )
-    acc = int.from_bytes(out, 'little')
-    i = 1
-    start = process_time()
-    end = start + seconds
-    while i < iterations or process_time() < end:
-        _kdf(
-            passwd, pwlen,
-            out, outlen,
-            N, r, p,
-            out, outlen,
-        )
-        acc ^= int.from_bytes(out, 'little')
-        i += 1
-    return i, process_time() - start, acc.to_bytes(KEY_BYTES, 'little')
+    if metrics.enabled:
+        with _enscrypt_seconds.labels(logN).time():
+            return EnScryptJob(passwd, salt, logN).run(
+                iterations, seconds, maxtime, clock=clock)
+    return EnScryptJob(passwd, salt, logN).run(
+        iterations, seconds, maxtime, clock=clock)
+
+
+class Cancelled(Exception):
+    '''raised by EnScryptJob.run when its cancel event is set'''
+
+
+# EnScryptJob checks the clock, progress and cancellation once per batch:
+# at most ENSCRYPT_BATCH iterations, and fewer when they take longer than
+# about ENSCRYPT_BATCH_SECONDS together
+ENSCRYPT_BATCH = 16
+ENSCRYPT_BATCH_SECONDS = 0.001
+
+
+class EnScryptJob:
+    '''an EnScrypt derivation that can be stopped, saved and resumed
+
+    The whole state of the loop is the iteration count, the last scrypt
+    output and the XOR accumulator (plus the time spent so far).
+    checkpoint() encrypts that state under a key of your choosing; resume()
+    picks it up again, possibly in another process. The password is not
+    saved: supply the same one when resuming.
+
+        job = EnScryptJob(rescue_code, salt, logN)
+        try:
+            i, t, key = job.run(miniter, mintime, cancel=stop_event)
+        except Cancelled:
+            save(job.checkpoint(ckey))
+        ...
+        job = EnScryptJob.resume(load(), ckey, rescue_code)
+        i, t, key = job.run(miniter, mintime)
+    '''
+    _struct = struct.Struct('<BQd{0}s{0}s'.format(KEY_BYTES))
+
+    def __init__(self, passwd, salt, logN):
+        self.passwd = passwd
+        self.salt = salt
+        self.logN = logN
+        self.iterations = 0
+        self.elapsed = 0.0
+        self.out = ctypes.create_string_buffer(KEY_BYTES).raw
+        self.acc = 0
+
+    def run(self, iterations, seconds=0, maxtime=None,
+            progress=None, interval=1.0, cancel=None, clock=thread_time):
+        '''continue the derivation until it is done
+
+        iterations, seconds and maxtime are totals for the whole derivation,
+        as for enscrypt, counting work done before a checkpoint.
+        progress(iterations, elapsed) is called about every interval seconds.
+        If cancel (a threading.Event) is set, the job stops and raises
+        Cancelled; it can then be checkpointed.
+
+        Time limits, progress and cancel are checked after batches of at
+        most ENSCRYPT_BATCH iterations, sized by the time an iteration takes
+        to last about ENSCRYPT_BATCH_SECONDS. A time limit may be overrun by
+        that much, or by one iteration if it takes longer.
+
+        returns a tuple: (iterations, time_consumed, derived_key)
+        '''
+        passwd = self.passwd
+        pwlen = ctypes.c_size_t(len(passwd))
+        N = ctypes.c_uint64(1 << self.logN)
+        r = ctypes.c_uint32(256)
+        p = ctypes.c_uint32(1)
+        outlen = ctypes.c_size_t(KEY_BYTES)
+        batch = ENSCRYPT_BATCH
+        buf, slots = _slots(batch)
+        # call k stretches the output of call k - 1 into slot k; the last
+        # slot carries the chain from one batch to the next
+        calls = [(passwd, pwlen, slots[k - 1], outlen, N, r, p, slots[k], outlen)
+                 for k in range(batch)]
+        last = slots[-1]
+        ctypes.memmove(last, self.out, KEY_BYTES)
+        start = clock() - self.elapsed
+        end = start + seconds
+        cap = None if maxtime is None else start + maxtime
+        report = None if progress is None else clock() + interval
+        i, acc = self.iterations, self.acc
+        # the XOR of every batch so far, one word per slot
+        wide = 0
+        # start small: a slow iteration must not overrun a time limit
+        size = 1
+        if i == 0:
+            _kdf(
+                passwd, pwlen,
+                self.salt, ctypes.c_size_t(len(self.salt)),
+                N, r, p,
+                last, outlen,
+            )
+            acc = int.from_bytes(buf[-KEY_BYTES:], 'little')
+            i = 1
+        while True:
+            # everything is consistent between batches: save it
+            self.iterations, self.acc, self.out, self.elapsed = (
+                i, acc ^ _fold(wide, batch), buf[-KEY_BYTES:], clock() - start)
+            if i >= iterations and clock() >= end:
+                break
+            if cap is not None and clock() >= cap:
+                break
+            if report is not None and clock() >= report:
+                progress(i, clock() - start)
+                report = clock() + interval
+            if cancel is not None and cancel.is_set():
+                raise Cancelled()
+            n = iterations - i
+            if n <= 0 or n >= size:
+                n = size
+            began = clock()
+            for args in calls[:n]:
+                _kdf(*args)
+            if n == batch:
+                wide, i = wide ^ int.from_bytes(buf, 'little'), i + batch
+            else:
+                ctypes.memmove(last, slots[n - 1], KEY_BYTES)
+                wide, i = wide ^ int.from_bytes(
+                    buf[:n * KEY_BYTES], 'little'), i + n
+            each = (clock() - began) / n
+            size = batch if each * batch <= ENSCRYPT_BATCH_SECONDS else \
+                max(1, int(ENSCRYPT_BATCH_SECONDS / each))
+        if metrics.enabled and self.elapsed > 0:
+            _enscrypt_rate.labels(self.logN).set(i / self.elapsed)
+        return i, self.elapsed, self.acc.to_bytes(KEY_BYTES, 'little')
+
+    def checkpoint(self, key):
+        '''return the state of the job, encrypted under key'''
+        pt = self._struct.pack(
+            self.logN, self.iterations, self.elapsed,
+            self.out, self.acc.to_bytes(KEY_BYTES, 'little')) + self.salt
+        nonce = rng.randombytes(na.crypto_secretbox_NONCEBYTES)
+        return nonce + na.crypto_secretbox(pt, nonce, key)
+
+    @classmethod
+    def resume(cls, data, key, passwd):
+        '''restore a job from checkpoint data
+
+        raises ValueError if key is wrong or the data was altered
+        '''
+        nb = na.crypto_secretbox_NONCEBYTES
+        pt = na.crypto_secretbox_open(data[nb:], data[:nb], key)
+        size = cls._struct.size
+        logN, i, elapsed, out, acc = cls._struct.unpack(pt[:size])
+        job = cls(passwd, pt[size:], logN)
+        job.iterations, job.elapsed = i, elapsed
+        job.out = out
+        job.acc = int.from_bytes(acc, 'little')
+        return job
+
+
+class EnScryptPool:
+    '''run enscrypt derivations concurrently
+
+    Jobs run on a thread pool by default; libsodium releases the GIL while
+    scrypt runs, so they use every core. Pass processes=True to use a process
+    pool instead. Each job times itself with its own thread's CPU clock, so
+    a job given `seconds` still runs its full budget however many others
+    share the machine.
+
+        with EnScryptPool() as pool:
+            futures = [pool.submit(pw, salt, 9, 20, 2) for pw, salt in ids]
+            keys = [f.result()[-1] for f in futures]
+    '''
+
+    def __init__(self, workers=None, processes=False):
+        from concurrent import futures
+        if processes:
+            self._executor = futures.ProcessPoolExecutor(workers)
+        else:
+            self._executor = futures.ThreadPoolExecutor(workers or os.cpu_count())
+
+    def submit(self, passwd, salt, logN, iterations, seconds=0):
+        '''start a derivation, return a concurrent.futures.Future
+
+        The future's result is the tuple returned by enscrypt.
+        '''
+        return self._executor.submit(
+            enscrypt, passwd, salt, logN, iterations, seconds)
+
+    def derive(self, passwd, salt, logN, iterations, seconds=0):
+        '''start a derivation, return an asyncio future for the running loop'''
+        import asyncio
+        return asyncio.wrap_future(
+            self.submit(passwd, salt, logN, iterations, seconds))
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
 
 import random
 import os
@@ -222,9 +493,81 @@ class KeyGen:
         '''generate UnlockRequestSigningKey from ServerUnlockKey and IdentityUnlockKey'''
 
 
-def sign(message, sk, pk):  # =>signature
-    return crypto_sign_detached(message, sk + pk)
+def sign(message, sk, pk=None):  # =>signature
+    '''sign message with an ed25519 secret key
+
+    sk is the 64-byte secret key from crypto_sign_keypair. For compatibility
+    it may also be the 32-byte seed, with the public key in pk, but then
+    the full key is rebuilt on every call.
+    '''
+    if pk is not None and len(sk) == KEY_BYTES:
+        sk = sk + pk
+    return na.crypto_sign_detached(message, sk)
+
+
+_sign_verify = sodium.crypto_sign_verify_detached
+SIGN_BYTES = na.crypto_sign_BYTES
+SIGN_PUBLICKEYBYTES = na.crypto_sign_PUBLICKEYBYTES
 
 
 def verify(sig, msg, pk):
-    crypto_sign_verify_detached(message, pk)
+    '''return True if sig is a good signature of msg under the public key pk'''
+    if len(sig) != SIGN_BYTES or len(pk) != SIGN_PUBLICKEYBYTES:
+        return False
+    return _sign_verify(sig, msg, ctypes.c_ulonglong(len(msg)), pk) == 0
+
+
+_pool = None
+VERIFY_CHUNK = 32
+
+
+def _submit_chunks(fn, count, minimum, executor=None):
+    '''split range(count) into about four chunks per core, each of at least
+    minimum items, and submit fn(start, stop) for each to executor (by
+    default a shared thread pool with a thread per core)
+
+    returns the futures
+    '''
+    if executor is None:
+        global _pool
+        if _pool is None:
+            from concurrent.futures import ThreadPoolExecutor
+            _pool = ThreadPoolExecutor(os.cpu_count())
+        executor = _pool
+    step = max(minimum, -(-count // (4 * (os.cpu_count() or 1))))
+    return [executor.submit(fn, i, min(i + step, count))
+            for i in range(0, count, step)]
+
+
+def _verify_chunk(items, results, start, stop):
+    for i in range(start, stop):
+        sig, msg, pk = items[i]
+        if results[i]:
+            results[i] = _sign_verify(
+                sig, msg, ctypes.c_ulonglong(len(msg)), pk) == 0
+
+
+def verify_many(items, executor=None):
+    '''verify a batch of (sig, msg, pk) triples
+
+    returns a bytearray with 1 for each good signature and 0 for each bad one.
+    Items with a malformed signature or key are rejected before any
+    signature is checked. The rest are checked in chunks on executor (by
+    default a shared thread pool with a thread per core); libsodium releases
+    the GIL, so the chunks run in parallel.
+    '''
+    count = len(items)
+    results = bytearray(count)
+    for i, (sig, msg, pk) in enumerate(items):
+        results[i] = (len(sig) == SIGN_BYTES and
+                      len(pk) == SIGN_PUBLICKEYBYTES)
+    if count <= VERIFY_CHUNK:
+        _verify_chunk(items, results, 0, count)
+        return results
+
+    futures = _submit_chunks(
+        lambda start, stop: _verify_chunk(items, results, start, stop),
+        count, VERIFY_CHUNK, executor)
+    for f in futures:
+        f.result()
+    return results
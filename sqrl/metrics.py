@@ -0,0 +1,329 @@
+'''
+Counters, histograms and gauges for the hot paths of sqrl.
+
+    from sqrl import metrics
+    metrics.enable()
+    metrics.Reporter(metrics.PrometheusFile('/var/lib/node_exporter/sqrl.prom')).start()
+
+Metrics are off until enable() is called. Instrumented code tests the
+module global first, so while off it costs one attribute lookup:
+
+    if metrics.enabled:
+        with _open_seconds.time():
+            return self._open_with_key(dkey)
+    return self._open_with_key(dkey)
+
+For calls that take more than a few microseconds, the timed decorator
+does the same for the price of one more function call.
+
+A sink is any callable that takes the Registry; Reporter calls it every
+`interval` seconds. prometheus_text renders a registry in the Prometheus
+text exposition format.
+
+Sampler is a poor man's profiler: a thread that looks at another thread's
+stack every few milliseconds and counts where it was, written out in the
+collapsed-stack format flame graph tools read.
+'''
+import bisect
+import functools
+import os
+import sys
+import threading
+import time
+from collections import Counter as _Tally
+
+enabled = False
+
+
+def enable(on=True):
+    '''turn collection on (or off)'''
+    global enabled
+    enabled = on
+
+
+# seconds, from 10us up to about 1 minute
+LATENCY_BUCKETS = tuple(1e-5 * 4 ** i for i in range(12))
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help='', labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        '''return the child for one set of label values'''
+        values = tuple(str(v) for v in values)
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._child())
+        return child
+
+    def samples(self):
+        '''yield (suffix, labels, value) for everything recorded'''
+        if self.labelnames:
+            for values, child in sorted(self._children.items()):
+                labels = tuple(zip(self.labelnames, values))
+                for suffix, extra, value in child.samples():
+                    yield suffix, labels + extra, value
+        else:
+            yield from self._samples()
+
+
+class Counter(_Metric):
+    '''a count that only goes up
+
+    Increments are not locked, so racing threads may now and then lose
+    one; the count is for watching trends, not for accounting.
+    '''
+    kind = 'counter'
+
+    def __init__(self, name, help='', labelnames=()):
+        super().__init__(name, help, labelnames)
+        self.value = 0
+
+    def _child(self):
+        return Counter(self.name)
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def _samples(self):
+        yield '_total', (), self.value
+
+
+class Gauge(_Metric):
+    '''a value that is set, e.g. the latest rate measured'''
+    kind = 'gauge'
+
+    def __init__(self, name, help='', labelnames=()):
+        super().__init__(name, help, labelnames)
+        self.value = 0
+
+    def _child(self):
+        return Gauge(self.name)
+
+    def set(self, value):
+        self.value = value
+
+    def _samples(self):
+        yield '', (), self.value
+
+
+class Histogram(_Metric):
+    '''counts of observations that fall at or under each of buckets'''
+    kind = 'histogram'
+
+    def __init__(self, name, help='', labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def _child(self):
+        return Histogram(self.name, buckets=self.buckets)
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def time(self):
+        '''return a context manager that observes the seconds it is open'''
+        return _Timer(self)
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def _samples(self):
+        total = 0
+        for bound, n in zip(self.buckets + (float('inf'),), self.counts):
+            total += n
+            yield '_bucket', (('le', _number(bound)),), total
+        yield '_sum', (), self.sum
+        yield '_count', (), total
+
+
+class _Timer:
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Registry:
+    '''the metrics of one process, by name'''
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, help, labelnames, **kw):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help, labelnames, **kw)
+            elif not isinstance(metric, cls):
+                raise ValueError('{} is already a {}'.format(name, metric.kind))
+            return metric
+
+    def counter(self, name, help='', labelnames=()):
+        return self._get(Counter, name, help, labelnames)
+
+    def gauge(self, name, help='', labelnames=()):
+        return self._get(Gauge, name, help, labelnames)
+
+    def histogram(self, name, help='', labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._get(Histogram, name, help, labelnames, buckets=buckets)
+
+    def __iter__(self):
+        with self._lock:
+            metrics = sorted(self._metrics.items())
+        return (m for _, m in metrics)
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+
+
+def timed(metric):
+    '''decorator: observe the seconds each call takes in metric, a
+    Histogram (or a child of one), while metrics are enabled'''
+    def wrap(fn):
+        @functools.wraps(fn)
+        def timed_call(*args, **kwargs):
+            if not enabled:
+                return fn(*args, **kwargs)
+            with metric.time():
+                return fn(*args, **kwargs)
+        return timed_call
+    return wrap
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return value.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def prometheus_text(registry=REGISTRY):
+    '''render the metrics in registry in the Prometheus text format'''
+    lines = []
+    for metric in registry:
+        if metric.help:
+            lines.append('# HELP {} {}'.format(
+                metric.name, metric.help.replace('\\', r'\\')))
+        lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+        for suffix, labels, value in metric.samples():
+            if labels:
+                labels = '{' + ','.join('{}="{}"'.format(k, _escape(v))
+                                        for k, v in labels) + '}'
+            lines.append('{}{}{} {}'.format(
+                metric.name, suffix, labels or '', _number(value)))
+    return ''.join(line + '\n' for line in lines)
+
+
+class PrometheusFile:
+    '''a sink that writes the Prometheus text to path, replacing it whole
+
+    Point node_exporter's textfile collector at the directory.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, registry):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as fo:
+            fo.write(prometheus_text(registry))
+        os.replace(tmp, self.path)
+
+
+class Reporter(threading.Thread):
+    '''hand the registry to sink every `interval` seconds
+
+    Runs in a daemon thread until stop() is called, and reports once more
+    on the way out.
+    '''
+
+    def __init__(self, sink, interval=15, registry=REGISTRY):
+        super().__init__(daemon=True)
+        self.sink = sink
+        self.interval = interval
+        self.registry = registry
+        self._halt = threading.Event()
+
+    def run(self):
+        while not self._halt.wait(self.interval):
+            self.sink(self.registry)
+        self.sink(self.registry)
+
+    def stop(self):
+        self._halt.set()
+
+
+class Sampler(threading.Thread):
+    '''sample the stack of a thread every `interval` seconds
+
+    stacks counts each distinct stack, as a tuple of 'file:function'
+    strings, outermost first. Use it as a context manager around the code
+    to profile; on exit the samples are written to path, if given, one
+    'frame;frame;... count' line per stack.
+    '''
+
+    def __init__(self, path=None, interval=0.005, thread=None):
+        super().__init__(daemon=True)
+        self.path = path
+        self.interval = interval
+        self.target = (threading.current_thread() if thread is None
+                       else thread).ident
+        self.stacks = _Tally()
+        self._halt = threading.Event()
+
+    def run(self):
+        while not self._halt.wait(self.interval):
+            frame = sys._current_frames().get(self.target)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{}:{}'.format(
+                    os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            if stack:
+                self.stacks[tuple(reversed(stack))] += 1
+
+    def stop(self):
+        self._halt.set()
+        self.join()
+
+    def dump(self, sink):
+        for stack, count in self.stacks.most_common():
+            sink.write('{} {}\n'.format(';'.join(stack), count))
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+        if self.path:
+            with open(self.path, 'w') as fo:
+                self.dump(fo)
@@ -1,13 +1,34 @@
 import io
 import struct
-from sqrl.s4enc import decode, encode
+from sqrl.s4enc import decode, encode, Encoder, Decoder
 from collections import namedtuple
 
-from sqrl import TAG_BYTES, KEY_BYTES, NULLIV, rng
-from sqrl.crypto import enscrypt, enhash, encrypt, decrypt
+from sqrl import TAG_BYTES, KEY_BYTES, NULLIV, metrics, rng
+from sqrl.crypto import enscrypt, enhash, AEAD, keyed
 
 
 
+_blockhead = struct.Struct('<HH')
+
+
+_seal_seconds = metrics.histogram(
+    'sqrl_s4_seal_seconds', 'sealing S4 blocks, with any key derivation',
+    ('block',))
+_open_seconds = metrics.histogram(
+    'sqrl_s4_open_seconds', 'opening S4 blocks, with any key derivation',
+    ('block',))
+_load_seconds = metrics.histogram(
+    'sqrl_s4_load_seconds', 'reading a whole SQRLdata stream with load')
+_blocks_loaded = metrics.counter(
+    'sqrl_s4_blocks_loaded', 'blocks read by SQRLdata.load')
+
+
+def _check(block, size):
+    if len(block) < size:
+        raise ValueError('truncated block: need {} bytes, have {}'.format(
+            size, len(block)))
+
+
 class _aead(namedtuple('_aead', ('authdata', 'ciphertext', 'tag'))):
     __slots__ = ()
 
@@ -34,6 +55,11 @@ class Block(namedtuple('Block', ('bocklen', 'blocktype', 'offset', 'data'))):
         data = source.read(blocklen)
         return cls(blocklen, blocktype, offset, data)
 
+    @classmethod
+    def frombuffer(cls, block, offset=None):
+        blocklen, blocktype = _blockhead.unpack_from(block)
+        return cls(blocklen, blocktype, offset, block)
+
     def dump(self, sink):
         sink.write(self.data)
 
@@ -63,9 +89,20 @@ class EnScrypt(namedtuple('EnScrypt', 'salt,logN,iterations')):
         return enscrypt(pw, self.salt, self.logN, self.iterations)[-1]
 
     @classmethod
-    def new_key(cls, pw, logN, miniter, mintime):
+    def new_key(cls, pw, logN, miniter, mintime, plan=None, maxtime=None):
+        '''derive a key from pw under a new random salt
+
+        Without a plan, run until both miniter and mintime are satisfied.
+        With a plan (a sqrl.calibration.Calibration), run the number of
+        iterations it predicts for mintime instead. maxtime caps the
+        time spent either way.
+        '''
         salt = cls.randomsalt()
-        i, pt, dkey = enscrypt(pw, salt, logN, miniter, mintime)
+        if plan is not None:
+            miniter = plan.iterations(logN, mintime, miniter)
+            mintime = 0
+        i, pt, dkey = enscrypt(pw, salt, logN, miniter, mintime,
+                               maxtime=maxtime)
         return cls(salt, logN, i), dkey
 
 EnScrypt.DEFAULT = EnScrypt(None,
@@ -91,30 +128,38 @@ class Rescue:
 
     @classmethod
     def load(cls, blocklen, blocktype, source):
-        ad = source.read(cls._struct.size)
-        ct = source.read(KEY_BYTES)
-        tag = source.read(TAG_BYTES)
-        that = cls(*cls._struct.unpack(ad))
-        that.aead = _aead(ad, ct, tag)
+        return cls.frombuffer(memoryview(source.read(blocklen)))
+
+    @classmethod
+    def frombuffer(cls, block, offset=None):
+        '''the aead fields are slices of block, a memoryview'''
+        adlen = cls._struct.size
+        _check(block, cls.BLOCKLEN)
+        that = cls(*cls._struct.unpack_from(block))
+        that.aead = _aead(block[:adlen], block[adlen:adlen + KEY_BYTES],
+                          block[adlen + KEY_BYTES:cls.BLOCKLEN])
         return that
 
     def dump(self, sink):
         self.aead.dump(sink)
 
     @classmethod
+    @metrics.timed(_seal_seconds.labels('Rescue'))
     def seal(cls, key, rescue_code,
              logN=EnScrypt.DEFAULT_LOGN,
              miniter=EnScrypt.MINITER_SENSITIVE,
-             mintime=EnScrypt.MINTIME_SENSITIVE
+             mintime=EnScrypt.MINTIME_SENSITIVE,
+             plan=None, maxtime=None
              ):
         assert len(key) == KEY_BYTES
         assert len(rescue_code) >= 24
-        sp, dkey = EnScrypt.new_key(rescue_code, logN, miniter, mintime)
+        sp, dkey = EnScrypt.new_key(
+            rescue_code, logN, miniter, mintime, plan, maxtime)
 
         p = (cls.BLOCKLEN, cls.BLOCKTYPE) + sp
         that = cls(*p)
         ad = cls._struct.pack(*p)
-        ct, tag = encrypt(dkey, NULLIV, key, ad)
+        ct, tag = AEAD(dkey).encrypt(NULLIV, key, ad)
         that.aead = _aead(ad, ct, tag)
         that.authenticated = True
         return that
@@ -122,10 +167,11 @@ class Rescue:
     def get_key(self, rescue_code):
         return enscrypt(rescue_code, self.salt, self.logN, self.iterations)[-1]
 
+    @metrics.timed(_open_seconds.labels('Rescue'))
     def open(self, rescue_code):
         dkey = self.get_key(rescue_code)
         ad, ct, tag = self.aead
-        iuk = decrypt(dkey, NULLIV, ct, ad, tag)
+        iuk = AEAD(dkey).decrypt(NULLIV, ct, ad, tag)
         self.authenticated = True
         return iuk
 
@@ -144,7 +190,7 @@ class Access:
     IV_BYTES = 12
     KEY_COUNT = 2
     _struct = struct.Struct(
-        '<HHH{}s{}HBBH'.format(IV_BYTES, EnScrypt._struct.format[1:].decode('ascii')))
+        '<HHH{}s{}HBBH'.format(IV_BYTES, EnScrypt._struct.format[1:]))
     PTLEN = _struct.size
     BLOCKTYPE = 1
     BLOCKLEN = PTLEN + KEY_BYTES * KEY_COUNT + TAG_BYTES
@@ -167,17 +213,18 @@ class Access:
 
     @classmethod
     def load(cls, blocklen, blocktype, source):
-        offset = source.tell()
-        source.seek(4, 1)
-        ptlen = int.from_bytes(source.read(2), 'little')
+        return cls.frombuffer(memoryview(source.read(blocklen)))
+
+    @classmethod
+    def frombuffer(cls, block, offset=None):
+        '''the aead fields are slices of block, a memoryview'''
+        _check(block, cls.BLOCKLEN)
+        that = cls(*cls._struct.unpack_from(block))
+        ptlen = that.ptlen
         assert ptlen == cls._struct.size
-        source.seek(offset)
-        ad = source.read(ptlen)
-        that = cls(*cls._struct.unpack(ad))
-        ctlen = cls.KEY_COUNT * KEY_BYTES
-        ct = source.read(ctlen)
-        tag = source.read(TAG_BYTES)
-        that.aead = _aead(ad, ct, tag)
+        ctend = ptlen + cls.KEY_COUNT * KEY_BYTES
+        that.aead = _aead(block[:ptlen], block[ptlen:ctend],
+                          block[ctend:ctend + TAG_BYTES])
         that.authenticated = True
         return that
 
@@ -202,23 +249,26 @@ class Access:
     def get_key(self, pw):
         return enscrypt(pw, self.salt, self.logN, self.iterations)[-1]
 
-    def seal(self, keys, password):
+    @metrics.timed(_seal_seconds.labels('Access'))
+    def seal(self, keys, password, plan=None, maxtime=None):
         assert len(keys) == self.KEY_COUNT * KEY_BYTES
         assert len(password) > 1
 
         sp, dkey = EnScrypt.new_key(
-            password, self.logN, EnScrypt.MINITER_INTERACTIVE, self.pwverifysecs)
+            password, self.logN, EnScrypt.MINITER_INTERACTIVE, self.pwverifysecs,
+            plan, maxtime)
         self.salt, self.logN, self.iterations = sp
         return self._seal_with_key(keys, dkey)
 
     def _seal_with_key(self, keys, dkey):
         self.gcmiv = iv = self.next_nonce()
         ad = self._struct.pack(*(getattr(self, k) for k in self._fields))
-        ct, tag = encrypt(dkey, iv, keys, ad)
+        ct, tag = keyed(dkey).encrypt(iv, keys, ad)
         self.aead = _aead(ad, ct, tag)
         self.authenticated = True
         return self
 
+    @metrics.timed(_open_seconds.labels('Access'))
     def open(self, password):
         assert len(password) > 1
         return self._open_with_key(self.get_key(password))
@@ -226,7 +276,7 @@ class Access:
     def _open_with_key(self, dkey):
         iv = self.gcmiv
         ad, ct, tag = self.aead
-        keys = decrypt(dkey, iv, ct, ad, tag)
+        keys = keyed(dkey).decrypt(iv, ct, ad, tag)
         self.authenticated = True
         return tuple(keys[i:i + KEY_BYTES] for i in range(0, len(keys), KEY_BYTES))
 
@@ -252,20 +302,26 @@ class Previous:
 
     @classmethod
     def load(cls, blocklen, blocktype, source):
-        offset = source.tell()
-        ad = source.read(cls.PTLEN)
-        that = cls(*cls._struct.unpack(ad))
-        ctlen = blocklen - cls.PTLEN - TAG_BYTES
-        ct = source.read(ctlen)
-        tag = source.read(TAG_BYTES)
-        that.aead = _aead(ad, ct, tag)
+        return cls.frombuffer(memoryview(source.read(blocklen)))
+
+    @classmethod
+    def frombuffer(cls, block, offset=None):
+        '''the aead fields are slices of block, a memoryview'''
+        _check(block, cls.PTLEN + TAG_BYTES)
+        that = cls(*cls._struct.unpack_from(block))
+        ctend = that.blocklen - TAG_BYTES
+        _check(block, that.blocklen)
+        that.aead = _aead(block[:cls.PTLEN], block[cls.PTLEN:ctend],
+                          block[ctend:that.blocklen])
         return that
 
     def dump(self, sink):
         self.aead.dump(sink)
 
     @classmethod
+    @metrics.timed(_seal_seconds.labels('Previous'))
     def seal(cls, imk, keys, edition=None):
+        '''encrypt keys under imk (a key or an AEAD handle)'''
         lk = len(keys)
         assert 1 <= lk <= 4
         if edition is None:
@@ -273,14 +329,15 @@ class Previous:
         blocklen = cls.PTLEN + TAG_BYTES + lk * KEY_BYTES
         that = cls(blocklen, cls.BLOCKTYPE, edition)
         ad = cls._struct.pack(blocklen, cls.BLOCKTYPE, edition)
-        ct, tag = encrypt(imk, NULLIV, b''.join(keys), ad)
+        ct, tag = keyed(imk).encrypt(NULLIV, b''.join(keys), ad)
         that.aead = _aead(ad, ct, tag)
         that.authenticated = True
         return that
 
+    @metrics.timed(_open_seconds.labels('Previous'))
     def open(self, imk):
         ad, ct, tag = self.aead
-        keys = decrypt(imk, NULLIV, ct, ad, tag)
+        keys = keyed(imk).decrypt(NULLIV, ct, ad, tag)
         self.authenticated = True
         return list(keys[i:i + KEY_BYTES] for i in range(0, len(keys), KEY_BYTES))
 
@@ -299,22 +356,107 @@ class SQRLdata(list):
         for x in self:
             x.dump(sink)
 
+    def dump_ascii(self, sink):
+        '''write the ASCII form to sink, encoding the blocks as they go'''
+        sink.write(self.ALT_HEADER)
+        enc = Encoder(sink)
+        # blocks make many small writes; gather them before encoding
+        bio = io.BytesIO()
+        for x in self:
+            x.dump(bio)
+            if bio.tell() >= enc.buffer:
+                enc.update(bio.getvalue())
+                bio.seek(0)
+                bio.truncate()
+        enc.update(bio.getvalue())
+        enc.finish()
+
     def ascii(self):
         bio = io.BytesIO()
-        self.dump(bio)
-        bio.seek(len(self.HEADER))
-        bin = bio.read()
-        lp = 3 - (len(bin) % 3)
-        return (self.ALT_HEADER + encode(bin)).decode('ascii')
+        self.dump_ascii(bio)
+        return bio.getvalue().decode('ascii')
+
+    def open_secrets(self, imk, executor=None, cache=None):
+        '''open every Secret block on a worker pool, see s4ext.open_secrets'''
+        from sqrl.s4ext import open_secrets
+        return open_secrets(self, imk, executor, cache)
+
+    def reseal_secrets(self, imk, newimk=None, executor=None, cache=None):
+        '''seal every Secret block again, see s4ext.reseal_secrets'''
+        from sqrl.s4ext import reseal_secrets
+        return reseal_secrets(self, imk, newimk, executor, cache)
+
+    @classmethod
+    def frombuffer(cls, data, typemap=None):
+        '''parse a whole vault from a bytes-like object (bytes, mmap, ...)
+
+        Blocks are parsed in one pass over the buffer, and their aead fields
+        are memoryview slices of it, so the binary form is not copied. The
+        ASCII form is decoded into one new buffer first.
+        '''
+        if typemap is None:
+            typemap = {0: Block}
+        data = memoryview(data)
+        start = len(cls.HEADER)
+        header = data[:start]
+        if header == cls.ALT_HEADER:
+            data = memoryview(decode(bytes(data[start:])))
+            start = 0
+        elif header != cls.HEADER:
+            raise ValueError('bad header: expecting {} or {}. got {}'.format(
+                cls.HEADER, cls.ALT_HEADER, bytes(header)
+            ))
+
+        that = cls()
+        offset, end = start, len(data)
+        while offset < end:
+            if offset + 4 > end:
+                raise ValueError('truncated block at {}'.format(offset))
+            blocklen, blocktype = _blockhead.unpack_from(data, offset)
+            if blocklen < 4 or offset + blocklen > end:
+                raise ValueError('bad block length {} at {}'.format(
+                    blocklen, offset))
+            breader = typemap.get(blocktype) or typemap[0]
+            that.append(breader.frombuffer(
+                data[offset:offset + blocklen], offset))
+            offset += blocklen
+        return that
+
+    @classmethod
+    def map(cls, path, typemap=None):
+        '''memory-map the file at path and parse it with frombuffer'''
+        import mmap
+        with open(path, 'rb') as fi:
+            data = mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls.frombuffer(data, typemap)
 
     @classmethod
     def load(cls, source, typemap=None):
+        '''yield the blocks read from source, binary or ASCII'''
+        if metrics.enabled:
+            return cls._timed_load(source, typemap)
+        return cls._load(source, typemap)
+
+    @classmethod
+    def _timed_load(cls, source, typemap):
+        count = 0
+        try:
+            with _load_seconds.time():
+                for block in cls._load(source, typemap):
+                    count += 1
+                    yield block
+        finally:
+            _blocks_loaded.inc(count)
+
+    @classmethod
+    def _load(cls, source, typemap=None):
         if typemap is None:
             typemap = {0: Block}
         start = source.tell()
         header = source.read(len(cls.HEADER))
         if header == cls.ALT_HEADER:
-            source = io.BytesIO(decode(source.read()))
+            yield from cls._load_ascii(source, typemap)
+            return
         elif header != cls.HEADER:
             source.seek(start)
             raise ValueError('bad header: expecting {} or {}. got {}'.format(
@@ -330,3 +472,29 @@ class SQRLdata(list):
             blocklen, blocktype = struct.unpack('<HH', bhead)
             breader = typemap.get(blocktype) or typemap[0]
             yield breader.load(blocklen, blocktype, source)
+
+    @classmethod
+    def _load_ascii(cls, source, typemap, chunk=65536):
+        # decode a chunk at a time, and hand on each block once it is whole
+        dec = Decoder()
+        pending = bytearray()
+        offset = 0
+        while True:
+            text = source.read(chunk)
+            pending += dec.update(text) if text else dec.finish()
+            while len(pending) >= 4:
+                blocklen, blocktype = _blockhead.unpack_from(pending)
+                if blocklen < 4:
+                    raise ValueError('bad block length {} at {}'.format(
+                        blocklen, offset))
+                if len(pending) < blocklen:
+                    break
+                block = memoryview(bytes(pending[:blocklen]))
+                del pending[:blocklen]
+                breader = typemap.get(blocktype) or typemap[0]
+                yield breader.frombuffer(block, offset)
+                offset += blocklen
+            if not text:
+                if pending:
+                    raise ValueError('truncated block at {}'.format(offset))
+                return
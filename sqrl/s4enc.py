@@ -1,6 +1,6 @@
-from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import a2b_base64, b2a_base64
 
-__all__ = ['onlydigits', 'encode', 'decode']
+__all__ = ['onlydigits', 'encode', 'decode', 'Encoder', 'Decoder']
 
 _identity = bytearray(range(256))
 _digits = b'0123456789'
@@ -8,6 +8,22 @@ _notdigits = bytes(set(_identity) - set(_digits))
 _b64u = b'0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz-_'
 _notb64u = bytes(set(_identity) - set(_b64u))
 _PADDING = [b'', b'', b'==', b'=']
+_tourl = bytes.maketrans(b'+/', b'-_')
+# drop everything but base64url and map it to standard base64 in one pass
+_fromurl = bytes.maketrans(b'-_', b'+/')
+
+
+# base64 itself imports re, which costs more to import than all of this
+def urlsafe_b64encode(b):
+    '''the same as base64.urlsafe_b64encode'''
+    return b2a_base64(b, newline=False).translate(_tourl)
+
+
+def urlsafe_b64decode(a):
+    '''the same as base64.urlsafe_b64decode'''
+    if isinstance(a, str):
+        a = a.encode('ascii')
+    return a2b_base64(a.translate(_fromurl))
 
 
 def onlydigits(b):
@@ -34,6 +50,82 @@ def encode(b):
     return g
 
 
+class Encoder:
+    '''incremental encode: the same output as encode(b''.join(chunks))
+
+    update(chunk) returns the text for the whole groups of 3 bytes seen so
+    far and holds back the rest; finish() returns the unpadded tail. If a
+    sink is given, the text is written to sink instead, about `buffer` bytes
+    at a time, and the methods return None. write is an alias of update, so
+    an Encoder can stand in for a binary file:
+
+        enc = Encoder(fo)
+        vault.dump(enc)
+        enc.finish()
+    '''
+
+    def __init__(self, sink=None, buffer=49152):
+        self.sink = sink
+        self.buffer = buffer
+        self._pending = bytearray()
+
+    def update(self, data):
+        pending = self._pending
+        pending += data
+        if self.sink is not None and len(pending) < self.buffer:
+            return None
+        cut = len(pending) - len(pending) % 3
+        out = b2a_base64(pending[:cut], newline=False).translate(_tourl)
+        del pending[:cut]
+        return self._emit(out)
+
+    write = update
+
+    def finish(self):
+        tail = bytes(self._pending)
+        self._pending.clear()
+        return self._emit(encode(tail))
+
+    def _emit(self, out):
+        if self.sink is None:
+            return out
+        if out:
+            self.sink.write(out)
+
+
+class Decoder:
+    '''incremental decode: the same output as decode(b''.join(chunks))
+
+    Characters outside the base64url alphabet (whitespace, line breaks)
+    are skipped wherever they fall. update(chunk) returns the bytes for the
+    whole groups of 4 characters seen so far; finish() returns the bytes
+    of the unpadded tail. If a sink is given, the bytes are written to sink
+    instead and the methods return None.
+    '''
+
+    def __init__(self, sink=None):
+        self.sink = sink
+        self._tail = b''
+
+    def update(self, text):
+        text = self._tail + bytes(text).translate(_fromurl, _notb64u)
+        cut = len(text) - len(text) % 4
+        self._tail = text[cut:]
+        return self._emit(a2b_base64(text[:cut]))
+
+    write = update
+
+    def finish(self):
+        tail, self._tail = self._tail, b''
+        return self._emit(a2b_base64(tail + _PADDING[len(tail) % 4]))
+
+    def _emit(self, out):
+        if self.sink is None:
+            return out
+        if out:
+            self.sink.write(out)
+
+
 if False:
     import string
     _ip6b85 = (string.digits + string.ascii_uppercase +
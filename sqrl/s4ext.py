@@ -13,25 +13,85 @@ authtag
 import time
 import struct
 import hmac
+import ctypes
+import threading
+from collections import OrderedDict, namedtuple
 
-from sqrl.s4 import _aead
-from sqrl import rng, TAG_BYTES
-from sqrl.crypto import enhash, encrypt, decrypt
+from sqrl.s4 import _aead, _seal_seconds, _open_seconds
+from sqrl import crypto, metrics, rng, TAG_BYTES
+from sqrl.crypto import enhash, keyed, sha256sum
 
 
-def read_pstr(source, maxlen):
-    b = ord(source.read(1))
-    if b > maxlen:
-        raise ValueError('string too long: len={} maxlen={}'.format(b, maxlen))
-    return maxlen - b - 1, source.read(b)
+def wipe(key):
+    '''overwrite a bytearray with zeros'''
+    if key:
+        ctypes.memset((ctypes.c_char * len(key)).from_buffer(key), 0, len(key))
 
 
-def write_pstrs(sink, *strs):
-    for s in strs:
-        l = len(s)
-        assert l < 256
-        sink.write(l.to_bytes(1, 'little'))
-        sink.write(s)
+class KeyCache:
+    '''a bounded cache of derived Secret keys
+
+    Entries are keyed on a hash of the IMK plus (path, realm, username).
+    When there are more than capacity entries, the least recently used is
+    dropped; entries not used for idle seconds are dropped on the next
+    access. Callers get a copy of each key; the cached copies are zeroed
+    when they are dropped. Call clear() when the vault locks.
+
+        cache = KeyCache()
+        secret.open(imk, cache=cache)
+    '''
+
+    def __init__(self, capacity=256, idle=300, clock=time.monotonic):
+        self.capacity = capacity
+        self.idle = idle
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, imk, names, derive):
+        '''return the key for names under imk, calling derive(imk) on a miss'''
+        ident = (sha256sum(imk), names)
+        now = self.clock()
+        with self._lock:
+            self._expire(now)
+            entry = self._entries.get(ident)
+            if entry is not None:
+                self._entries.move_to_end(ident)
+                entry[0] = now
+                self.hits += 1
+                # a copy: the cached buffer is wiped when it is dropped,
+                # maybe while another thread still uses the key
+                return bytes(entry[1])
+        key = bytearray(derive(imk))
+        with self._lock:
+            self.misses += 1
+            old = self._entries.pop(ident, None)
+            if old is not None:
+                wipe(old[1])
+            self._entries[ident] = [now, key]
+            while len(self._entries) > self.capacity:
+                wipe(self._entries.popitem(last=False)[1][1])
+            return bytes(key)
+
+    def _expire(self, now):
+        entries = self._entries
+        while entries:
+            ident, entry = next(iter(entries.items()))
+            if now - entry[0] < self.idle:
+                break
+            del entries[ident]
+            wipe(entry[1])
+
+    def clear(self):
+        '''zero and drop every key'''
+        with self._lock:
+            for _, key in self._entries.values():
+                wipe(key)
+            self._entries.clear()
 
 
 class Secret:
@@ -63,74 +123,90 @@ class Secret:
 
     @classmethod
     def load(cls, blocklen, blocktype, source):
-        offset = source.tell()
-        bl, bt, ptlen, gcmiv, modtime = cls._struct.unpack(
-            source.read(cls.FIXED_BYTES))
-        ctlen = blocklen - ptlen - TAG_BYTES
-        if ctlen < 0:
-            # XXX: this will leave the source stream in an undefined state
+        return cls.frombuffer(memoryview(source.read(blocklen)))
+
+    @classmethod
+    def frombuffer(cls, block, offset=None):
+        '''the aead fields are slices of block, a memoryview'''
+        if len(block) < cls.FIXED_BYTES:
+            raise ValueError('truncated block')
+        bl, bt, ptlen, gcmiv, modtime = cls._struct.unpack_from(block)
+        ctlen = bl - ptlen - TAG_BYTES
+        if ctlen < 0 or ptlen < cls.FIXED_BYTES or len(block) < bl:
             raise ValueError(
-                'corrupt header field: ptlen={} blocklen={}'.format(ptlen, blocklen))
-        path = realm = username = b''
-        maxlen = ptlen - cls.FIXED_BYTES
-        if maxlen > 0:
-            maxlen, path = read_pstr(source, maxlen)
-        if maxlen > 0:
-            maxlen, realm = read_pstr(source, maxlen)
-        if maxlen > 0:
-            maxlen, username = read_pstr(source, maxlen)
-        source.seek(offset)
-
-        that = cls(bl, bt, ptlen, gcmiv, modtime, path, realm, username)
-        ad = source.read(ptlen)
-        ct = source.read(ctlen)
-        tag = source.read(TAG_BYTES)
-        that.aead = _aead(ad, ct, tag)
+                'corrupt header field: ptlen={} blocklen={}'.format(ptlen, bl))
+        names = []
+        i = cls.FIXED_BYTES
+        for _ in range(3):
+            if i >= ptlen:
+                names.append(b'')
+                continue
+            l = block[i]
+            if i + 1 + l > ptlen:
+                raise ValueError('string too long: len={} maxlen={}'.format(
+                    l, ptlen - i - 1))
+            names.append(bytes(block[i + 1:i + 1 + l]))
+            i += 1 + l
+
+        that = cls(bl, bt, ptlen, gcmiv, modtime, *names)
+        ctend = ptlen + ctlen
+        that.aead = _aead(block[:ptlen], block[ptlen:ctend],
+                          block[ctend:bl])
         that.authenticated = False
         return that
 
-    def get_key(self, imk):
-        '''get secret encryption key'''
+    def get_key(self, imk, cache=None):
+        '''get secret encryption key, from cache (a KeyCache) if given'''
+        if cache is not None:
+            return cache.get(imk, (self.path, self.realm, self.username),
+                             self._derive_key)
+        return self._derive_key(imk)
+
+    def _derive_key(self, imk):
         h = hmac.new(imk, digestmod='sha256')
         for x in self.path, self.realm, self.username:
             h.update(len(x).to_bytes(1, 'little'))
             h.update(x)
         return enhash(h.digest())
 
-    def seal(self, imk, secret):
-        dkey = self.get_key(imk)
+    @metrics.timed(_seal_seconds.labels('Secret'))
+    def seal(self, imk, secret, cache=None):
+        dkey = self.get_key(imk, cache)
         return self._seal_with_key(dkey, secret)
 
     def _seal_with_key(self, dkey, secret):
+        '''dkey may be a key or an AEAD handle'''
         iv = self.gcmiv = self.next_nonce()
         bl = 3 + len(self.path) + len(self.realm) + len(self.username)
-        ba = bytearray(bl)
-        i = 0
-        for s in self.path, self.realm, self.username:
-            l = len(s)
-            ba[i] = l
-            i += 1
-            for x in s:
-                ba[i] = x
-                i += 1
         adlen = self.ptlen = self.FIXED_BYTES + bl
         self.blocklen = adlen + TAG_BYTES + len(secret)
         self.modtime = int(time.time())
-        ad = self._struct.pack(self.blocklen, self.blocktype,
-                               adlen, iv, self.modtime) + ba
-        ct, tag = encrypt(dkey, iv, secret, ad)
-        self.aead = _aead(ad, ct, tag)
+        # the whole block is built in one buffer, the ciphertext and tag
+        # are written straight into it
+        block = memoryview(bytearray(self.blocklen))
+        self._struct.pack_into(block, 0, self.blocklen, self.blocktype,
+                               adlen, iv, self.modtime)
+        i = self.FIXED_BYTES
+        for s in self.path, self.realm, self.username:
+            l = len(s)
+            block[i] = l
+            block[i + 1:i + 1 + l] = s
+            i += 1 + l
+        ad = block[:adlen]
+        keyed(dkey).encrypt_into(iv, secret, ad, block[adlen:])
+        self.aead = _aead(ad, block[adlen:-TAG_BYTES], block[-TAG_BYTES:])
         self.authenticated = True
         return self
 
-    def open(self, imk):
-        dkey = self.get_key(imk)
+    @metrics.timed(_open_seconds.labels('Secret'))
+    def open(self, imk, cache=None):
+        dkey = self.get_key(imk, cache)
         return self._open_with_key(dkey)
 
     def _open_with_key(self, dkey):
         iv = self.gcmiv
         ad, ct, tag = self.aead
-        secret = decrypt(dkey, iv, ct, ad, tag)
+        secret = keyed(dkey).decrypt(iv, ct, ad, tag)
         self.authenticated = True
         return secret
 
@@ -156,3 +232,65 @@ class Secret:
             self.username.decode('utf-8'),
             self.aead.ciphertext.hex()
         )
+
+
+Opened = namedtuple('Opened', 'index,block,secret,error')
+
+SECRET_CHUNK = 64
+
+
+def _open_chunk(chunk, imk, cache):
+    out = []
+    for i, block in chunk:
+        try:
+            out.append(Opened(i, block, block.open(imk, cache), None))
+        except (crypto.InvalidTag, ValueError) as e:
+            out.append(Opened(i, block, None, e))
+    return out
+
+
+def _reseal_chunk(chunk, imk, newimk, cache):
+    out = []
+    for i, block in chunk:
+        try:
+            block.seal(newimk, block.open(imk, cache), cache)
+            out.append(Opened(i, block, None, None))
+        except (crypto.InvalidTag, ValueError) as e:
+            out.append(Opened(i, block, None, e))
+    return out
+
+
+def _in_chunks(fn, blocks, executor, *args):
+    from concurrent.futures import as_completed
+    items = [(i, b) for i, b in enumerate(blocks) if isinstance(b, Secret)]
+    futures = crypto._submit_chunks(
+        lambda start, stop: fn(items[start:stop], *args),
+        len(items), SECRET_CHUNK, executor)
+    for f in as_completed(futures):
+        yield from f.result()
+
+
+def open_secrets(blocks, imk, executor=None, cache=None):
+    '''open every Secret in blocks under imk
+
+    yields an Opened(index, block, secret, error) for each Secret, in the
+    order they finish. A block that fails to open has secret None and
+    the exception in error; the others carry on.
+
+    The blocks are opened in chunks on executor (by default a shared thread
+    pool with a thread per core). Key derivation is mostly libsodium calls
+    made through ctypes, which release the GIL.
+    '''
+    return _in_chunks(_open_chunk, blocks, executor, imk, cache)
+
+
+def reseal_secrets(blocks, imk, newimk=None, executor=None, cache=None):
+    '''open every Secret in blocks under imk and seal it again under newimk
+
+    newimk defaults to imk, which just renews the nonces. yields an Opened
+    for each Secret as in open_secrets, with secret always None. Blocks that
+    fail to open are left as they were.
+    '''
+    if newimk is None:
+        newimk = imk
+    return _in_chunks(_reseal_chunk, blocks, executor, imk, newimk, cache)
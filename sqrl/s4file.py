@@ -0,0 +1,326 @@
+'''
+Incremental saving of a binary SQRLdata file.
+
+SQRLdata.dump writes every block. A VaultFile keeps the file open for
+edits instead: a save appends only the blocks that changed, and marks the
+copies they replace as free by rewriting their block type in place. Free
+blocks are an unassigned block type, so other S4 readers skip them as
+unknown blocks.
+
+Each save is crash-safe:
+
+ 1. the changed blocks are appended, followed by free blocks listing the
+    offsets of the copies they replace and a commit block (also free) that
+    holds the SHA-256 of everything appended, and fsynced
+ 2. only then are the old copies marked free, and fsynced again
+
+On open, anything after the last commit that checks out is ignored, and the
+offsets listed by the last save are freed again in case a crash came
+between 1 and 2. A file written by SQRLdata.dump has no commit yet, so
+before its first save appends anything, a commit of what is already there
+is written and fsynced. compact() rewrites the live blocks to a new file and
+renames it over the old one.
+
+    vf = VaultFile('id.sqrl', typemap)
+    secret = vf.blocks[-1]
+    secret.seal(imk, b'new password')
+    vf.changed(secret)
+    vf.save()
+'''
+import io
+import os
+import struct
+import threading
+
+from sqrl.crypto import sha256sum
+from sqrl.s4 import SQRLdata, Block, Access, Rescue, Previous, _blockhead
+from sqrl.s4ext import Secret
+
+FREE_BLOCKTYPE = 0xffff
+COMMIT_MAGIC = b'sqrlsave'
+FREED_MAGIC = b'sqrlfree'
+# free block header, magic, start of the region it covers, hash of the region
+_commit = struct.Struct('<HH8sQ32s')
+# free block header and magic, followed by the offsets a save frees
+_freed = struct.Struct('<HH8s')
+_FREED_MAX = (0xffff - _freed.size) // 8
+
+
+def identity(block):
+    '''return what makes two blocks copies of the same thing, or None'''
+    if isinstance(block, Secret):
+        return (Secret.BLOCKTYPE, block.path, block.realm, block.username)
+    if isinstance(block, (Access, Rescue, Previous)):
+        return (block.BLOCKTYPE,)
+    return None
+
+
+def commit_block(data, start):
+    '''return a commit block for data, which begins at offset start'''
+    return _commit.pack(_commit.size, FREE_BLOCKTYPE, COMMIT_MAGIC, start,
+                        sha256sum(data))
+
+
+def freed_blocks(offsets):
+    '''return free blocks that list offsets, for recovery after a crash'''
+    out = []
+    for i in range(0, len(offsets), _FREED_MAX):
+        chunk = offsets[i:i + _FREED_MAX]
+        out.append(_freed.pack(_freed.size + 8 * len(chunk), FREE_BLOCKTYPE,
+                               FREED_MAGIC))
+        out.append(struct.pack('<%dQ' % len(chunk), *chunk))
+    return b''.join(out)
+
+
+def _fsync_dir(path):
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class VaultFile:
+    '''a binary SQRLdata file that saves only what changed
+
+    blocks: the live blocks, a SQRLdata. Use add, changed and remove to
+        edit it, then save.
+    compact_ratio: save starts a background compaction when more than this
+        fraction of the file is free space (None to never do so)
+    '''
+
+    def __init__(self, path, typemap=None, compact_ratio=0.5):
+        self.path = path
+        self.typemap = typemap
+        self.compact_ratio = compact_ratio
+        self.blocks = SQRLdata()
+        self._offsets = {}      # id(block) -> (offset, blocklen) on disk
+        self._dirty = {}        # id(block) -> block, in order
+        self._superseded = []   # (offset, blocklen) to mark free
+        self._lock = threading.RLock()
+        self._generation = 0
+        self._bare = False      # no commit block on disk yet
+        self._compactor = None
+        self.size = 0
+        self.free = 0
+        if os.path.exists(path):
+            with open(path, 'rb') as fi:
+                self._load(fi.read())
+
+    def _load(self, data):
+        if data[:len(SQRLdata.HEADER)] != SQRLdata.HEADER:
+            raise ValueError('incremental save needs the binary form')
+        view = memoryview(data)
+        found = []
+        offset, end = len(SQRLdata.HEADER), len(data)
+        while offset + 4 <= end:
+            blocklen, blocktype = _blockhead.unpack_from(data, offset)
+            if blocklen < 4 or offset + blocklen > end:
+                break   # a torn append
+            found.append((offset, blocklen, blocktype))
+            offset += blocklen
+        start, end = self._committed(data, found, offset)
+        self._bare = start == end > len(SQRLdata.HEADER)
+
+        # the last save may have crashed before freeing what it replaced
+        freed = set()
+        for offset, blocklen, blocktype in found:
+            if start <= offset < end and blocktype == FREE_BLOCKTYPE and \
+                    data[offset + 4:offset + 12] == FREED_MAGIC:
+                freed.update(struct.unpack_from(
+                    '<%dQ' % ((blocklen - _freed.size) // 8), data,
+                    offset + _freed.size))
+
+        typemap = self.typemap or {0: Block}
+        for offset, blocklen, blocktype in found:
+            if offset >= end:
+                break
+            if blocktype == FREE_BLOCKTYPE:
+                self.free += blocklen
+                continue
+            if offset in freed:
+                self._superseded.append((offset, blocklen))
+                continue
+            breader = typemap.get(blocktype) or typemap[0]
+            block = breader.frombuffer(view[offset:offset + blocklen], offset)
+            self.blocks.append(block)
+            self._offsets[id(block)] = (offset, blocklen)
+        self.size = end
+
+    @staticmethod
+    def _committed(data, found, scanned):
+        '''return (start, end) of the last save in the committed part'''
+        commits = [(o, l) for o, l, t in found
+                   if t == FREE_BLOCKTYPE and l == _commit.size and
+                   data[o + 4:o + 12] == COMMIT_MAGIC]
+        if not commits:
+            return scanned, scanned     # written by plain SQRLdata.dump
+        for offset, blocklen in reversed(commits):
+            _, _, _, start, digest = _commit.unpack_from(data, offset)
+            if start <= offset and sha256sum(data[start:offset]) == digest:
+                return start, offset + blocklen
+        return len(SQRLdata.HEADER), len(SQRLdata.HEADER)
+
+    def _drop(self, block):
+        # by identity: unknown blocks compare equal by content
+        for i, b in enumerate(self.blocks):
+            if b is block:
+                del self.blocks[i]
+                break
+        where = self._offsets.pop(id(block), None)
+        if where is not None:
+            self._superseded.append(where)
+
+    def add(self, block):
+        '''add a new block, replacing any block with the same identity'''
+        with self._lock:
+            key = identity(block)
+            if key is not None:
+                for old in [b for b in self.blocks if identity(b) == key]:
+                    self.remove(old)
+            self.blocks.append(block)
+            self._dirty[id(block)] = block
+
+    def changed(self, block):
+        '''note that block (already in blocks) was changed, e.g. resealed'''
+        with self._lock:
+            where = self._offsets.pop(id(block), None)
+            if where is not None:
+                self._superseded.append(where)
+            self._dirty[id(block)] = block
+
+    def remove(self, block):
+        with self._lock:
+            self._dirty.pop(id(block), None)
+            self._drop(block)
+
+    def save(self):
+        '''write the changes since the last save, return bytes appended'''
+        with self._lock:
+            written = self._save()
+            if (written and self.compact_ratio is not None and
+                    self.free > self.compact_ratio * self.size):
+                self.compact(background=True)
+            return written
+
+    def _save(self):
+        with self._lock:
+            if not self._dirty and not self._superseded:
+                return 0
+            if self._bare:
+                self._commit_bare()
+            start = self.size
+            bio = io.BytesIO()
+            if start == 0:
+                bio.write(SQRLdata.HEADER)
+            placed = []
+            for block in self._dirty.values():
+                offset = start + bio.tell()
+                block.dump(bio)
+                placed.append((block, offset, start + bio.tell() - offset))
+            live = bio.tell()
+            if self._superseded:
+                bio.write(freed_blocks([o for o, l in self._superseded]))
+            body = bio.getvalue()
+            body += commit_block(body, start)
+            with open(self.path, 'r+b' if start else 'wb') as fo:
+                fo.truncate(start)
+                fo.seek(start)
+                fo.write(body)
+                fo.flush()
+                os.fsync(fo.fileno())
+                if not start:
+                    _fsync_dir(self.path)
+                # the new copies are safe on disk: free the old ones
+                if self._superseded:
+                    free = FREE_BLOCKTYPE.to_bytes(2, 'little')
+                    for offset, blocklen in self._superseded:
+                        fo.seek(offset + 2)
+                        fo.write(free)
+                        self.free += blocklen
+                    fo.flush()
+                    os.fsync(fo.fileno())
+            for block, offset, blocklen in placed:
+                self._offsets[id(block)] = (offset, blocklen)
+            self._dirty.clear()
+            self._superseded.clear()
+            self.size = start + len(body)
+            self.free += len(body) - live
+            self._generation += 1
+            return len(body)
+
+    def _commit_bare(self):
+        # without a commit, everything that parses counts as written; a
+        # crash in the middle of an append would make the torn blocks live
+        start = self.size
+        with open(self.path, 'r+b') as fo:
+            data = fo.read(start)
+            fo.truncate(start)
+            fo.seek(start)
+            fo.write(commit_block(data[len(SQRLdata.HEADER):],
+                                  len(SQRLdata.HEADER)))
+            fo.flush()
+            os.fsync(fo.fileno())
+        self.size = start + _commit.size
+        self.free += _commit.size
+        self._bare = False
+
+    def compact(self, background=False):
+        '''rewrite the file with only the live blocks
+
+        With background=True, the file is written on another thread, which
+        is returned. Edits may go on meanwhile; if a save happens too, that
+        compaction is thrown away and a later one will pick up the slack.
+        Only one compaction runs at a time.
+        '''
+        worker = self._compactor
+        if worker is not None and worker.is_alive():
+            if background:
+                return worker
+            worker.join()
+        with self._lock:
+            self._save()
+            generation = self._generation
+            bio = io.BytesIO()
+            bio.write(SQRLdata.HEADER)
+            placed = []
+            for block in self.blocks:
+                offset = bio.tell()
+                block.dump(bio)
+                placed.append((block, offset, bio.tell() - offset))
+            body = bio.getvalue()
+            body += commit_block(body[len(SQRLdata.HEADER):],
+                                 len(SQRLdata.HEADER))
+
+        def finish():
+            tmp = self.path + '.tmp'
+            with open(tmp, 'wb') as fo:
+                fo.write(body)
+                fo.flush()
+                os.fsync(fo.fileno())
+            with self._lock:
+                if generation != self._generation:
+                    os.remove(tmp)
+                    return
+                os.replace(tmp, self.path)
+                _fsync_dir(self.path)
+                # blocks changed or removed since the snapshot have their
+                # new copies freed by the next save, as in the old file
+                offsets, superseded = {}, []
+                for b, o, l in placed:
+                    if id(b) in self._offsets:
+                        offsets[id(b)] = (o, l)
+                    else:
+                        superseded.append((o, l))
+                self._offsets = offsets
+                self._superseded = superseded
+                self.size = len(body)
+                self.free = _commit.size
+                self._bare = False
+
+        if not background:
+            finish()
+            return None
+        worker = self._compactor = threading.Thread(target=finish, daemon=True)
+        worker.start()
+        return worker
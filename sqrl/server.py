@@ -1,143 +1,808 @@
 '''
-This implentation is not threadsafe and not useful in a load-balanced environment.
+NutCase is not threadsafe. ThreadedNutCase may be shared by all the threads
+of one process. To run several load-balanced nodes, give each one a NutCase
+built on the same KeyRing.
 
 However, a single server should handle the load for thousands of active clients.
 '''
+import itertools
+import math
 import struct
+import sys
+import threading
 import time
 
-from base64 import urlsafe_b64decode, urlsafe_b64encode
+from array import array
 from collections import namedtuple
 import pysodium as na
 import ctypes
 
-from sqrl import KEY_BYTES, rng
+from sqrl import KEY_BYTES, metrics, rng
 from sqrl.crypto import Nonce, sha256sum
+from sqrl.s4enc import urlsafe_b64decode, urlsafe_b64encode
 
 
 Nut = namedtuple("Nut", "now,up,ip,flags")
+Cracked = namedtuple("Cracked", "nut,ipmatch,goodtime,replayed")
 
 
 NUT_IPV6 = 1
 
+NONCE_BYTES = na.crypto_secretbox_NONCEBYTES
+MAC_BYTES = na.crypto_secretbox_MACBYTES
+
+_secretbox = na.sodium.crypto_secretbox_easy
+_secretbox_open = na.sodium.crypto_secretbox_open_easy
+
+_issued = metrics.counter('sqrl_nuts_issued', 'nuts created')
+_cracked = metrics.counter(
+    'sqrl_nuts_cracked', 'nuts returned by clients, by outcome', ('result',))
+_crack_seconds = metrics.histogram(
+    'sqrl_nut_crack_seconds', 'NutCase.crack, from sealed nut to result')
+_shed = metrics.counter(
+    'sqrl_nuts_shed', 'requests refused by a NutCase rate limit', ('limit',))
+
+
+def fold_ip(ip, flags=0):
+    '''reduce a client address to the 4 bytes stored in a nut
+
+    IPv6 addresses are hashed, and marked with NUT_IPV6 in the returned flags.
+    '''
+    if len(ip) > 4:
+        return sha256sum(ip, 4), flags | NUT_IPV6
+    return ip, flags & ~NUT_IPV6
+
+
+def _outcome(goodtime, replayed):
+    return 'replayed' if replayed else 'good' if goodtime else 'expired'
+
+
+class ReplayCache:
+    '''remember the nonces of cracked nuts until the nuts expire
+
+    Nonces are recorded in a ring of Bloom filters, each covering `span`
+    seconds of nut issue time. Since a nut is only good for `timeout` seconds
+    after it was issued, a filter is simply replaced by a fresh one when its
+    slot comes around again. Memory is fixed when the cache is created, and
+    is about 1.44 * log2(1 / error) bits for each of `capacity` nuts per
+    timeout.
+
+    A false positive makes a fresh nut look replayed, with probability error.
+    '''
+
+    def __init__(self, timeout=300, capacity=1000000, error=1e-6, buckets=4):
+        self.span = span = -(-timeout // buckets)
+        per_bucket = -(-capacity // buckets)
+        bits = math.ceil(-per_bucket * math.log(error) / math.log(2) ** 2)
+        self._bits = bits
+        self._nbytes = (bits + 7) // 8
+        self._hashes = max(1, round(bits / per_bucket * math.log(2)))
+        # one more slot for nuts issued during the skew allowance
+        self._slots = [[-1, None] for _ in range(buckets + 2)]
+        self._lock = threading.Lock()
+
+    @property
+    def nbytes(self):
+        '''the most memory the filters will ever use'''
+        return self._nbytes * len(self._slots)
+
+    def seen(self, nonce, issued):
+        '''record nonce for a nut issued at time `issued`
+
+        returns True if it was already recorded
+        '''
+        epoch = issued // self.span
+        # the first byte of a nonce is the key id; the rest is a hash
+        h1 = int.from_bytes(nonce[8:16], 'little')
+        h2 = int.from_bytes(nonce[16:24], 'little') | 1
+        bits = self._bits
+        fresh = False
+        with self._lock:
+            slot = self._slots[epoch % len(self._slots)]
+            if slot[0] != epoch:
+                if slot[0] > epoch:
+                    # an expired nut; its filter has been reused
+                    return True
+                slot[0] = epoch
+                slot[1] = bytearray(self._nbytes)
+            bloom = slot[1]
+            for i in range(self._hashes):
+                b = (h1 + i * h2) % bits
+                mask = 1 << (b & 7)
+                if not bloom[b >> 3] & mask:
+                    bloom[b >> 3] |= mask
+                    fresh = True
+        return not fresh
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+class Shed(Exception):
+    '''raised by NutCase when a client is over its rate limit'''
+
+
+class RateLimiter:
+    '''token buckets per client address, in fixed memory
+
+    Each client may do `rate` things per second on average, in bursts of up
+    to `burst`. Addresses are reduced with fold_ip, after cutting IPv6
+    addresses to their first `v6prefix` bytes, since one host usually has a
+    whole /64.
+
+    There is no per-client entry. Each address hashes to one cell in each of
+    `rows` arrays of `width` cells, and a cell holds the time at which its
+    bucket will be full again (the GCRA form of a token bucket, one float).
+    A client is judged by the least loaded of its cells, and every cell
+    takes the charge, as in a count-min sketch with conservative update.
+    Clients that share all their cells share a bucket, so a flood from many
+    addresses can only make limits stricter, never use more memory.
+
+    shed counts the requests refused.
+    '''
+
+    def __init__(self, rate=1.0, burst=20, width=65536, rows=2, v6prefix=8):
+        self.interval = 1 / rate
+        self.limit = burst * self.interval
+        self.width = width
+        self.v6prefix = v6prefix
+        self._rows = [array('d', bytes(8 * width)) for _ in range(rows)]
+        # a random multiplier per row, so clients cannot choose collisions
+        self._salts = [int.from_bytes(rng.randombytes(8), 'little') | 1
+                       for _ in range(rows)]
+        self.shed = 0
+        self._lock = threading.Lock()
+
+    @property
+    def nbytes(self):
+        return 8 * self.width * len(self._rows)
+
+    def _cells(self, ip):
+        if len(ip) > 4:
+            ip = ip[:self.v6prefix]
+        ip, flags = fold_ip(ip)
+        x = int.from_bytes(ip, 'little') | flags << 32
+        width = self.width
+        return [(x * salt >> 32) % width for salt in self._salts]
+
+    def _due(self, cells, now):
+        # when the least loaded bucket is full again, but not before now
+        return max(now, min(row[c] for row, c in zip(self._rows, cells)))
+
+    def allow(self, ip, cost=1, now=None):
+        '''take cost tokens for ip, return False (and count it as shed) if
+        it does not have them'''
+        now = time.monotonic() if now is None else now
+        cells = self._cells(ip)
+        with self._lock:
+            due = self._due(cells, now) + cost * self.interval
+            if due - now > self.limit:
+                self.shed += 1
+                return False
+            self._charge(cells, due)
+        return True
+
+    def peek(self, ip, cost=1, now=None):
+        '''return True if ip has cost tokens, without taking them'''
+        now = time.monotonic() if now is None else now
+        cells = self._cells(ip)
+        with self._lock:
+            if self._due(cells, now) + cost * self.interval - now > self.limit:
+                self.shed += 1
+                return False
+        return True
+
+    def charge(self, ip, cost=1, now=None):
+        '''take cost tokens for ip, even if that puts it over the limit'''
+        now = time.monotonic() if now is None else now
+        cells = self._cells(ip)
+        with self._lock:
+            due = self._due(cells, now) + cost * self.interval
+            self._charge(cells, min(due, now + 2 * self.limit))
+
+    def _charge(self, cells, due):
+        for row, c in zip(self._rows, cells):
+            if row[c] < due:
+                row[c] = due
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+Transaction = namedtuple("Transaction", "session,ip,step")
+
+
+def nonce_of(sealed):
+    '''return the nonce of a sealed nut, the key for a TransactionTable'''
+    return urlsafe_b64decode(sealed)[:NONCE_BYTES]
+
+
+class TransactionTable:
+    '''map the nut of each pending login step to its browser session
+
+    Entries live in a timing wheel: a ring of dicts, each holding the
+    entries added during `span` seconds. When the clock moves into a new
+    span, the dicts whose entries are all older than `timeout` are thrown
+    away whole, so nothing is scanned and no entry has a timer. An entry
+    lasts at least timeout and less than timeout + span seconds.
+
+    At most `capacity` entries are kept; past that, adding an entry evicts
+    the oldest one.
+
+    expired and evicted count the entries dropped each way.
+    '''
+    _ENTRY_BYTES = (sys.getsizeof(bytes(NONCE_BYTES)) +
+                    sys.getsizeof(Transaction(None, None, 0)))
+
+    def __init__(self, timeout=300, capacity=1000000, buckets=4):
+        self.timeout = timeout
+        self.capacity = capacity
+        self.span = -(-timeout // buckets)
+        self._slots = [[-1, {}] for _ in range(buckets + 1)]
+        self._epoch = -1
+        self._count = 0
+        self.expired = self.evicted = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def nbytes(self):
+        '''about how much memory the table holds, not counting the
+        session and ip objects themselves'''
+        return (sum(sys.getsizeof(d) for _, d in self._slots) +
+                self._count * self._ENTRY_BYTES)
+
+    def _advance(self, now):
+        # the methods starting with _ are called with the lock held
+        epoch = now // self.span
+        if epoch <= self._epoch:
+            return
+        self._epoch = epoch
+        oldest = epoch - len(self._slots) + 1
+        for slot in self._slots:
+            if slot[0] < oldest and slot[1]:
+                self.expired += len(slot[1])
+                self._count -= len(slot[1])
+                slot[1] = {}
+
+    def _live(self):
+        '''yield the dicts of live entries, oldest first'''
+        n = len(self._slots)
+        for e in range(self._epoch - n + 1, self._epoch + 1):
+            slot = self._slots[e % n]
+            if slot[0] == e and slot[1]:
+                yield slot[1]
+
+    def _take(self, nonce):
+        for entries in self._live():
+            tx = entries.pop(nonce, None)
+            if tx is not None:
+                self._count -= 1
+                return tx
+        return None
+
+    def _put(self, nonce, tx):
+        self._take(nonce)
+        if self._count >= self.capacity:
+            for entries in self._live():
+                del entries[next(iter(entries))]
+                self._count -= 1
+                self.evicted += 1
+                break
+        slot = self._slots[self._epoch % len(self._slots)]
+        if slot[0] != self._epoch:
+            slot[0], slot[1] = self._epoch, {}
+        slot[1][nonce] = tx
+        self._count += 1
+        return tx
+
+    def add(self, nonce, session, ip, step=0, now=None):
+        '''record that the nut with nonce belongs to session'''
+        now = int(time.time()) if now is None else now
+        with self._lock:
+            self._advance(now)
+            return self._put(nonce, Transaction(session, ip, step))
+
+    def get(self, nonce, now=None):
+        '''return the Transaction for nonce, or None if unknown or expired'''
+        now = int(time.time()) if now is None else now
+        with self._lock:
+            self._advance(now)
+            for entries in self._live():
+                tx = entries.get(nonce)
+                if tx is not None:
+                    return tx
+            return None
+
+    def pop(self, nonce, now=None):
+        '''remove and return the Transaction for nonce, or None'''
+        now = int(time.time()) if now is None else now
+        with self._lock:
+            self._advance(now)
+            return self._take(nonce)
+
+    def advance(self, nonce, newnonce, now=None):
+        '''move the login waiting on nonce to its next step, now waiting on
+        newnonce, and return its new Transaction (None if it was unknown)'''
+        now = int(time.time()) if now is None else now
+        with self._lock:
+            self._advance(now)
+            tx = self._take(nonce)
+            if tx is None:
+                return None
+            return self._put(newnonce, tx._replace(step=tx.step + 1))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+class KeyRing:
+    '''the keys used to seal nuts, indexed by a one-byte key id
+
+    Each key is derived from a master secret and a rotation epoch (wall-clock
+    seconds divided by period), so every node holding a copy of the ring
+    switches to the same key at the same time, without any coordination.
+    The key id is the epoch modulo SLOTS; it travels with the nut, so the key
+    for a nut is found with one lookup.
+
+    rotate() installs the keys for the current and next epochs and drops the
+    ones no outstanding nut can use. Run it on a fixed cadence with a Rotator
+    (or sqrl.aioserver); keys missing from the ring are derived on demand.
+
+    Distribute the ring with dump/load, which encrypt it under a wrapping key
+    that you must provide to every node out of band.
+    '''
+    _struct = struct.Struct('>I{}s'.format(KEY_BYTES))
+    SLOTS = 256
+
+    def __init__(self, master=None, period=3600):
+        self.master = rng.randombytes(KEY_BYTES) if master is None else master
+        self.period = period
+        self._slots = [None] * self.SLOTS
+
+    def epoch(self, now):
+        return now // self.period
+
+    def derive(self, epoch):
+        '''return the nut key for the given epoch'''
+        # imported here: hmac pulls in hashlib, which nothing else needs
+        import hmac
+        msg = b'sqrl nut key' + epoch.to_bytes(8, 'big')
+        return hmac.new(self.master, msg, 'sha256').digest()
+
+    def _install(self, epoch):
+        entry = self._slots[epoch % self.SLOTS] = (epoch, self.derive(epoch))
+        return entry
+
+    def sealing(self, now):
+        '''return (keyid, key) for a nut issued at now'''
+        epoch = now // self.period
+        keyid = epoch % self.SLOTS
+        entry = self._slots[keyid]
+        if entry is None or entry[0] != epoch:
+            entry = self._install(epoch)
+        return keyid, entry[1]
+
+    def lookup(self, keyid, first, last):
+        '''return the key with keyid, if its epoch falls within first..last
+
+        returns None if no key in that span of time has this id
+        '''
+        lo, hi = first // self.period, last // self.period
+        entry = self._slots[keyid]
+        if entry is not None and lo <= entry[0] <= hi:
+            return entry[1]
+        epoch = hi - (hi - keyid) % self.SLOTS
+        if epoch < lo:
+            return None
+        return self._install(epoch)[1]
+
+    def rotate(self, now, keep):
+        '''install keys for the current and next epochs, and drop keys
+        for epochs that ended more than keep seconds ago'''
+        assert keep < (self.SLOTS - 2) * self.period
+        epoch = now // self.period
+        for e in epoch, epoch + 1:
+            entry = self._slots[e % self.SLOTS]
+            if entry is None or entry[0] != e:
+                self._install(e)
+        oldest = (now - keep) // self.period
+        for i, entry in enumerate(self._slots):
+            if entry is not None and entry[0] < oldest:
+                self._slots[i] = None
+
+    def dump(self, wrapkey):
+        '''export the ring, encrypted under wrapkey'''
+        nonce = rng.randombytes(NONCE_BYTES)
+        pt = self._struct.pack(self.period, self.master)
+        return nonce + na.crypto_secretbox(pt, nonce, wrapkey)
+
+    @classmethod
+    def load(cls, data, wrapkey):
+        '''import a ring exported by dump
+
+        raises ValueError if wrapkey is wrong or the data was altered
+        '''
+        pt = na.crypto_secretbox_open(
+            data[NONCE_BYTES:], data[:NONCE_BYTES], wrapkey)
+        period, master = cls._struct.unpack(pt)
+        return cls(master, period)
+
+
+class Rotator(threading.Thread):
+    '''rotate the keys of a NutCase every `interval` seconds
+
+    Runs in a daemon thread until stop() is called.
+    '''
+
+    def __init__(self, nutcase, interval=60):
+        super().__init__(daemon=True)
+        self.nutcase = nutcase
+        self.interval = interval
+        self._halt = threading.Event()
+
+    def run(self):
+        self.nutcase.rotate()
+        while not self._halt.wait(self.interval):
+            self.nutcase.rotate()
+
+    def stop(self):
+        self._halt.set()
+
 
 class NutCase:
     '''
 
-    To rotate keys, create a new instance, passing the old one as the first
-    parameter. When all nuts issued under the old key expire, it will
-    automatically be retired.
+    Keys rotate every keyring.period seconds without any help, but the
+    ring only drops old keys when rotate() is called. Start a Rotator to do
+    that on a fixed schedule.
 
     new start:
         nc = NutCase()
-
-    rotate:
-        nc = NutCase(nc)
+        Rotator(nc).start()
 
     restart:
         oldcase = pickle.dumps(nc)
         #ideally encrypt oldcase if you write it to non-volatile memory
 
-        nc = NutCase(pickle.loads(oldcase))
+        nc = pickle.loads(oldcase)
+
+    load-balanced:
+        ring = KeyRing.load(exported, wrapkey)   # on every node
+        nc = NutCase(keyring=ring)
 
     This implentation is not safe for unsynchronized use from multiple threads.
+    Use ThreadedNutCase for that.
 
     '''
     NUTBOX = struct.Struct('>II4sH')
+    SEALED_BYTES = NONCE_BYTES + MAC_BYTES + NUTBOX.size
+    # sealed nuts pack into base64 without padding, so a batch can be
+    # encoded in one call and sliced
+    assert SEALED_BYTES % 3 == 0
 
-    def __init__(self, previous=None, timeout=300):
+    def __init__(self, *, timeout=300, keyring=None, skew=5, replay=None,
+                 issue_limit=None, fail_limit=None):
         '''create a nut generator
 
-        previous: a previous instance that may have issued outstanding nuts
-        start: the starting nonce
-        timeout: maximum number of seconds a nut is valid for
+        All arguments are keyword-only.
 
-        This instance generates a random key. Nuts sealed by other instances
-        will not validate with this instance. (A server restart will invalidate
-        all outstanding nuts unless this instance is pickled and restored.
-        (Take care to not leak the key))
+        timeout: maximum number of seconds a nut is valid for
+        keyring: a KeyRing shared with other nodes
+        skew: how many seconds the clocks of nodes sharing keyring may differ
+        replay: a ReplayCache to detect nuts that are cracked more than once
+        issue_limit: a RateLimiter for the nuts issued to each client
+        fail_limit: a RateLimiter for the nuts from each client that fail
+            to open; a client over it is refused before any decryption
+
+        Without a keyring, this instance generates a private one. Nuts sealed
+        by other instances will not validate with this instance. (A server
+        restart will invalidate all outstanding nuts unless this instance is
+        pickled and restored. (Take care to not leak the key))
+
+        With a shared keyring, nuts are checked against wall-clock time only,
+        so any node sharing the ring can crack them.
         '''
-        self.old = previous
         self.start_now = int(time.time())
         self.start_up = int(time.monotonic())
         self.timeout = timeout
-        self.__key = rng.randombytes(KEY_BYTES)
+        self.shared = keyring is not None
+        self.keyring = KeyRing() if keyring is None else keyring
+        self.skew = skew
+        self.replay = replay
+        self.issue_limit = issue_limit
+        self.fail_limit = fail_limit
         self.nonce = Nonce()
 
     def new(self, ip, flags=0):
         '''create a nut based on the current time, prepared for a client at ip
 
-        This implementation has room for 16 flag bits.
+        This implementation has room for 16 flag bits. Raises Shed if ip is
+        over the issue limit.
         '''
-        if len(ip) > 4:
-            ip = sha256sum(ip, 4)
-            flags |= NUT_IPV6
-        else:
-            flags &= ~NUT_IPV6
-
-        now = int(time.time())
-        self._lastnow = now
-        up = int(time.monotonic())
+        if self.issue_limit is not None and not self.issue_limit.allow(ip):
+            if metrics.enabled:
+                _shed.labels('issue').inc()
+            raise Shed('too many nuts for this client')
+        if metrics.enabled:
+            _issued.inc()
+        ip, flags = fold_ip(ip, flags)
+        now, up = self._clock()
+        self._touch(now)
         nut = Nut(now, up, ip, flags)
         return nut
 
+    def _clock(self):
+        return int(time.time()), int(time.monotonic())
+
+    def _touch(self, now):
+        self._lastnow = now
+
+    def rotate(self):
+        '''prepare the next key and forget keys no outstanding nut can use'''
+        self.keyring.rotate(int(time.time()), 2 * self.timeout + self.skew)
+
+    def _openkey(self, keyid, now):
+        # keys stay usable for a second timeout, so a nut that has only
+        # just expired still opens and is reported as not goodtime
+        return self.keyring.lookup(
+            keyid, now - 2 * self.timeout - self.skew, now + self.skew)
+
     def seal(self, nut):
         '''encrypt a nut and prepare for sending to a client
         '''
         message = self.NUTBOX.pack(*nut)
-        nonce = next(self.nonce)
-        box = nonce + na.crypto_secretbox(message, nonce, self.__key)
+        keyid, key = self.keyring.sealing(nut.now)
+        # the first byte of the nonce carries the key id
+        nonce = bytes((keyid,)) + next(self.nonce)[1:]
+        box = nonce + na.crypto_secretbox(message, nonce, key)
         return urlsafe_b64encode(box)
 
+    def seal_many(self, ips, flags=0):
+        '''create and seal a nut for each address in ips
+
+        This is equivalent to [seal(new(ip, flags)) for ip in ips], but the
+        whole batch shares one clock sample and one reservation of nonces,
+        and the boxes are written into a single buffer. Instead of raising
+        Shed, addresses over the issue limit get None.
+        '''
+        limit = self.issue_limit
+        if limit is None:
+            return self._seal_many(ips, flags)
+        allowed = [limit.allow(ip) for ip in ips]
+        if metrics.enabled:
+            _shed.labels('issue').inc(allowed.count(False))
+        sealed = iter(self._seal_many(
+            [ip for ip, ok in zip(ips, allowed) if ok], flags))
+        return [next(sealed) if ok else None for ok in allowed]
+
+    def _seal_many(self, ips, flags):
+        count = len(ips)
+        if metrics.enabled:
+            _issued.inc(count)
+        now, up = self._clock()
+        self._touch(now)
+        size = self.SEALED_BYTES
+        buf = ctypes.create_string_buffer(count * size)
+        msg = ctypes.create_string_buffer(self.NUTBOX.size)
+        mlen = ctypes.c_ulonglong(self.NUTBOX.size)
+        pack_into = self.NUTBOX.pack_into
+        keyid, key = self.keyring.sealing(now)
+        keyid = bytes((keyid,))
+        for i, nonce in enumerate(self.nonce.take(count)):
+            ip, f = fold_ip(ips[i], flags)
+            pack_into(msg, 0, now, up, ip, f)
+            nonce = keyid + nonce[1:]
+            offset = i * size
+            buf[offset:offset + NONCE_BYTES] = nonce
+            _secretbox(ctypes.byref(buf, offset + NONCE_BYTES),
+                       msg, mlen, nonce, key)
+        sealed = urlsafe_b64encode(buf.raw)
+        step = size // 3 * 4
+        return [sealed[i:i + step] for i in range(0, len(sealed), step)]
+
     def open(self, nut):
         '''decrypt and verify the integrity of a nut returned by a client
 
         returns the original nut passed to seal
         '''
-        box = urlsafe_b64decode(nut)
-        nonce = box[:na.crypto_secretbox_NONCEBYTES]
-        ct = box[na.crypto_secretbox_NONCEBYTES:]
-        pt = na.crypto_secretbox_open(ct, nonce, self.__key)
-        return Nut(*self.NUTBOX.unpack(pt))
+        return self._unbox(nut)[0]
 
-    def expired(self):
-        '''return True if all issued nuts have expired'''
-        now = int(time.time())
-        then = self._lastnow + self.timeout
-        return then < now
+    def _unbox(self, nut):
+        box = urlsafe_b64decode(nut)
+        nonce = box[:NONCE_BYTES]
+        ct = box[NONCE_BYTES:]
+        key = self._openkey(box[0], int(time.time())) if box else None
+        if key is None:
+            raise ValueError('no key for this nut')
+        pt = na.crypto_secretbox_open(ct, nonce, key)
+        return Nut(*self.NUTBOX.unpack(pt)), nonce
 
     def crack(self, ip, sealed):
         '''sanity check the values in the nut
 
-        Because issued nuts are not stored by the server, we cannot prevent
-        replay attacks at this point, but the timestamp limits the window
-        of opportunity
-        '''
+        returns Cracked(nut, ipmatch, goodtime, replayed)
 
-        try:
-            nut = self.open(sealed)
-            # we are getting back new nuts, check to expire an old verifier
-        except ValueError:
-            if self.old:
-                return self.old.crack(ip, sealed)
-            else:
-                raise
+        Issued nuts are not stored by the server, so without a replay cache
+        we cannot prevent replay attacks at this point, but the timestamp
+        limits the window of opportunity. With a cache, `replayed` is set
+        when a nut with a good time has been cracked before.
 
-        if self.old and self.old.expired():
-            self.old = None
+        Raises Shed, without trying to open the nut, if ip has failed too
+        often.
+        '''
+        if not metrics.enabled:
+            return self._crack(ip, sealed)
+        with _crack_seconds.time():
+            try:
+                cracked = self._crack(ip, sealed)
+            except ValueError:
+                _cracked.labels('bad').inc()
+                raise
+        _cracked.labels(_outcome(cracked.goodtime, cracked.replayed)).inc()
+        return cracked
 
-        if len(ip) > 4:
-            # IPV6 might give an attacker enough room to force a collision
-            # of the first 4 bytes of a SHA2 hash
-            ip = na.crypto_hash_sha256(ip)[4:]
-            typematch = (nut.flags & NUT_IPV6) != 0
+    def _crack(self, ip, sealed):
+        fails = self.fail_limit
+        if fails is None:
+            nut, nonce = self._unbox(sealed)
         else:
-            typematch = (nut.flags & NUT_IPV6) == 0
-
-        ipmatch = typematch and ip == nut.ip
-        now = int(time.time())
-        up = int(time.monotonic())
-        goodtime = (nut.now >= self.start_now and now <= nut.now + self.timeout and
-                    nut.now <= self._lastnow and
-                    nut.up >= self.start_up and up <= nut.up + self.timeout)
-        return nut, ipmatch, goodtime
+            if not fails.peek(ip):
+                if metrics.enabled:
+                    _shed.labels('fail').inc()
+                raise Shed('too many bad nuts from this client')
+            try:
+                nut, nonce = self._unbox(sealed)
+            except ValueError:
+                fails.charge(ip)
+                raise
+        now, up = self._clock()
+        goodtime = self._goodtime(nut, now, up)
+        replay = self.replay
+        replayed = bool(goodtime and replay and replay.seen(nonce, nut.now))
+        return Cracked(nut, self._ipmatch(ip, nut), goodtime, replayed)
+
+    def crack_many(self, pairs):
+        '''crack a batch of (ip, sealed) pairs
+
+        The results are returned in columns, as a Cracked tuple of a list of
+        nuts, and bytearrays of the ipmatch, goodtime and replayed flags.
+        Instead of raising ValueError or Shed, a nut that cannot be opened,
+        or whose client is over the fail limit, is reported as None with all
+        flags clear.
+        '''
+        count = len(pairs)
+        nuts = [None] * count
+        ipmatch = bytearray(count)
+        goodtime = bytearray(count)
+        replayed = bytearray(count)
+        now, up = self._clock()
+        size = self.SEALED_BYTES
+        msg = ctypes.create_string_buffer(self.NUTBOX.size)
+        clen = ctypes.c_ulonglong(size - NONCE_BYTES)
+        unpack = self.NUTBOX.unpack
+        openkey = self._openkey
+        replay = self.replay
+        fails = self.fail_limit
+        for i, (ip, sealed) in enumerate(pairs):
+            if fails is not None and not fails.peek(ip):
+                if metrics.enabled:
+                    _shed.labels('fail').inc()
+                continue
+            try:
+                box = urlsafe_b64decode(sealed)
+            except ValueError:
+                box = b''
+            opened = False
+            if len(box) == size:
+                key = openkey(box[0], now)
+                nonce = box[:NONCE_BYTES]
+                opened = key is not None and not _secretbox_open(
+                    msg, box[NONCE_BYTES:], clen, nonce, key)
+            if not opened:
+                if fails is not None:
+                    fails.charge(ip)
+                continue
+            nut = nuts[i] = Nut(*unpack(msg.raw))
+            ipmatch[i] = self._ipmatch(ip, nut)
+            if self._goodtime(nut, now, up):
+                goodtime[i] = 1
+                if replay:
+                    replayed[i] = replay.seen(nonce, nut.now)
+        if metrics.enabled:
+            for nut, g, r in zip(nuts, goodtime, replayed):
+                _cracked.labels(
+                    'bad' if nut is None else _outcome(g, r)).inc()
+        return Cracked(nuts, ipmatch, goodtime, replayed)
+
+    def _ipmatch(self, ip, nut):
+        # IPV6 might give an attacker enough room to force a collision
+        # of the first 4 bytes of a SHA2 hash
+        ip, flags = fold_ip(ip)
+        return (ip == nut.ip and
+                (flags & NUT_IPV6) == (nut.flags & NUT_IPV6))
+
+    def _goodtime(self, nut, now, up):
+        if self.shared:
+            # other nodes' uptime and high-water mark are unknown here
+            return now - self.timeout <= nut.now <= now + self.skew
+        return (nut.now >= self.start_now and now <= nut.now + self.timeout and
+                nut.now <= self._lastnow and
+                nut.up >= self.start_up and up <= nut.up + self.timeout)
+
+
+class ThreadedNutCase(NutCase):
+    '''a NutCase that can be shared by many threads without a global lock
+
+    Each thread draws nonces from its own stream. The streams share a random
+    prefix extended by a per-thread stream number, so no two threads ever
+    hash the same counter. The _lastnow high-water mark only takes a lock
+    when the clock has moved forward, which is at most once per second.
+
+    Pickling works as for NutCase. A restored instance chooses a new random
+    prefix, so it will not repeat nonces issued before the restart.
+    '''
+
+    def __init__(self, *, timeout=300, keyring=None, skew=5, replay=None,
+                 issue_limit=None, fail_limit=None):
+        super().__init__(timeout=timeout, keyring=keyring, skew=skew,
+                         replay=replay, issue_limit=issue_limit,
+                         fail_limit=fail_limit)
+        self._lastnow = 0
+        self._start_streams()
+
+    def _start_streams(self):
+        self._local = threading.local()
+        # next() on itertools.count is atomic under the GIL
+        self._streams = itertools.count()
+        self._lock = threading.Lock()
+
+    @property
+    def nonce(self):
+        try:
+            return self._local.nonce
+        except AttributeError:
+            stream = next(self._streams).to_bytes(4, 'little')
+            nonce = self._local.nonce = Nonce(prefix=self._prefix + stream)
+            return nonce
+
+    @nonce.setter
+    def nonce(self, value):
+        self._prefix = value._prefix
+
+    def _touch(self, now):
+        if now > self._lastnow:
+            with self._lock:
+                if now > self._lastnow:
+                    self._lastnow = now
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for k in ('_local', '_streams', '_lock', '_prefix'):
+            del state[k]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.nonce = Nonce()
+        self._start_streams()
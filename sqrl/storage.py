@@ -1,4 +1,39 @@
+'''
+A simple typed block store.
+
+Blocks can be kept in memory and written out with dump, or attached to a
+journal file. An attached store never rewrites the file: adds and deletes
+are appended as records, and commit() makes them durable. Threads that
+commit at the same time share one fsync. Writers in other processes are
+kept out with an exclusive flock from a writer's first change until its
+commit, and each writer catches up on the others' records when it takes
+the lock. vacuum() rewrites the file with only the live blocks.
+
+Each record is applied whole or not at all, but a commit is not atomic: a
+crash during one may keep any prefix of the records it was writing, which
+is also what a group commit shares with other threads. A torn record at
+the end is dropped by the next writer.
+
+vacuum() also writes an index of the live blocks (type, offset, length),
+grouped by type, and a small directory of where each type's entries
+start. Every commit ends with a pointer to the directory, so attach() reads
+only the directory and whatever was appended since, not the whole file.
+The Block objects of a type are made when get_blocks (or anything that
+walks every block) first needs them; get_block and has_block need no more
+than one index entry. Payloads are read through an mmap when they are
+first used. Files without an index are scanned from the start.
+
+    store = Blocks(types)
+    store.attach('blocks.db')
+    store.add_block(bt, block)
+    store.commit()
+'''
+import fcntl
+import io
+import mmap
+import os
 import struct
+import threading
 
 from sqrl import rng
 from collections import defaultdict, namedtuple
@@ -14,6 +49,36 @@ class Block:
         self.dirty = True
         self.deleted = False
 
+    @property
+    def bdata(self):
+        data = self._bdata
+        if data is None:
+            start = self.offset + 4
+            data = self._bdata = self._source[start:start + self.bl - 4]
+        return data
+
+    @bdata.setter
+    def bdata(self, data):
+        self._bdata = data
+        self._source = None
+
+    def map(self, source, offset, bl, bt):
+        '''like load, but read the payload from source when it is used'''
+        self.bh = struct.pack('>HH', bl, bt)
+        self.bt = bt
+        self.bl = bl
+        self._bdata = None
+        self._source = source
+        self.offset = offset
+        self.dirty = False
+        self.deleted = False
+
+    def unload(self, source):
+        '''drop the payload, to be read again from source at offset'''
+        self.bl = len(self.bdata) + 4
+        self._bdata = None
+        self._source = source
+
     def load(self, fo, offset, bl, bt, bh):
         self.bh = bh
         self.bt = bt  # preserve blocktype on save
@@ -34,62 +99,443 @@ class Block:
 
 class Blocks(list):
     header = b'myblocks'
+    # a journal record that deletes the block at an offset
+    DELETE = 0xffff
+    _delete = struct.Struct('>HHQ')
+    # index records hold (type, offset, length) of live blocks, one type
+    # after another, each in file order
+    INDEX = 0xfffe
+    _entry = struct.Struct('>HQH')
+    _PER_INDEX = (0xffff - 4) // _entry.size
+    # directory records hold (type, count, offset of its first index record)
+    INDEXDIR = 0xfffc
+    _dirent = struct.Struct('>HQQ')
+    # a pointer record holds where the directory records start and end
+    INDEXPTR = 0xfffd
+    INDEXMAGIC = b'blkindx2'
+    _pointer = struct.Struct('>HH8sQQ')
 
     def __init__(self, types):
         self.tm = tm = defaultdict(Block)
         for t, c in types:
             tm[t] = c
         self.by_type = defaultdict(list)
+        self.by_offset = {}
+        self._live = defaultdict(int)
+        self._oldest = defaultdict(int)
+        self.path = None
+        self.syncs = 0
+        self._file = None
+        self._index = None
+        self._lazy = {}         # bt -> (count, first index record)
+        self._gone = set()      # offsets of indexed blocks deleted since
+        self._unlisted = []     # lists of indexed blocks not yet in self
+        self._cond = threading.Condition()
+
+    # the indexed blocks are only made when they are needed
+
+    def _entry_at(self, bt, k):
+        count, first = self._lazy[bt]
+        per = self._PER_INDEX
+        at = first + (k // per) * (4 + per * self._entry.size) + 4 + \
+            (k % per) * self._entry.size
+        return self._entry.unpack_from(self._map, at)[1:]
+
+    def _indexed(self, bt, offset, blocklen):
+        '''return the Block for an index entry, made once'''
+        block = self.by_offset.get(offset)
+        if block is None:
+            block = self.tm[bt]()
+            block.map(self._map, offset, blocklen, bt)
+            # already left out of the live count
+            block.deleted = offset in self._gone
+            self.by_offset[offset] = block
+        return block
+
+    def _blocks_of(self, bt):
+        '''return by_type[bt], with the indexed blocks made first'''
+        blocks = self.by_type[bt]
+        lazy = self._lazy.pop(bt, None)
+        if lazy is not None:
+            count, at = lazy
+            source, indexed = self._map, []
+            while len(indexed) < count:
+                bl = struct.unpack_from('>H', source, at)[0]
+                for _, offset, blocklen in self._entry.iter_unpack(
+                        source[at + 4:at + bl]):
+                    indexed.append(self._indexed(bt, offset, blocklen))
+                at += bl
+            blocks[:0] = indexed
+            self._unlisted.append(indexed)
+        return blocks
+
+    def _listed(self):
+        # make every block, and put them in file order
+        if self._lazy or self._unlisted:
+            for bt in list(self._lazy):
+                self._blocks_of(bt)
+            indexed = [b for blocks in self._unlisted for b in blocks]
+            indexed.sort(key=lambda b: b.offset)
+            self[:0] = indexed
+            del self._unlisted[:]
+        return self
+
+    def __iter__(self):
+        return list.__iter__(self._listed())
+
+    def __reversed__(self):
+        return list.__reversed__(self._listed())
+
+    def __len__(self):
+        return list.__len__(self._listed())
+
+    def __getitem__(self, i):
+        return list.__getitem__(self._listed(), i)
+
+    def _forget_indexed(self, offset):
+        # find the type whose sorted entries hold offset
+        for bt, (count, first) in self._lazy.items():
+            lo, hi = 0, count
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self._entry_at(bt, mid)[0] < offset:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            if lo < count and self._entry_at(bt, lo)[0] == offset:
+                if offset not in self._gone:
+                    self._gone.add(offset)
+                    self._live[bt] -= 1
+                return
 
     def add_block(self, bt, block):
-        self.append(block)
-        if block.SINGLETON:
-            old = self.by_type.get(bt)
-            if old:
-                old[0].deleted = True
-        self.by_type[bt].append(block)
+        with self._cond:
+            self._begin()
+            self.append(block)
+            if block.SINGLETON:
+                for old in self._blocks_of(bt):
+                    if not old.deleted:
+                        self._delete_block(old)
+            self.by_type[bt].append(block)
+            if not block.deleted:
+                self._live[bt] += 1
+            if self._file is not None:
+                self._write(block.dump)
+                block.offset += self._tail
+            if block.offset is not None:
+                self.by_offset[block.offset] = block
+
+    def _forget(self, block):
+        if not block.deleted:
+            block.deleted = True
+            self._live[block.bt] -= 1
+
+    def _delete_block(self, block):
+        self._forget(block)
+        if self._file is not None and block.offset is not None:
+            self._write(lambda fo: fo.write(self._delete.pack(
+                self._delete.size, self.DELETE, block.offset)))
 
     def has_block(self, bt):
-        return bt in self.by_type and len(self.by_type[bt] > 0)
+        '''return True if there is a block of type bt that is not deleted'''
+        return self._live.get(bt, 0) > 0
 
     def get_blocks(self, bt):
         '''return all blocks of type bt'''
-        return self.by_type[bt]
+        return self._blocks_of(bt)
 
     def get_block(self, bt):
         '''return the newest block of type bt'''
-        return self.by_type[bt][-1]
+        blocks = self.by_type[bt]
+        if not blocks and bt in self._lazy:
+            newest = self._entry_at(bt, self._lazy[bt][0] - 1)
+            return self._indexed(bt, *newest)
+        return blocks[-1]
 
     def del_block(self, bt):
         '''remove the oldest block of type bt'''
-        for b in self.by_type.get(bt, ()):
-            if not b.deleted:
-                b.deleted = True
-                break
+        with self._cond:
+            self._begin()
+            blocks = self._blocks_of(bt)
+            # skip the blocks deleted so far; each is passed over once
+            i = self._oldest[bt]
+            while i < len(blocks) and blocks[i].deleted:
+                i += 1
+            self._oldest[bt] = i
+            if i < len(blocks):
+                self._delete_block(blocks[i])
 
     def del_blocks(self, bt):
         '''remove all blocks of type bt'''
-        for b in self.by_type.get(bt, ()):
-            if not b.deleted:
-                b.deleted = True
+        with self._cond:
+            self._begin()
+            for b in self._blocks_of(bt):
+                if not b.deleted:
+                    self._delete_block(b)
 
-    def dump(self, fo):
+    def dump(self, fo, index=False):
+        '''write the live blocks to fo, followed by an index if asked'''
         fo.write(self.header)
         for block in self:
             if not block.deleted:
                 block.dump(fo)
+        if index:
+            self._dump_index(fo)
+
+    def _dump_index(self, fo):
+        entries = defaultdict(list)
+        for b in self:
+            if not b.deleted:
+                entries[b.bt].append(
+                    self._entry.pack(b.bt, b.offset, len(b.bdata) + 4))
+        directory = []
+        for bt, packed in entries.items():
+            directory.append(self._dirent.pack(bt, len(packed), fo.tell()))
+            self._dump_records(fo, self.INDEX, packed)
+        start = fo.tell()
+        self._dump_records(fo, self.INDEXDIR, directory)
+        self._index = (start, fo.tell())
+        fo.write(self._index_pointer())
+
+    @staticmethod
+    def _dump_records(fo, bt, packed):
+        # as many whole entries in each record as fit
+        per = (0xffff - 4) // len(packed[0]) if packed else 1
+        for i in range(0, len(packed), per):
+            chunk = b''.join(packed[i:i + per])
+            fo.write(struct.pack('>HH', len(chunk) + 4, bt))
+            fo.write(chunk)
+
+    def _index_pointer(self):
+        return self._pointer.pack(self._pointer.size, self.INDEXPTR,
+                                  self.INDEXMAGIC, *self._index)
 
     def load(self, fo):
         hh = fo.read(len(self.header))
         if hh != self.header:
             raise ValueError(
                 'expected {}, got {} when reading header'.format(self.header, hh))
+        self._replay(fo)
+
+    def _replay(self, fo):
+        '''read blocks and delete records from fo to its end'''
         while True:
             offset = fo.tell()
             bh = fo.read(4)
-            if not bh:
+            if len(bh) < 4:
+                fo.seek(offset)
                 break
             bl, bt = struct.unpack('>HH', bh)
+            if bt == self.DELETE:
+                target = fo.read(8)
+                if len(target) < 8:
+                    fo.seek(offset)
+                    break
+                target = struct.unpack('>Q', target)[0]
+                block = self.by_offset.get(target)
+                if block is not None:
+                    self._forget(block)
+                elif self._lazy:
+                    self._forget_indexed(target)
+                continue
+            if bt in (self.INDEX, self.INDEXDIR, self.INDEXPTR):
+                fo.seek(offset + bl)
+                continue
             block = self.tm[bt]()
             block.load(fo, offset, bl, bt, bh)
+            if len(block.bdata) < bl - 4:
+                fo.seek(offset)  # a torn append
+                break
             self.add_block(bt, block)
+
+    # journal
+
+    def attach(self, path):
+        '''load the journal file at path (creating it), and log changes to it'''
+        with self._cond:
+            self.path = path
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            self._file = open(fd, 'r+b')
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if not os.fstat(fd).st_size:
+                    self._file.write(self.header)
+                    self._sync(self._file)
+                self._reload()
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            self._pending = io.BytesIO()
+            self._locked = self._torn = False
+            self._syncing = False
+            self._seq = self._durable = 0
+
+    def _clear(self):
+        del self[:]
+        self.by_type.clear()
+        self.by_offset.clear()
+        self._live.clear()
+        self._oldest.clear()
+        self._lazy.clear()
+        self._gone.clear()
+        del self._unlisted[:]
+
+    def _reload(self):
+        self._clear()
+        fo, self._file = self._file, None   # replay without logging
+        try:
+            if not self._load_index(fo):
+                fo.seek(0)
+                self.load(fo)
+        finally:
+            self._file = fo
+        self._tail = fo.tell()
+
+    def _load_index(self, fo):
+        '''read the index directory, then replay what follows'''
+        self._index = None
+        size = os.fstat(fo.fileno()).st_size
+        if size < len(self.header) + self._pointer.size:
+            return False
+        source = mmap.mmap(fo.fileno(), 0, access=mmap.ACCESS_READ)
+        if source[:len(self.header)] != self.header:
+            raise ValueError('expected {}, got {} when reading header'.format(
+                self.header, source[:len(self.header)]))
+        bl, bt, magic, start, end = self._pointer.unpack_from(
+            source, size - self._pointer.size)
+        if (bt != self.INDEXPTR or magic != self.INDEXMAGIC or
+                bl != self._pointer.size or not start <= end <= size):
+            return False
+        self._map = source
+        # only the directory is read: blocks are made when they are needed
+        at = start
+        while at < end:
+            bl, bt = struct.unpack_from('>HH', source, at)
+            for bt, count, first in self._dirent.iter_unpack(
+                    source[at + 4:at + bl]):
+                self._lazy[bt] = (count, first)
+                self._live[bt] = count
+            at += bl
+        self._index = (start, end)
+        fo.seek(end)
+        self._replay(fo)
+        return True
+
+    def _sync(self, fo):
+        fo.flush()
+        os.fsync(fo.fileno())
+        self.syncs += 1
+
+    def _lock_file(self):
+        # called with _cond held; keep the file locked until commit
+        while True:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+            try:
+                current = os.stat(self.path).st_ino
+            except FileNotFoundError:
+                current = None
+            if current == os.fstat(self._file.fileno()).st_ino:
+                break
+            # vacuumed by another process: start over from the new file
+            self._file.close()
+            self._file = open(self.path, 'r+b')
+            self._reload()
+        self._locked = True
+        # replay whatever other processes appended since we last looked
+        self._file.seek(self._tail)
+        fo, self._file = self._file, None
+        try:
+            self._replay(fo)
+        finally:
+            self._file = fo
+        self._tail = fo.tell()
+        # anything past the tail was torn by a crash: cut it off on commit
+        self._torn = os.fstat(fo.fileno()).st_size > self._tail
+
+    def _begin(self):
+        # called with _cond held, before a change
+        if self._file is not None and not self._locked:
+            self._lock_file()
+
+    def _write(self, dump):
+        # called with _cond held. Offsets in the pending buffer are
+        # relative to _tail, where it will be written.
+        dump(self._pending)
+        self._seq += 1
+
+    def commit(self):
+        '''make every change made so far durable
+
+        If other threads commit at the same time, one fsync serves them all,
+        and a crash may leave part of what they wrote: see the module notes.
+        '''
+        cond = self._cond
+        with cond:
+            if self._file is None:
+                return
+            target = self._seq
+            while True:
+                while self._syncing and self._durable < target:
+                    cond.wait()
+                if self._durable >= target:
+                    return
+                self._syncing = True
+                data = self._pending.getvalue()
+                if self._index is not None:
+                    data += self._index_pointer()
+                self._pending = io.BytesIO()
+                at, upto = self._tail, self._seq
+                self._tail += len(data)
+                torn, self._torn = self._torn, False
+                cond.release()
+                try:
+                    if torn:
+                        self._file.truncate(at)
+                    self._file.seek(at)
+                    self._file.write(data)
+                    self._sync(self._file)
+                finally:
+                    cond.acquire()
+                    self._syncing = False
+                    cond.notify_all()
+                self._durable = upto
+                if self._durable == self._seq and self._locked:
+                    fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+                    self._locked = False
+
+    def vacuum(self):
+        '''rewrite the journal with only the live blocks'''
+        with self._cond:
+            self.commit()
+            self._begin()
+            tmp = self.path + '.tmp'
+            fo = open(tmp, 'w+b')
+            fcntl.flock(fo.fileno(), fcntl.LOCK_EX)
+            live = [b for b in self if not b.deleted]
+            self.dump(fo, index=True)
+            self._sync(fo)
+            os.replace(tmp, self.path)
+            dirfd = os.open(os.path.dirname(os.path.abspath(self.path)),
+                            os.O_RDONLY)
+            try:
+                os.fsync(dirfd)
+            finally:
+                os.close(dirfd)
+            self._file.close()
+            self._file = fo
+            self._clear()
+            self._map = mmap.mmap(fo.fileno(), 0, access=mmap.ACCESS_READ)
+            for block in live:
+                block.unload(self._map)
+                self.append(block)
+                self.by_type[block.bt].append(block)
+                self.by_offset[block.offset] = block
+                self._live[block.bt] += 1
+            self._tail = fo.tell()
+            fcntl.flock(fo.fileno(), fcntl.LOCK_UN)
+            self._locked = self._torn = False
+
+    def close(self):
+        if self._file is not None:
+            self.commit()
+            self._file.close()
+            self._file = None
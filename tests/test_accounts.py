@@ -0,0 +1,76 @@
+import threading
+
+from sqrl import rng
+from sqrl.accounts import Account, AccountStore, SQLiteAccountStore
+
+
+def key():
+    return rng.randombytes(32)
+
+
+def test_accounts(tmpdir):
+    store = SQLiteAccountStore(str(tmpdir.join('accounts.db')), cache_size=4)
+    a = Account(key(), key(), key(), None, 'alice', False)
+    store.create(a)
+    store.create_many(Account(key(), key(), key(), None, 'u%d' % i, False)
+                      for i in range(100))
+    assert store.get(a.idk) == a
+    assert store.find(a.idk, key()) == (a, False)
+    assert store.find(key()) == (None, False)
+
+    # after a rekey the old identity finds the account as previous
+    newidk = key()
+    store.rekey(a.idk, newidk, key(), key())
+    b = store.get(newidk)
+    assert b.user == 'alice' and b.pidk == a.idk
+    assert store.get(a.idk) is None
+    assert store.find(key(), newidk) == (b, True)
+    assert store.find(newidk, a.idk) == (b, False)
+    assert store.by_previous(a.idk) == b
+
+    # repeated logins are served from the cache
+    misses = store.misses
+    for _ in range(10):
+        assert store.find(newidk, a.idk) == (b, False)
+    assert store.misses == misses
+
+    store.set_disabled(newidk, True)
+    assert store.get(newidk).disabled
+    store.remove(newidk)
+    assert store.find(newidk) == (None, False)
+    assert len(store._cache) <= 4
+
+    # a read that raced a write is not cached
+    c = Account(key(), key(), key(), None, 'carol', False)
+    store.create(c)
+    writes = store._miss()
+    store.set_disabled(c.idk, True)
+    store._remember(c.idk, c, writes)
+    assert store.get(c.idk).disabled
+
+    # each thread gets its own connection
+    seen = []
+
+    def worker():
+        seen.append((store._db(), store.get(a.idk)))
+
+    threads = [threading.Thread(target=worker) for _ in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(set(id(db) for db, _ in seen)) == 3
+
+
+def test_interface():
+    try:
+        AccountStore()
+        assert False
+    except TypeError:
+        pass
+
+
+if __name__ == '__main__':
+    import tempfile, py
+    test_accounts(py.path.local(tempfile.mkdtemp()))
+    test_interface()
@@ -0,0 +1,161 @@
+import asyncio
+import threading
+from urllib.parse import urlencode, urlsplit
+
+import pysodium as na
+
+from sqrl.aioserver import *
+from sqrl.s4enc import decode, encode
+from sqrl.server import NutCase, RateLimiter
+
+
+async def http(port, method, target, body=b''):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write('{} {} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {}\r\n'
+                 'Connection: close\r\n\r\n'.format(
+                     method, target, len(body)).encode('ascii') + body)
+    data = await reader.read()
+    writer.close()
+    head, _, payload = data.partition(b'\r\n\r\n')
+    return int(head.split()[1]), payload
+
+
+def client_post(server, pk, sk, cmd='query'):
+    client = encode('ver=1\r\ncmd={}\r\nidk={}\r\n'.format(
+        cmd, encode(pk).decode('ascii')).encode('ascii')).decode('ascii')
+    ids = na.crypto_sign_detached((client + server).encode('ascii'), sk)
+    return urlencode({'client': client, 'server': server,
+                      'ids': encode(ids).decode('ascii')}).encode('ascii')
+
+
+def parse_reply(payload):
+    return dict(line.split('=', 1) for line in
+                decode(payload).decode('ascii').split('\r\n') if line)
+
+
+def test_loopback():
+    seen = []
+
+    def handler(req):
+        seen.append(req.client['cmd'])
+        return TIF_ID_MATCH, {'suk': 'x'}
+
+    async def run():
+        srv = SQRLServer(handler=handler)
+        listener = await srv.start()
+        port = listener.sockets[0].getsockname()[1]
+        try:
+            status, url = await http(port, 'GET', '/nut')
+            assert status == 200
+            url = urlsplit(url.decode('ascii'))
+            pk, sk = na.crypto_sign_keypair()
+            server = encode(url.geturl().encode('ascii')).decode('ascii')
+            target = url.path + '?' + url.query
+
+            status, payload = await http(
+                port, 'POST', target, client_post(server, pk, sk))
+            reply = parse_reply(payload)
+            assert int(reply['tif'], 16) == TIF_ID_MATCH | TIF_IP_MATCH
+            assert reply['suk'] == 'x'
+
+            # the next command goes to the qry in the reply, and signs it
+            server = payload.decode('ascii')
+            status, payload = await http(
+                port, 'POST', reply['qry'],
+                client_post(server, pk, sk, 'ident'))
+            assert int(parse_reply(payload)['tif'], 16) & TIF_ID_MATCH
+
+            # a bad signature never reaches the handler
+            other = na.crypto_sign_keypair()[1]
+            status, payload = await http(
+                port, 'POST', reply['qry'], client_post(server, pk, other))
+            tif = int(parse_reply(payload)['tif'], 16)
+            assert tif & TIF_CLIENT_FAILURE
+            assert seen == ['query', 'ident']
+        finally:
+            listener.close()
+            srv.close()
+
+    asyncio.run(run())
+
+
+async def raw(port, data):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(data)
+    data = await asyncio.wait_for(reader.read(), 5)
+    writer.close()
+    return data
+
+
+def test_bad_requests():
+    def handler(req):
+        raise RuntimeError('the database is down')
+
+    async def run():
+        srv = SQRLServer(handler=handler, timeout=0.1)
+        listener = await srv.start()
+        port = listener.sockets[0].getsockname()[1]
+        try:
+            for data in (b'nonsense\r\n\r\n',
+                         b'GET /nut HTTP/1.1\r\n' + b'X: y\r\n' * 100 + b'\r\n',
+                         b'POST /sqrl HTTP/1.1\r\nContent-Length: x\r\n\r\n'):
+                assert (await raw(port, data)).startswith(b'HTTP/1.1 400 ')
+            status, payload = await http(port, 'POST', '/sqrl?nut=x', b'\xff')
+            assert status == 400
+
+            # a client that sends nothing is hung up on
+            assert await raw(port, b'GET /nut HTTP/1.1\r\n') == b''
+
+            # a failing handler fails the command, not the connection
+            status, url = await http(port, 'GET', '/nut')
+            url = urlsplit(url.decode('ascii'))
+            pk, sk = na.crypto_sign_keypair()
+            server = encode(url.geturl().encode('ascii')).decode('ascii')
+            status, payload = await http(port, 'POST',
+                                         url.path + '?' + url.query,
+                                         client_post(server, pk, sk))
+            assert status == 200
+            assert int(parse_reply(payload)['tif'], 16) & TIF_COMMAND_FAILED
+        finally:
+            listener.close()
+            srv.close()
+
+    asyncio.run(run())
+
+
+def test_shed():
+    async def run():
+        nc = NutCase(issue_limit=RateLimiter(rate=0.01, burst=1))
+        srv = SQRLServer(nutcase=nc)
+        listener = await srv.start()
+        port = listener.sockets[0].getsockname()[1]
+        try:
+            status, url = await http(port, 'GET', '/nut')
+            assert status == 200
+            status, payload = await http(port, 'GET', '/nut')
+            assert status == 429
+        finally:
+            listener.close()
+            srv.close()
+
+    asyncio.run(run())
+
+
+def test_offload_backpressure():
+    release = threading.Event()
+
+    async def run():
+        offload = Offload(workers=1, backlog=1)
+        first = asyncio.ensure_future(offload(release.wait))
+        second = asyncio.ensure_future(offload(release.wait))
+        await asyncio.sleep(0)
+        try:
+            await offload(release.wait)
+            assert False
+        except Busy:
+            pass
+        release.set()
+        assert await first and await second
+        offload.shutdown()
+
+    asyncio.run(run())
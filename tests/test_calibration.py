@@ -0,0 +1,45 @@
+import json
+import math
+
+from sqrl.calibration import *
+from sqrl.crypto import enscrypt
+from sqrl.s4 import Rescue
+
+rc = b'0000-0000-0000-0000-0000-0000'
+
+
+def test_calibration(tmpdir):
+    path = str(tmpdir.join('cal.json'))
+    cal = Calibration(path, sample=.1)
+    rate = cal.rate(4)
+    assert rate > 0
+    assert cal.iterations(4, 1) == math.ceil(rate)
+    assert cal.iterations(4, 0, 20) == 20
+
+    # the measurement is reused by the next process on this host
+    cal2 = Calibration(path)
+    assert cal2.rates == {4: rate}
+    assert abs(cal2.estimate(4, 100) - 100 / rate) < 1e-9
+
+    with open(path) as fi:
+        data = json.load(fi)
+    data['fingerprint'] = 'some other host'
+    with open(path, 'w') as fo:
+        json.dump(data, fo)
+    assert Calibration(path).rates == {}
+
+
+def test_planned_seal():
+    cal = Calibration(None, sample=.1)
+    key = bytes(range(32))
+    planned = cal.iterations(4, .2, 1)
+    rb = Rescue.seal(key, rc, 4, 1, .2, plan=cal)
+    assert rb.iterations == planned
+    assert rb.open(rc) == key
+
+    # the time cap wins over the planned iterations
+    i, t, dkey = enscrypt(rc, b'salt', 4, 10 ** 9, maxtime=.1)
+    assert 1 < i < 10 ** 9
+    rb = Rescue.seal(key, rc, 4, 10 ** 9, 0, maxtime=.1)
+    assert rb.iterations < 10 ** 9
+    assert rb.open(rc) == key
@@ -30,6 +30,26 @@ def test_enhash():
             assert enhash(key) == expected
 
 
+def test_aead():
+    from cryptography.exceptions import InvalidTag
+    key, iv, ad = os.urandom(KEY_BYTES), os.urandom(12), b'header'
+    box = AEAD(key)
+    ct, tag = encrypt(key, iv, b'secret', ad)
+    assert box.encrypt(iv, b'secret', ad) == (ct, tag)
+    assert box.decrypt(iv, ct, ad, tag) == b'secret'
+
+    buf = bytearray(4 + len(ct) + len(tag))
+    box.encrypt_into(iv, b'secret', ad, memoryview(buf)[4:])
+    assert buf == bytes(4) + ct + tag
+    assert decrypt(box, iv, memoryview(buf)[4:-len(tag)], ad, tag) == b'secret'
+
+    try:
+        box.decrypt(iv, ct, b'other', tag)
+        assert False
+    except InvalidTag:
+        pass
+
+
 def test_enscrypt():
     '''this is a very time-consuming test (by design).'''
 
@@ -53,6 +73,88 @@ def test_enscrypt_time():
     assert t >= 3
     assert i > 1
 
+def test_enscrypt_checkpoint():
+    import threading
+    ckey = bytes(32)
+    expected = enscrypt(b'pw', b'salt', 4, 50)
+
+    stop = threading.Event()
+    seen = []
+
+    def progress(i, t):
+        seen.append(i)
+        if i >= 20:
+            stop.set()
+
+    job = EnScryptJob(b'pw', b'salt', 4)
+    try:
+        job.run(50, progress=progress, interval=0, cancel=stop)
+        assert False
+    except Cancelled:
+        pass
+    assert 20 <= job.iterations < 50
+    assert seen[-1] >= 20
+    assert seen == sorted(seen)
+    saved = job.checkpoint(ckey)
+
+    try:
+        EnScryptJob.resume(saved, b'x' * 32, b'pw')
+        assert False
+    except ValueError:
+        pass
+    job = EnScryptJob.resume(saved, ckey, b'pw')
+    i, t, dkey = job.run(50)
+    assert i == 50
+    assert dkey == expected[-1]
+
+
+def test_enscrypt_maxtime():
+    # at logN 9 one iteration takes tens of milliseconds: the limit must
+    # still hold to within one of them
+    i, t, dkey = enscrypt(b'pw', b'salt', 9, 10 ** 9, maxtime=.2)
+    assert .2 <= t < .2 + 2 * t / i
+
+
+def test_enscrypt_pool():
+    import asyncio
+    expected = enscrypt(b'pw', b'salt', 4, 10)[-1]
+    with EnScryptPool(workers=3) as pool:
+        timed = [pool.submit(b'pw', bytes((i,)), 4, 1, .3) for i in range(3)]
+        fixed = pool.submit(b'pw', b'salt', 4, 10)
+        for f in timed:
+            i, t, dkey = f.result()
+            # each job gets its own budget, even when they share a core
+            assert t >= .3
+        assert fixed.result()[-1] == expected
+
+        async def derive():
+            return await pool.derive(b'pw', b'salt', 4, 10)
+        assert asyncio.run(derive())[-1] == expected
+
+
+def test_sign_verify():
+    import pysodium
+    pk, sk = pysodium.crypto_sign_keypair()
+    msg = b'client=abc&server=def'
+    sig = sign(msg, sk)
+    assert sign(msg, sk[:KEY_BYTES], pk) == sig
+    assert verify(sig, msg, pk)
+    assert not verify(sig, msg + b'x', pk)
+    assert not verify(sig[:-1], msg, pk)
+    assert not verify(sig, msg, pk[:-1])
+
+    items = []
+    for i in range(200):
+        m = msg + bytes((i,))
+        items.append((sign(m, sk), m, pk))
+    items[3] = (items[3][0], msg, pk)
+    items[70] = (b'short', msg, pk)
+    items[199] = (items[199][0], items[199][1], b'')
+    good = verify_many(items)
+    assert len(good) == 200
+    assert [i for i, g in enumerate(good) if not g] == [3, 70, 199]
+    assert list(verify_many(items[:5])) == [1, 1, 1, 0, 1]
+
 NULLIV = b'\0' * 12
 
 MINITER_INTERACTIVE = 20
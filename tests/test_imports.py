@@ -0,0 +1,29 @@
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def loaded(module):
+    '''return the modules a fresh interpreter has after importing module'''
+    out = subprocess.run(
+        [sys.executable, '-c',
+         'import sys, {}; print(" ".join(sys.modules))'.format(module)],
+        cwd=ROOT, capture_output=True, text=True, check=True)
+    return set(out.stdout.split())
+
+
+def test_lazy_imports():
+    # nut workers never touch AES-GCM
+    assert 'cryptography' not in loaded('sqrl.server')
+    assert not {'cryptography', 'concurrent.futures'} & loaded('sqrl.s4')
+    assert not {'cryptography', 'click', 'correcthorse'} & loaded('s4dump')
+
+    # and it comes back as soon as it is needed
+    assert 'cryptography' in loaded(
+        'sqrl.crypto; sqrl.crypto.encrypt(bytes(32), bytes(12), b"", b"")')
+
+
+if __name__ == '__main__':
+    test_lazy_imports()
@@ -0,0 +1,95 @@
+import io
+import time
+
+from sqrl import metrics
+from sqrl.crypto import encrypt, decrypt, enscrypt
+from sqrl.s4 import SQRLdata, Previous
+
+
+def test_registry():
+    reg = metrics.Registry()
+    c = reg.counter('test_things', 'things done', ('kind',))
+    c.labels('a').inc()
+    c.labels('a').inc(2)
+    c.labels('b"').inc()
+    h = reg.histogram('test_seconds', buckets=(0.1, 1))
+    for x in 0.05, 0.5, 5:
+        h.observe(x)
+    reg.gauge('test_rate').set(1.5)
+    assert reg.counter('test_things') is c
+    try:
+        reg.gauge('test_things')
+        assert False
+    except ValueError:
+        pass
+
+    text = metrics.prometheus_text(reg)
+    assert text.splitlines() == [
+        '# TYPE test_rate gauge',
+        'test_rate 1.5',
+        '# TYPE test_seconds histogram',
+        'test_seconds_bucket{le="0.1"} 1',
+        'test_seconds_bucket{le="1"} 2',
+        'test_seconds_bucket{le="+Inf"} 3',
+        'test_seconds_sum 5.55',
+        'test_seconds_count 3',
+        '# HELP test_things things done',
+        '# TYPE test_things counter',
+        'test_things_total{kind="a"} 3',
+        'test_things_total{kind="b\\""} 1',
+    ]
+
+
+def test_instrumented():
+    key = bytes(32)
+    iv = bytes(12)
+    encs = metrics.REGISTRY.histogram('sqrl_encrypt_seconds')
+    loaded = metrics.REGISTRY.counter('sqrl_s4_blocks_loaded')
+    before = encs.count, loaded.value
+
+    # nothing is recorded while disabled
+    ct, tag = encrypt(key, iv, b'x', b'')
+    assert (encs.count, loaded.value) == before
+
+    metrics.enable()
+    try:
+        ct, tag = encrypt(key, iv, b'x', b'')
+        try:
+            decrypt(key, iv, ct, b'', bytes(16))
+            assert False
+        except Exception:
+            pass
+        enscrypt(b'pw', bytes(16), 4, 3)
+        bio = io.BytesIO()
+        SQRLdata([Previous.seal(key, [key])]).dump(bio)
+        bio.seek(0)
+        assert len(list(SQRLdata.load(bio))) == 1
+    finally:
+        metrics.enable(False)
+    assert encs.count == before[0] + 1
+    assert loaded.value == before[1] + 1
+    text = metrics.prometheus_text()
+    assert 'sqrl_decrypt_failures_total 1' in text
+    assert 'sqrl_enscrypt_iterations_per_second{logN="4"}' in text
+    assert 'sqrl_s4_seal_seconds_count{block="Previous"} 1' in text
+
+
+def test_sampler(tmpdir):
+    path = str(tmpdir.join('profile.txt'))
+
+    def spin():
+        end = time.perf_counter() + 0.1
+        while time.perf_counter() < end:
+            pass
+
+    with metrics.Sampler(path, interval=0.001) as sampler:
+        spin()
+    assert sum(sampler.stacks.values()) > 10
+    with open(path) as fi:
+        top = fi.readline()
+    assert 'test_metrics.py:spin ' in top
+
+
+if __name__ == '__main__':
+    test_registry()
+    test_instrumented()
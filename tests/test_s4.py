@@ -1,5 +1,5 @@
 from sqrl.s4 import *
-from sqrl.s4ext import Secret
+from sqrl.s4ext import Secret, KeyCache, SECRET_CHUNK
 from pysodium import crypto_sign_seed_keypair, crypto_sign_keypair
 
 rc = b'0000-0000-0000-0000-0000-0000'
@@ -55,5 +55,158 @@ def test_s4():
     assert piuk == piuk1
 
 
+
+def cached(cache):
+    '''the cache's own buffer for the key it handed out last'''
+    return next(reversed(cache._entries.values()))[1]
+
+
+def test_key_cache():
+    now = [0]
+    cache = KeyCache(capacity=2, idle=60, clock=lambda: now[0])
+    imk = rng.randombytes(KEY_BYTES)
+    a = Secret.make(b'shop', b'amazon', b'a')
+    b = Secret.make(b'shop', b'amazon', b'b')
+    c = Secret.make(b'shop', b'ebay', b'a')
+
+    a.seal(imk, b'one', cache=cache)
+    assert a.open(imk, cache=cache) == b'one'
+    assert a.open(imk) == b'one'
+    assert (cache.hits, cache.misses) == (1, 1)
+    key = a.get_key(imk, cache)
+    assert key == a.get_key(imk)
+    held = cached(cache)
+    # resealing the same block uses a new nonce
+    assert a.seal(imk, b'two', cache=cache).open(imk) == b'two'
+
+    # a different IMK gets a different key
+    assert a.get_key(rng.randombytes(KEY_BYTES), cache) != key
+
+    # least recently used keys are dropped and wiped, but not the copies
+    # callers already have
+    b.get_key(imk, cache)
+    c.get_key(imk, cache)
+    assert len(cache) == 2
+    assert held == bytes(KEY_BYTES)
+    assert key == a.get_key(imk)
+
+    # so are idle ones
+    key = c.get_key(imk, cache)
+    held = cached(cache)
+    now[0] = 60
+    b.get_key(imk, cache)
+    assert len(cache) == 1
+    assert held == bytes(KEY_BYTES)
+    assert key == c.get_key(imk)
+
+    b.get_key(imk, cache)
+    held = cached(cache)
+    cache.clear()
+    assert len(cache) == 0
+    assert held == bytes(KEY_BYTES)
+
+
+def test_bulk_secrets():
+    imk = rng.randombytes(KEY_BYTES)
+    count = 3 * SECRET_CHUNK
+    vault = SQRLdata([Block.for_bytes(77, b'other')])
+    for i in range(count):
+        name = str(i).encode('ascii')
+        vault.append(Secret.make(b'p', b'r', name).seal(imk, b'pw' + name))
+    # spoil one tag
+    bad = vault[10]
+    ad, ct, tag = bad.aead
+    bad.aead = type(bad.aead)(ad, ct, bytes(len(tag)))
+
+    opened = sorted(vault.open_secrets(imk))
+    assert [x.index for x in opened] == list(range(1, count + 1))
+    for i, block, secret, error in opened:
+        if i == 10:
+            assert secret is None and error is not None
+        else:
+            assert error is None
+            assert secret == b'pw' + block.username
+
+    newimk = rng.randombytes(KEY_BYTES)
+    failed = [x.index for x in vault.reseal_secrets(imk, newimk) if x.error]
+    assert failed == [10]
+    assert vault[11].open(newimk) == b'pw' + vault[11].username
+    errors = [x.index for x in vault.open_secrets(newimk) if x.error]
+    assert errors == [10]
+
+
+def test_threaded_reseal():
+    # workers share one small cache, so keys are evicted while others
+    # are still using them
+    from concurrent.futures import ThreadPoolExecutor
+    imk = rng.randombytes(KEY_BYTES)
+    vault = SQRLdata(
+        Secret.make(b'p', b'r', str(i).encode('ascii')).seal(imk, b'pw')
+        for i in range(1000))
+    with ThreadPoolExecutor(8) as pool:
+        for _ in range(2):
+            results = list(vault.reseal_secrets(
+                imk, executor=pool, cache=KeyCache(capacity=2)))
+            assert not any(x.error for x in results)
+    assert all(block.open(imk) == b'pw' for block in vault)
+
+
+def test_frombuffer(tmpdir):
+    iuk = gen_iuk()
+    imk = enhash(iuk)
+    vault = SQRLdata([
+        Access(logN=1, pwverifysecs=0).seal(imk + iuk, pw),
+        Rescue.seal(iuk, rc, 1, 1, 0),
+        Previous.seal(imk, [gen_iuk(), gen_iuk()]),
+        Block.for_bytes(77, b'unknown'),
+        Secret.make(b'shop', b'amazon', b'me').seal(imk, b'hunter2'),
+    ])
+    bio = io.BytesIO()
+    vault.dump(bio)
+    data = bio.getvalue()
+
+    blocks = SQRLdata.frombuffer(data, tm)
+    for block in blocks:
+        if hasattr(block, 'aead'):
+            assert block.aead.ciphertext.obj is data
+    assert [type(x) for x in blocks] == [type(x) for x in vault]
+    assert blocks[0].open(pw) == (imk, iuk)
+    assert blocks[1].open(rc) == iuk
+    assert blocks[2].open(imk) == vault[2].open(imk)
+    assert blocks[3].data == vault[3].data
+    assert blocks[4].username == b'me'
+    assert blocks[4].open(imk) == b'hunter2'
+    out = io.BytesIO()
+    blocks.dump(out)
+    assert out.getvalue() == data
+
+    text = vault.ascii().encode('ascii')
+    ascii = SQRLdata.frombuffer(text, tm)
+    assert ascii[4].open(imk) == b'hunter2'
+    streamed = list(SQRLdata._load_ascii(io.BytesIO(text[8:]), tm, chunk=7))
+    assert streamed[4].open(imk) == b'hunter2'
+    try:
+        list(SQRLdata.load(io.BytesIO(text[:-10]), tm))
+        assert False
+    except ValueError:
+        pass
+
+    path = str(tmpdir.join('vault.bin'))
+    with open(path, 'wb') as fo:
+        fo.write(data)
+    mapped = SQRLdata.map(path, tm)
+    assert mapped[4].open(imk) == b'hunter2'
+    assert list(SQRLdata.load(io.BytesIO(data), tm))[4].open(imk) == b'hunter2'
+
+    for bad in data[:-1], data[:8] + b'\x02\x00\x01\x00':
+        try:
+            SQRLdata.frombuffer(bad, tm)
+            assert False
+        except ValueError:
+            pass
+
+
 if __name__ == '__main__':
     test_s4()
+    test_key_cache()
+    test_bulk_secrets()
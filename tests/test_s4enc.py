@@ -24,7 +24,31 @@ def test_all():
     t3 = b' \n '.join(all[i:i + 10] for i in range(0, len(all), 10))
     assert decode(all)==decode(t3)
     #print(t3.decode('ascii'))
+def test_incremental():
+    import io
+    data = bytes(range(256)) * 3 + b'xy'
+    text = encode(data)
+    for size in 1, 2, 5, 64:
+        enc = Encoder()
+        out = b''.join(enc.update(data[i:i + size])
+                       for i in range(0, len(data), size)) + enc.finish()
+        assert out == text
+
+        wrapped = b'\r\n'.join(text[i:i + 7] for i in range(0, len(text), 7))
+        dec = Decoder()
+        out = b''.join(dec.update(wrapped[i:i + size])
+                       for i in range(0, len(wrapped), size)) + dec.finish()
+        assert out == data
+
+    sink = io.BytesIO()
+    enc = Encoder(sink, buffer=10)
+    for i in range(0, len(data), 3):
+        enc.write(data[i:i + 3])
+    enc.finish()
+    assert sink.getvalue() == text
+
 
 if __name__ == '__main__':
     test_b64u()
     test_all()
+    test_incremental()
@@ -0,0 +1,165 @@
+import os
+
+from sqrl import KEY_BYTES, rng
+from sqrl.s4 import SQRLdata, Block, Access, Rescue, Previous
+from sqrl.s4ext import Secret
+from sqrl.s4file import VaultFile, FREE_BLOCKTYPE
+
+tm = dict((x.BLOCKTYPE, x) for x in (Block, Access, Rescue, Previous, Secret))
+
+
+def secrets(imk, count):
+    return [Secret.make(b'p', b'r', str(i).encode('ascii')).seal(imk, b'pw%d' % i)
+            for i in range(count)]
+
+
+def test_incremental_save(tmpdir):
+    path = str(tmpdir.join('vault.bin'))
+    imk = rng.randombytes(KEY_BYTES)
+    vf = VaultFile(path, tm, compact_ratio=None)
+    for s in secrets(imk, 50):
+        vf.add(s)
+    vf.add(Block.for_bytes(77, b'unknown'))
+    vf.save()
+    size = os.path.getsize(path)
+
+    # one change costs about one block, however big the vault
+    s = vf.blocks[7]
+    s.seal(imk, b'changed')
+    vf.changed(s)
+    written = vf.save()
+    assert written < 2 * s.blocklen + 64
+    assert os.path.getsize(path) == size + written
+
+    vf.remove(vf.blocks[3])
+    vf.save()
+
+    again = VaultFile(path, tm)
+    assert len(again.blocks) == 50
+    opened = dict((b.username, b.open(imk)) for b in again.blocks
+                  if isinstance(b, Secret))
+    assert opened[b'7'] == b'changed'
+    assert opened[b'8'] == b'pw8'
+    assert b'3' not in opened
+    assert again.free > 0
+
+    # other readers see the free blocks as unknown blocks
+    with open(path, 'rb') as fi:
+        plain = SQRLdata.frombuffer(fi.read(), tm)
+    assert sum(1 for b in plain if b.blocktype == FREE_BLOCKTYPE) == 7
+
+    again.compact()
+    assert again.free < 100
+    third = VaultFile(path, tm)
+    assert [b.username for b in third.blocks if isinstance(b, Secret)] == \
+        [b.username for b in again.blocks if isinstance(b, Secret)]
+
+
+def test_crash_recovery(tmpdir):
+    path = str(tmpdir.join('vault.bin'))
+    imk = rng.randombytes(KEY_BYTES)
+    vf = VaultFile(path, tm, compact_ratio=None)
+    for s in secrets(imk, 3):
+        vf.add(s)
+    vf.save()
+    with open(path, 'rb') as fi:
+        good = fi.read()
+
+    # a crash during the append: everything after the last commit,
+    # whole blocks or not, is ignored
+    lost = Secret.make(b'p', b'r', b'1').seal(imk, b'lost')
+    for tail in lost.aead.authdata, b''.join(lost.aead):
+        with open(path, 'ab') as fo:
+            fo.write(tail)
+        vf = VaultFile(path, tm, compact_ratio=None)
+        assert vf.size == len(good)
+        assert vf.blocks[1].open(imk) == b'pw1'
+
+    # the new copy was committed, but the old one was never freed
+    offset, blocklen = vf._offsets[id(vf.blocks[1])]
+    vf.add(Secret.make(b'p', b'r', b'1').seal(imk, b'kept'))
+    vf.save()
+    with open(path, 'r+b') as fo:
+        fo.seek(offset)
+        fo.write(good[offset:offset + 4])
+    vf = VaultFile(path, tm, compact_ratio=None)
+    assert [b.open(imk) for b in vf.blocks] == [b'pw0', b'pw2', b'kept']
+    vf.save()
+    assert VaultFile(path, tm).free > blocklen
+
+
+def test_dump_duplicates(tmpdir):
+    # copies with the same identity are only dropped after a crash
+    path = str(tmpdir.join('vault.bin'))
+    imk = rng.randombytes(KEY_BYTES)
+    twins = secrets(imk, 1) * 2 + secrets(imk, 2)[1:]
+    with open(path, 'wb') as fo:
+        SQRLdata(twins).dump(fo)
+    vf = VaultFile(path, tm, compact_ratio=None)
+    assert len(vf.blocks) == 3
+    vf.blocks[2].seal(imk, b'changed')
+    vf.changed(vf.blocks[2])
+    vf.save()
+    again = VaultFile(path, tm)
+    assert [b.open(imk) for b in again.blocks] == [b'pw0', b'pw0', b'changed']
+
+
+def test_first_save_crash(tmpdir):
+    # a vault from SQRLdata.dump, cut off anywhere in its first save
+    path = str(tmpdir.join('vault.bin'))
+    imk = rng.randombytes(KEY_BYTES)
+    with open(path, 'wb') as fo:
+        SQRLdata(secrets(imk, 3)).dump(fo)
+    with open(path, 'rb') as fi:
+        good = fi.read()
+    vf = VaultFile(path, tm, compact_ratio=None)
+    vf.add(Secret.make(b'p', b'r', b'1').seal(imk, b'new'))
+    vf.save()
+    with open(path, 'rb') as fi:
+        saved = fi.read()
+
+    # the old copy is only freed once the save is committed
+    for cut in range(len(good), len(saved)):
+        with open(path, 'wb') as fo:
+            fo.write(good + saved[len(good):cut])
+        vf = VaultFile(path, tm, compact_ratio=None)
+        assert [(b.username, b.open(imk)) for b in vf.blocks] == \
+            [(b'0', b'pw0'), (b'1', b'pw1'), (b'2', b'pw2')]
+    with open(path, 'wb') as fo:
+        fo.write(saved)
+    vf = VaultFile(path, tm, compact_ratio=None)
+    assert [b.open(imk) for b in vf.blocks] == [b'pw0', b'pw2', b'new']
+
+
+def test_edit_while_compacting(tmpdir):
+    path = str(tmpdir.join('vault.bin'))
+    imk = rng.randombytes(KEY_BYTES)
+    vf = VaultFile(path, tm, compact_ratio=None)
+    for s in secrets(imk, 4):
+        vf.add(s)
+    vf.save()
+    vf.remove(vf.blocks[0])
+    with vf._lock:
+        # the snapshot is taken; the swap waits for the lock
+        worker = vf.compact(background=True)
+        s = vf.blocks[1]
+        s.seal(imk, b'changed')
+        vf.changed(s)
+        vf.remove(vf.blocks[0])
+    worker.join()
+    vf.save()
+    again = VaultFile(path, tm)
+    opened = dict((b.username, b.open(imk)) for b in again.blocks)
+    assert opened == {b'2': b'changed', b'3': b'pw3'}
+    with open(path, 'rb') as fi:
+        plain = SQRLdata.frombuffer(fi.read(), tm)
+    assert len([b for b in plain if isinstance(b, Secret)]) == 2
+
+
+if __name__ == '__main__':
+    import tempfile, py
+    test_incremental_save(py.path.local(tempfile.mkdtemp()))
+    test_crash_recovery(py.path.local(tempfile.mkdtemp()))
+    test_dump_duplicates(py.path.local(tempfile.mkdtemp()))
+    test_first_save_crash(py.path.local(tempfile.mkdtemp()))
+    test_edit_while_compacting(py.path.local(tempfile.mkdtemp()))
@@ -3,6 +3,7 @@ import sqrl.server
 from sqrl.server import *
 
 import time
+from base64 import urlsafe_b64decode
 
 
 class MockTime:
@@ -22,8 +23,11 @@ class MockTime:
 
 def test_rotate():
     ft = sqrl.server.time = MockTime()
-
-    nc = NutCase()
+    ft.tick(150 - ft._now % 150)  # the start of a rotation period
+    ring = KeyRing(period=150)
+    nc = NutCase(keyring=ring)
+    rotator = Rotator(nc, 0.01)
+    rotator.start()
 
     ip = bytearray((192, 168, 0, 100))
     ip2 = bytearray((192, 168, 0, 200))
@@ -32,25 +36,27 @@ def test_rotate():
     s1 = nc.seal(n1)
     ft.tick(160)
 
-    nc = NutCase(nc)
-    assert not nc.old.expired()
-
     n2 = nc.new(ip2)
     s2 = nc.seal(n2)
+    assert urlsafe_b64decode(s1)[0] != urlsafe_b64decode(s2)[0]
 
-    nn,ipm,gt = nc.crack(ip,s1)
+    nn,ipm,gt,rp = nc.crack(ip,s1)
     assert n1 == nn
 
-    ft.tick(160)
-    assert nc.old.expired()
-
+    rotator.stop()
+    rotator.join()
+    ft.tick(660)
+    nc.rotate()
+    epoch = ring.epoch(n1.now)
+    assert ring._slots[epoch % ring.SLOTS] is None
+    assert ring._slots[(epoch + 5) % ring.SLOTS] is not None
 
-    nn,ipm,gt = nc.crack(ip2,s2)
+    nn,ipm,gt,rp = nc.crack(ip2,s2)
     assert n2 == nn
-    assert nc.old is None
+    assert not gt
 
     try:
-        nn,ipm,gt = nc.crack(ip,s1)
+        nn,ipm,gt,rp = nc.crack(ip,s1)
         assert False
     except ValueError:
         pass
@@ -62,6 +68,14 @@ def test_nut():
     ip = bytearray((192, 168, 0, 100))
     ip2 = bytearray((192, 168, 0, 200))
 
+    # the old NutCase(previous) form must not be taken for a timeout
+    for cls in NutCase, ThreadedNutCase:
+        try:
+            cls(nc)
+            assert False
+        except TypeError:
+            pass
+
     print(ft._now)
     n0 = nc.new(ip)
     ft.tick(300)
@@ -77,33 +91,232 @@ def test_nut():
     s1 = nc.seal(n1)
     s2 = nc.seal(n2)
 
-    nn,ipm,gt = nc.crack(ip,s0)
+    nn,ipm,gt,rp = nc.crack(ip,s0)
     assert n0 == nn
     assert ipm
     assert not gt
 
-    nn,ipm,gt = nc.crack(ip,s1)
+    nn,ipm,gt,rp = nc.crack(ip,s1)
     assert n1 == nn
     assert ipm
     assert gt
 
-    nn,ipm,gt = nc.crack(ip2,s1)
+    nn,ipm,gt,rp = nc.crack(ip2,s1)
     assert n1 == nn
     assert not ipm
     assert gt
 
-    nn,ipm,gt = nc.crack(ip,s2)
+    nn,ipm,gt,rp = nc.crack(ip,s2)
     assert n2 == nn
     assert ipm
     assert gt
 
     ft.tick(301)
-    nn,ipm,gt = nc.crack(ip,s2)
+    nn,ipm,gt,rp = nc.crack(ip,s2)
     assert n2 == nn
     assert ipm
     assert not gt
 
 
+def test_many():
+    ft = sqrl.server.time = MockTime()
+    nc = NutCase()
+    ips = [bytearray((10, 0, 0, i)) for i in range(20)]
+    ips.append(bytes(range(16)))
+
+    sealed = nc.seal_many(ips)
+    assert len(sealed) == len(ips)
+    for ip, s in zip(ips, sealed):
+        nn, ipm, gt, rp = nc.crack(ip, s)
+        assert ipm
+        assert gt
+
+    other = NutCase()
+    bad = nc.seal(nc.new(ips[0]))[:-4] + b'AAAA'
+    pairs = list(zip(ips, sealed))
+    pairs.reverse()
+    pairs += [(ips[0], bad), (ips[1], other.seal_many(ips[:1])[0]),
+              (ips[1], nc.seal_many(ips[:1])[0])]
+    nuts, ipm, gt, rp = nc.crack_many(pairs)
+    assert nuts[:len(ips)] == [nc.crack(ip, s)[0] for ip, s in pairs[:len(ips)]]
+    assert all(ipm[:len(ips)])
+    assert all(gt[:len(ips)])
+    assert nuts[-3] is None and not ipm[-3] and not gt[-3]
+    assert nuts[-2] is None
+    assert nuts[-1].ip == ips[0]
+    assert not ipm[-1]
+    assert gt[-1]
+
+    ft.tick(301)
+    nuts, ipm, gt, rp = nc.crack_many(pairs)
+    assert not any(gt)
+
+def test_threaded():
+    import pickle
+    import threading
+    sqrl.server.time = MockTime()
+    nc = ThreadedNutCase()
+    ip = bytearray((192, 168, 0, 100))
+    results = []
+
+    def worker():
+        sealed = [nc.seal(nc.new(ip)) for _ in range(50)]
+        sealed += nc.seal_many([ip] * 50)
+        results.extend(sealed)
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    nonces = set(urlsafe_b64decode(s)[:NONCE_BYTES] for s in results)
+    assert len(nonces) == len(results) == 800
+
+    nc2 = pickle.loads(pickle.dumps(nc))
+    nuts, ipm, gt, rp = nc2.crack_many([(ip, s) for s in results])
+    assert all(ipm)
+    assert all(gt)
+    s2 = nc2.seal(nc2.new(ip))
+    assert urlsafe_b64decode(s2)[:NONCE_BYTES] not in nonces
+
+def test_keyring():
+    ft = sqrl.server.time = MockTime()
+    wrapkey = b'k' * 32
+    ring = KeyRing(period=600)
+    exported = ring.dump(wrapkey)
+    try:
+        KeyRing.load(exported, b'x' * 32)
+        assert False
+    except ValueError:
+        pass
+
+    a = NutCase(keyring=ring)
+    b = ThreadedNutCase(keyring=KeyRing.load(exported, wrapkey))
+    ip = bytearray((192, 168, 0, 100))
+
+    s1 = a.seal(a.new(ip))
+    ft._mo += 1000  # node b booted at a different time
+    nn, ipm, gt, rp = b.crack(ip, s1)
+    assert ipm and gt
+
+    ft.tick(250)
+    s2 = b.seal_many([ip])[0]
+    ft.tick(250)
+    # s1 is now 500 seconds old: its key may have been dropped already
+    nuts, ipm, gt, rp = a.crack_many([(ip, s1), (ip, s2)])
+    assert not gt[0]
+    assert nuts[1] and gt[1]
+
+    c = NutCase(keyring=KeyRing(period=600))
+    nuts, ipm, gt, rp = c.crack_many([(ip, s2)])
+    assert nuts == [None]
+
+def test_replay():
+    ft = sqrl.server.time = MockTime()
+    cache = ReplayCache(timeout=300, capacity=10000, error=1e-4)
+    size = cache.nbytes
+    nc = NutCase(replay=cache)
+    ip = bytearray((192, 168, 0, 100))
+    sealed = nc.seal_many([ip] * 100)
+
+    assert not any(nc.crack_many([(ip, s) for s in sealed[:50]]).replayed)
+    nn, ipm, gt, rp = nc.crack(ip, sealed[50])
+    assert gt and not rp
+    nn, ipm, gt, rp = nc.crack(ip, sealed[0])
+    assert gt and rp
+    assert all(nc.crack_many([(ip, s) for s in sealed]).replayed[:51])
+
+    # old filters are recycled as time passes
+    for _ in range(10):
+        ft.tick(100)
+        for s in nc.seal_many([ip] * 100):
+            assert not nc.crack(ip, s).replayed
+    assert cache.nbytes == size
+
+
+def test_transactions():
+    ft = sqrl.server.time = MockTime()
+    table = TransactionTable(timeout=300, capacity=100)
+    nc = NutCase()
+    ip = bytearray((192, 168, 0, 100))
+    s1 = nc.seal(nc.new(ip))
+    table.add(nonce_of(s1), 'session', ip)
+    assert table.get(nonce_of(s1)) == ('session', ip, 0)
+
+    # each reply carries a new nut for the same session
+    ft.tick(100)
+    s2 = nc.seal(nc.new(ip))
+    tx = table.advance(nonce_of(s1), nonce_of(s2))
+    assert tx == ('session', ip, 1)
+    assert table.get(nonce_of(s1)) is None
+    assert table.advance(nonce_of(s1), nonce_of(s2)) is None
+    assert len(table) == 1
+
+    # entries outlive the nut, then go all at once
+    ft.tick(300)
+    assert table.get(nonce_of(s2)) == tx
+    ft.tick(table.span)
+    assert table.get(nonce_of(s2)) is None
+    assert len(table) == 0 and table.expired == 1
+
+    # past capacity the oldest entries give way
+    for i in range(150):
+        table.add(i.to_bytes(NONCE_BYTES, 'big'), i, ip)
+        if i % 50 == 0:
+            ft.tick(table.span)
+    assert len(table) == 100 and table.evicted == 50
+    assert table.get(bytes(NONCE_BYTES)) is None
+    assert table.pop((149).to_bytes(NONCE_BYTES, 'big')).session == 149
+    assert table.nbytes > 99 * table._ENTRY_BYTES
+
+
+def test_rate_limit():
+    ft = sqrl.server.time = MockTime()
+    limiter = RateLimiter(rate=1, burst=5, width=1024)
+    ip = bytearray((192, 168, 0, 100))
+    assert all(limiter.allow(ip) for _ in range(5))
+    assert not limiter.allow(ip)
+    assert limiter.allow(bytearray((192, 168, 0, 101)))
+    assert limiter.allow(ip, now=ft.monotonic() + 1.5)
+    assert limiter.shed == 1
+
+    # one host, many addresses in its /64
+    v6 = bytes(range(16))
+    for i in range(5):
+        assert limiter.allow(v6[:15] + bytes((i,)))
+    assert not limiter.allow(v6)
+    assert limiter.nbytes == 2 * 8 * 1024
+
+    nc = NutCase(issue_limit=RateLimiter(rate=1, burst=3),
+                 fail_limit=RateLimiter(rate=1, burst=2))
+    sealed = nc.seal_many([ip] * 4)
+    assert sealed[3] is None and all(sealed[:3])
+    try:
+        nc.new(ip)
+        assert False
+    except Shed:
+        pass
+    ft.tick(1)
+    assert nc.crack(ip, nc.seal(nc.new(ip))).goodtime
+
+    # failures are counted, and then nuts are refused without opening them
+    bad = sealed[0][:-4] + b'AAAA'
+    for _ in range(2):
+        try:
+            nc.crack(ip, bad)
+            assert False
+        except ValueError:
+            pass
+    try:
+        nc.crack(ip, sealed[0])
+        assert False
+    except Shed:
+        pass
+    nuts, ipm, gt, rp = nc.crack_many([(ip, sealed[0])])
+    assert nuts == [None]
+    assert nc.fail_limit.shed == 2
+
 
 if __name__ == '__main__':
     test_rotate()
@@ -1,4 +1,6 @@
 import io
+import os
+import struct
 
 from sqrl import rng
 from sqrl.storage import *
@@ -45,5 +47,141 @@ def test_add_block():
     assert len(rb)==3
 
 
+def test_journal(tmpdir):
+    import threading
+    path = str(tmpdir.join('blocks.db'))
+    types = ((13, MyBlock), (37, Singleton))
+    mb = Blocks(types)
+    mb.attach(path)
+    b1 = MyBlock(13, rng.randombytes(50))
+    mb.add_block(13, b1)
+    mb.add_block(37, Singleton(37, b'one'))
+    mb.add_block(37, Singleton(37, b'two'))
+    mb.del_block(13)
+    mb.commit()
+    size = os.path.getsize(path)
+
+    # another writer sees the changes, and its own are appended after them
+    other = Blocks(types)
+    other.attach(path)
+    assert other.get_block(37).bdata == b'two'
+    assert [b.deleted for b in other.get_blocks(37)] == [True, False]
+    assert other.get_blocks(13)[0].deleted
+    other.add_block(13, MyBlock(13, b'other'))
+    other.commit()
+    assert os.path.getsize(path) > size
+    mb.add_block(13, MyBlock(13, b'mine'))
+    mb.commit()
+    assert [b.bdata for b in mb.get_blocks(13)][1:] == [b'other', b'mine']
+
+    # many threads, far fewer fsyncs
+    syncs = mb.syncs
+
+    def writer(n):
+        for i in range(20):
+            mb.add_block(13, MyBlock(13, bytes((n, i))))
+            mb.commit()
+
+    threads = [threading.Thread(target=writer, args=(n,)) for n in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert mb.syncs - syncs <= 160
+    live = [b.bdata for b in mb if not b.deleted]
+
+    mb.vacuum()
+    again = Blocks(types)
+    again.attach(path)
+    assert [b.bdata for b in again] == live
+    assert not any(b.deleted for b in again)
+    # the other writer notices the new file
+    other.add_block(13, MyBlock(13, b'late'))
+    other.commit()
+    assert len(other) == len(live) + 1
+    other.close()
+    mb.close()
+
+
+def test_index(tmpdir):
+    path = str(tmpdir.join('blocks.db'))
+    types = ((13, MyBlock), (37, Singleton))
+    mb = Blocks(types)
+    mb.attach(path)
+    assert not mb.has_block(13)
+    for i in range(3000):
+        mb.add_block(13, MyBlock(13, i.to_bytes(4, 'big')))
+    mb.add_block(37, Singleton(37, b'single'))
+    mb.commit()
+    mb.vacuum()
+    mb.add_block(13, MyBlock(13, b'after'))
+    mb.del_block(13)
+    mb.del_block(13)
+    mb.commit()
+    mb.close()
+
+    rb = Blocks(types)
+    rb.attach(path)
+    assert rb._index is not None
+    # opening makes only the block appended since the vacuum, and the
+    # newest block of a type costs one more
+    assert len(rb.by_offset) == 1
+    assert rb.has_block(13) and rb.has_block(37)
+    assert rb.get_block(37).bdata == b'single'
+    assert rb.get_block(13).bdata == b'after'
+    assert len(rb.by_offset) == 2
+    # payloads are read when they are used
+    assert all(b._bdata is None for b in rb.get_blocks(13)[:-1])
+    blocks = rb.get_blocks(13)
+    assert [b.deleted for b in blocks[:3]] == [True, True, False]
+    assert blocks[2].bdata == (2).to_bytes(4, 'big')
+    assert blocks[3]._bdata is None
+    assert rb.has_block(37)
+    rb.del_blocks(37)
+    assert not rb.has_block(37)
+    rb.del_block(13)
+    assert blocks[2].deleted and not blocks[3].deleted
+    rb.close()
+
+    # walking the store puts every block back in file order
+    again = Blocks(types)
+    again.attach(path)
+    again.get_block(37)
+    assert [b.bdata for b in again if not b.deleted][-2:] == \
+        [(2999).to_bytes(4, 'big'), b'after']
+    assert len(again) == 3002
+    assert [b.offset for b in again] == sorted(b.offset for b in again)
+    again.close()
+
+
+def test_torn_tail(tmpdir):
+    path = str(tmpdir.join('blocks.db'))
+    types = ((13, MyBlock), (37, Singleton))
+    mb = Blocks(types)
+    mb.attach(path)
+    mb.add_block(13, MyBlock(13, b'kept'))
+    mb.close()
+    # a crash in the middle of a long block
+    with open(path, 'ab') as fo:
+        fo.write(struct.pack('>HH', 104, 13) + b'x' * 40)
+
+    mb = Blocks(types)
+    mb.attach(path)
+    assert [b.bdata for b in mb] == [b'kept']
+    # a shorter record must not leave the torn bytes behind it
+    mb.add_block(13, MyBlock(13, b'next'))
+    mb.add_block(37, Singleton(37, b'one'))
+    mb.commit()
+    mb.close()
+    again = Blocks(types)
+    again.attach(path)
+    assert [b.bdata for b in again] == [b'kept', b'next', b'one']
+    again.close()
+
+
 if __name__ == '__main__':
-    test_blocks()
+    import tempfile, py
+    test_add_block()
+    test_journal(py.path.local(tempfile.mkdtemp()))
+    test_index(py.path.local(tempfile.mkdtemp()))
+    test_torn_tail(py.path.local(tempfile.mkdtemp()))